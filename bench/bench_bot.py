@@ -0,0 +1,379 @@
+"""
+bot.py のよく呼ばれる関数とスラッシュコマンドのベンチマーク
+
+  python bench/bench_bot.py                      # 全ケースを実行
+  python bench/bench_bot.py -k ランキング         # 名前に文字列を含むケースだけ
+  python bench/bench_bot.py --save before        # 結果を bench/baselines/before.json に保存
+  python bench/bench_bot.py --compare before     # 保存した結果と比べる（悪化したケースがあれば終了コード1）
+
+保存先は一時ファイルの SQLite（STORAGE_BACKEND=sqlite）で、Storage のメソッド呼び出しを数えるラッパーを挟む。
+Storage の1呼び出しがおおむね Firestore の1往復にあたるので、「往復」は本番で払うネットワーク往復の目安になる。
+Discord 側は偽の Interaction / Guild / Member で置き換え、コマンドは .callback を直接呼ぶ。
+データ量はユーザー1万人・商品500件・100万枚の宝くじ。
+"""
+import argparse
+import asyncio
+import json
+import os
+import platform
+import random
+import sys
+import tempfile
+import threading
+import time
+import tracemalloc
+from collections import Counter
+from types import SimpleNamespace
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+BASELINE_DIR = os.path.join(ROOT, "bench", "baselines")
+sys.path.insert(0, ROOT)
+
+USERS = 10_000
+SHOPS = 10
+PRODUCTS_PER_SHOP = 50
+INVENTORY_ITEMS = 60
+LOTTERY_TICKETS = 1_000_000
+VERIFIED_ROLE_ID = 1408273149199650867  # bot.py のコマンドが確認する認証ロール
+
+# bot.py を読み込む前に保存先を差し替える
+_tmpdir = tempfile.TemporaryDirectory(prefix="raruin-bench-")
+os.environ["STORAGE_BACKEND"] = "sqlite"
+os.environ["SQLITE_PATH"] = os.path.join(_tmpdir.name, "bench.db")
+os.environ["BACKUP_CHANNEL_ID"] = "0"
+os.environ.setdefault("DISCORD_TOKEN", "bench")
+
+import bot  # noqa: E402
+from lottery import draw_unit_lottery, split_inventory  # noqa: E402
+
+# --- Storage の呼び出し回数を数える ---
+class CountingStorage:
+    """Storage のメソッド呼び出し（= 往復の目安）を数える"""
+    def __init__(self, inner):
+        self.inner = inner
+        self.calls = 0
+        self.by_method = Counter()
+        self._lock = threading.Lock()
+
+    def __getattr__(self, name):
+        attr = getattr(self.inner, name)
+        if not callable(attr):
+            return attr
+        def counted(*args, **kwargs):
+            with self._lock:
+                self.calls += 1
+                self.by_method[name] += 1
+            return attr(*args, **kwargs)
+        return counted
+
+# --- 偽の Discord オブジェクト ---
+class FakeRole:
+    def __init__(self, role_id, name="role"):
+        self.id = role_id
+        self.name = name
+        self.members = []
+
+class FakeMember:
+    def __init__(self, member_id, display_name, roles):
+        self.id = member_id
+        self.name = display_name
+        self.display_name = display_name
+        self.global_name = display_name
+        self.roles = roles
+        self.bot = False
+        self.mention = f"<@{member_id}>"
+
+    async def send(self, content=None, **kwargs):
+        pass
+
+class FakeGuild:
+    def __init__(self, guild_id, members):
+        self.id = guild_id
+        self.members = members
+        self._by_id = {m.id: m for m in members}
+
+    def get_member(self, member_id):
+        return self._by_id.get(member_id)
+
+class FakeMessage:
+    async def edit(self, **kwargs):
+        pass
+
+class FakeResponse:
+    def __init__(self):
+        self.sent = []
+        self._done = False
+
+    def is_done(self):
+        return self._done
+
+    async def send_message(self, content=None, **kwargs):
+        self._done = True
+        self.sent.append((content, kwargs))
+
+    async def defer(self, **kwargs):
+        self._done = True
+
+    async def edit_message(self, **kwargs):
+        self._done = True
+        self.sent.append((None, kwargs))
+
+class FakeFollowup:
+    def __init__(self):
+        self.sent = []
+
+    async def send(self, content=None, **kwargs):
+        self.sent.append((content, kwargs))
+        return FakeMessage()
+
+class FakeInteraction:
+    def __init__(self, user, guild, **namespace):
+        self.user = user
+        self.guild = guild
+        self.guild_id = guild.id
+        self.response = FakeResponse()
+        self.followup = FakeFollowup()
+        self.namespace = SimpleNamespace(**namespace)
+
+# --- データの用意 ---
+def seed(store, rng):
+    """ユーザー・ショップ・商品・所持アイテム・宝くじを作る（数えない方の Storage に直接書く）"""
+    user_ids = list(range(1, USERS + 1))
+    for i in range(0, USERS, bot.BATCH_LIMIT - 1):
+        chunk = user_ids[i:i + bot.BATCH_LIMIT - 1]
+        store.commit_rewards([(uid, rng.randint(1, 1_000_000)) for uid in chunk])
+
+    shops = [f"ショップ{i:02d}" for i in range(SHOPS)]
+    for shop_name in shops:
+        store.create_shop(shop_name)
+        for j in range(PRODUCTS_PER_SHOP):
+            store.set_product(shop_name, f"商品{j:03d}", {
+                "description": f"{shop_name}の商品{j}", "price": rng.randint(1, 500),
+                "stock": 0, "buy_role": None,
+            })
+
+    for j in range(INVENTORY_ITEMS):
+        store.add_user_item(1, shops[j % SHOPS], f"商品{j:03d}", rng.randint(1, 5))
+
+    counts = [1, 10, 100, 1000, LOTTERY_TICKETS // 100, LOTTERY_TICKETS // 10]
+    store.set_lottery(
+        "ジャンボ",
+        {"price": 1, "end_date": "20991231", "total": LOTTERY_TICKETS,
+         **{f"prize{g}": p for g, p in zip(range(1, 7), (1_000_000, 100_000, 10_000, 1000, 100, 10))}},
+        split_inventory(LOTTERY_TICKETS, counts, bot.LOTTERY_SHARDS, rng),
+    )
+    return shops
+
+def make_guild(rng):
+    role = FakeRole(VERIFIED_ROLE_ID, "認証済み")
+    syllables = ["ra", "ru", "in", "ka", "mi", "to", "shi", "ne", "ko", "yu", "さ", "く", "ら", "ね", "こ"]
+    members = [
+        FakeMember(uid, "".join(rng.choice(syllables) for _ in range(rng.randint(2, 6))) + str(uid % 97), [role])
+        for uid in range(1, USERS + 1)
+    ]
+    role.members = members
+    return FakeGuild(1, members), role
+
+# --- ケース ---
+def build_cases(guild, shops, rng):
+    """(名前, async 関数) の一覧。関数は引数なしで1回分の処理をする"""
+    me = guild.get_member(1)
+    other = guild.get_member(2)
+    shop_name = shops[0]
+    lottery_setting = {"remaining": LOTTERY_TICKETS, "count1": 1, "count2": 10, "count3": 100,
+                       "count4": 1000, "count5": LOTTERY_TICKETS // 100, "count6": LOTTERY_TICKETS // 10,
+                       **{f"prize{g}": 10 ** (7 - g) for g in range(1, 7)}}
+    login_users = iter(range(USERS + 1, USERS * 100))
+
+    def inter(user=me, **namespace):
+        return FakeInteraction(user, guild, **namespace)
+
+    async def lottery_draw():
+        draw_unit_lottery(lottery_setting, 100, rng)
+
+    async def autocomplete_user():
+        await bot.user_autocomplete(inter(), "ra")
+
+    async def autocomplete_shop():
+        await bot.shop_autocomplete(inter(), "ショップ")
+
+    async def autocomplete_product():
+        await bot.product_autocomplete(inter(shop_name=shop_name), "商品0")
+
+    async def autocomplete_myitem():
+        await bot.myitem_key_autocomplete(inter(), "商品")
+
+    board = bot.leaderboards["balance"]
+
+    async def ranking_embed():
+        await board.refresh_if_stale()
+        view = bot.RankingPagination(board, guild)
+        view.create_embed(await view.get_page(0))
+        view.stop()
+
+    async def item_list():
+        await bot.send_item_list(inter(), me.id, 2)
+
+    async def cmd_balance():
+        await bot.balance_cmd.callback(inter())
+
+    async def cmd_ranking():
+        await bot.ranking_cmd.callback(inter(), "balance")
+
+    async def cmd_ranking_deep():
+        # 上位 N 人より下のページ（カーソルで続きを読む）
+        view = bot.RankingPagination(board, guild)
+        page = board.size // bot.RANKING_PAGE_SIZE
+        for p in range(page, page + 3):
+            await view.get_page(p)
+        view.stop()
+
+    async def cmd_shop_list():
+        await bot.shop_list_cmd.callback(inter(), 1)
+
+    async def cmd_shop_detail():
+        await bot.shop_detail_cmd.callback(inter(), shop_name, 3)
+
+    async def cmd_buy():
+        await bot.buy_cmd.callback(inter(), shop_name, "商品001")
+
+    async def cmd_item_list():
+        await bot.item_list_cmd.callback(inter(), 1)
+
+    async def cmd_transfer():
+        await bot.transfer_cmd.callback(inter(), other, 1)
+
+    async def cmd_login():
+        user = FakeMember(next(login_users), "login", me.roles)
+        await bot.login_bonus_cmd.callback(inter(user))
+
+    async def cmd_lottery():
+        await bot.lottery_buy.callback(inter(), "ジャンボ", 10)
+
+    return [
+        ("抽選 draw_unit_lottery（100万枚から100枚）", lottery_draw),
+        ("オートコンプリート ユーザー（1万人）", autocomplete_user),
+        ("オートコンプリート ショップ", autocomplete_shop),
+        ("オートコンプリート 商品", autocomplete_product),
+        ("オートコンプリート 所持アイテム", autocomplete_myitem),
+        ("RankingPagination.create_embed", ranking_embed),
+        ("send_item_list", item_list),
+        ("/残高", cmd_balance),
+        ("/ランキング", cmd_ranking),
+        ("/ランキング 上位N人より下の3ページ", cmd_ranking_deep),
+        ("/ショップ一覧", cmd_shop_list),
+        ("/ショップ", cmd_shop_detail),
+        ("/買う", cmd_buy),
+        ("/アイテム表示", cmd_item_list),
+        ("/渡す", cmd_transfer),
+        ("/ログイン（毎回新しいユーザー）", cmd_login),
+        ("/宝くじ（10枚）", cmd_lottery),
+    ]
+
+# --- 計測 ---
+ROUNDS = 5
+
+async def measure(func, counter, repeat):
+    await func()  # キャッシュを温める
+    tracemalloc.start()
+    tracemalloc.reset_peak()
+    before, _ = tracemalloc.get_traced_memory()
+    await func()
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+
+    # 時間は ROUNDS 回計った中で一番速い回（他の処理に割り込まれた回を除くため）
+    calls = counter.calls
+    best = float("inf")
+    for _ in range(ROUNDS):
+        started = time.perf_counter()
+        for _ in range(repeat):
+            await func()
+        best = min(best, (time.perf_counter() - started) / repeat)
+    return {
+        "ms": best * 1000,
+        "peak_kb": max(0, peak - before) / 1024,
+        "round_trips": (counter.calls - calls) / (repeat * ROUNDS),
+    }
+
+async def run(args):
+    rng = random.Random(args.seed)
+    inner = bot.store
+    print(f"データ作成中（ユーザー{USERS:,}人・商品{SHOPS * PRODUCTS_PER_SHOP}件・宝くじ{LOTTERY_TICKETS:,}枚）...")
+    started = time.perf_counter()
+    shops = seed(inner, rng)
+    guild, _ = make_guild(rng)
+    print(f"  {time.perf_counter() - started:.1f}秒")
+
+    counter = bot.store = CountingStorage(inner)
+    await bot.catalog.start()
+
+    results = {}
+    print(f"{'ケース':<40} {'時間':>10} {'ピークメモリ':>12} {'往復':>6}")
+    for name, func in build_cases(guild, shops, rng):
+        if args.k and args.k not in name:
+            continue
+        r = await measure(func, counter, args.repeat)
+        results[name] = r
+        print(f"{name:<40} {r['ms']:>8.3f}ms {r['peak_kb']:>10.1f}KB {r['round_trips']:>6.1f}")
+    bot.catalog.stop_listeners()
+    return results
+
+# --- ベースライン ---
+def baseline_path(name):
+    return os.path.join(BASELINE_DIR, f"{name}.json")
+
+def save_baseline(name, results, args):
+    os.makedirs(BASELINE_DIR, exist_ok=True)
+    data = {
+        "meta": {
+            "python": platform.python_version(), "machine": platform.machine(),
+            "repeat": args.repeat, "seed": args.seed, "saved_at": time.strftime("%Y-%m-%d %H:%M:%S"),
+        },
+        "results": results,
+    }
+    with open(baseline_path(name), "w", encoding="utf-8") as f:
+        json.dump(data, f, ensure_ascii=False, indent=2)
+    print(f"保存しました: {baseline_path(name)}")
+
+def compare_baseline(name, results, threshold):
+    """保存した結果と比べて表示し、悪化したケースがなければ True"""
+    with open(baseline_path(name), encoding="utf-8") as f:
+        base = json.load(f)["results"]
+    ok = True
+    print(f"== {name} との比較（時間が {threshold:.0%} 超遅い・往復が増えたものを悪化とする） ==")
+    for case, r in results.items():
+        old = base.get(case)
+        if old is None:
+            print(f"  {case}: 比較対象なし")
+            continue
+        ratio = r["ms"] / old["ms"] if old["ms"] else 1.0
+        worse = ratio > 1 + threshold or r["round_trips"] > old["round_trips"] + 1e-9
+        ok &= not worse
+        print(
+            f"  {case}: {old['ms']:.3f}ms → {r['ms']:.3f}ms (x{ratio:.2f})"
+            f" / 往復 {old['round_trips']:.1f} → {r['round_trips']:.1f} {'NG' if worse else 'OK'}"
+        )
+    return ok
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("-k", help="名前にこの文字列を含むケースだけ実行する")
+    parser.add_argument("--repeat", type=int, default=50)
+    parser.add_argument("--seed", type=int, default=20240101)
+    parser.add_argument("--save", metavar="NAME", help="結果をベースラインとして保存する")
+    parser.add_argument("--compare", metavar="NAME", help="保存したベースラインと比べる")
+    parser.add_argument("--threshold", type=float, default=0.5, help="悪化とみなす時間の増加率")
+    args = parser.parse_args()
+
+    results = asyncio.run(run(args))
+    ok = True
+    if args.compare:
+        ok = compare_baseline(args.compare, results, args.threshold)
+    if args.save:
+        save_baseline(args.save, results, args)
+    bot.db_executor.shutdown(wait=True)
+    sys.exit(0 if ok else 1)
+
+if __name__ == "__main__":
+    main()
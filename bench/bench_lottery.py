@@ -0,0 +1,228 @@
+"""
+宝くじ抽選のベンチマークと統計チェック
+
+  python bench/bench_lottery.py            # 統計チェック + ベンチマーク
+  python bench/bench_lottery.py --check    # 統計チェックのみ（失敗時は終了コード1）
+  python bench/bench_lottery.py --bench    # ベンチマークのみ
+
+旧実装（くじ箱をリストに展開して random.sample）と lottery.draw_unit_lottery を比べる。
+統計チェックは、各等級の当選本数の分布が厳密な超幾何分布と一致するかをカイ二乗で、
+等級間の共分散が理論値と一致するかを z 値で確認する。
+あわせて、シャードに分けた宝くじを SQLite で買った時に当選金が残高に入るかを確かめる。
+"""
+import argparse
+import math
+import os
+import random
+import sys
+import tempfile
+import time
+import tracemalloc
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from lottery import GRADES, draw_unit_lottery, hypergeometric, split_inventory  # noqa: E402
+from storage import RESET_FIELDS, SQLiteStorage  # noqa: E402
+
+def legacy_draw_unit_lottery(setting, count, rng=random):
+    """変更前の実装（比較用）"""
+    results = {1:0, 2:0, 3:0, 4:0, 5:0, 6:0, "lose":0}
+    reward = 0
+    pool = []
+    for grade in range(1, 7):
+        pool.extend([grade] * setting.get(f"count{grade}", 0))
+    loses = max(0, setting.get("remaining", 0) - len(pool))
+    pool.extend(["lose"] * loses)
+    for res in rng.sample(pool, min(count, len(pool))):
+        results[res] += 1
+        if res != "lose":
+            reward += setting.get(f"prize{res}", 0)
+    return results, reward
+
+def make_setting(total, counts, prizes=(100000, 10000, 1000, 500, 100, 10)):
+    setting = {"remaining": total}
+    for grade, c, p in zip(GRADES, counts, prizes):
+        setting[f"count{grade}"] = c
+        setting[f"prize{grade}"] = p
+    return setting
+
+# --- 統計チェック ---
+def hypergeom_pmf(ngood, nbad, nsample):
+    total = math.comb(ngood + nbad, nsample)
+    lo, hi = max(0, nsample - nbad), min(nsample, ngood)
+    return {x: math.comb(ngood, x) * math.comb(nbad, nsample - x) / total for x in range(lo, hi + 1)}
+
+def chi_square_z(observed, pmf, trials):
+    """期待度数5未満の階級をまとめてカイ二乗を計算し、Wilson-Hilferty 近似の z 値を返す"""
+    bins, obs, exp = [], 0, 0.0
+    for x in sorted(pmf):
+        obs += observed.get(x, 0)
+        exp += pmf[x] * trials
+        if exp >= 5:
+            bins.append((obs, exp))
+            obs, exp = 0, 0.0
+    if exp > 0:
+        if bins:
+            o, e = bins.pop()
+            bins.append((o + obs, e + exp))
+        else:
+            bins.append((obs, exp))
+    k = len(bins) - 1
+    if k < 1:
+        return 0.0
+    chi2 = sum((o - e) ** 2 / e for o, e in bins)
+    return ((chi2 / k) ** (1 / 3) - (1 - 2 / (9 * k))) / math.sqrt(2 / (9 * k))
+
+def check_univariate(rng, trials):
+    ok = True
+    cases = [(5, 95, 10), (30, 70, 50), (60, 40, 80), (1, 999, 500), (400, 600, 999), (2000, 1000000, 5000)]
+    for ngood, nbad, nsample in cases:
+        observed = {}
+        for _ in range(trials):
+            x = hypergeometric(ngood, nbad, nsample, rng)
+            observed[x] = observed.get(x, 0) + 1
+        if ngood + nbad <= 5000:
+            pmf = hypergeom_pmf(ngood, nbad, nsample)
+        else:
+            # 大きい箱は正規近似の代わりに平均・分散で確認
+            pmf = None
+        if pmf is not None:
+            z = chi_square_z(observed, pmf, trials)
+        else:
+            total = ngood + nbad
+            mean = nsample * ngood / total
+            var = mean * (nbad / total) * (total - nsample) / (total - 1)
+            sample_mean = sum(x * c for x, c in observed.items()) / trials
+            z = abs(sample_mean - mean) / math.sqrt(var / trials)
+        passed = z < 4
+        ok &= passed
+        print(f"  hypergeometric({ngood}, {nbad}, {nsample}): z={z:+.2f} {'OK' if passed else 'NG'}")
+    return ok
+
+def check_multivariate(impl, name, rng, trials):
+    counts = [2, 5, 10, 20, 0, 40]
+    total = 200
+    nsample = 25
+    setting = make_setting(total, counts)
+    classes = list(GRADES) + ["lose"]
+    class_counts = counts + [total - sum(counts)]
+    observed = {c: {} for c in classes}
+    sum_a = sum_b = sum_ab = 0
+    rewards = 0
+    for _ in range(trials):
+        results, reward = impl(setting, nsample, rng)
+        rewards += reward
+        for c in classes:
+            observed[c][results[c]] = observed[c].get(results[c], 0) + 1
+        a, b = results[3], results["lose"]
+        sum_a += a
+        sum_b += b
+        sum_ab += a * b
+    ok = True
+    for c, k in zip(classes, class_counts):
+        if k == 0:
+            passed = observed[c] == {0: trials}
+            z = 0.0
+        else:
+            z = chi_square_z(observed[c], hypergeom_pmf(k, total - k, nsample), trials)
+            passed = z < 4
+        ok &= passed
+        label = "はずれ" if c == "lose" else f"{c}等"
+        print(f"  [{name}] {label}の本数: z={z:+.2f} {'OK' if passed else 'NG'}")
+
+    # 等級間の共分散（3等とはずれ）
+    ka, kb = class_counts[2], class_counts[-1]
+    cov = -nsample * (ka / total) * (kb / total) * (total - nsample) / (total - 1)
+    sample_cov = sum_ab / trials - (sum_a / trials) * (sum_b / trials)
+    # 共分散の推定誤差は概算で sqrt(Var(a)Var(b)/trials) 程度
+    var_a = nsample * (ka / total) * (1 - ka / total) * (total - nsample) / (total - 1)
+    var_b = nsample * (kb / total) * (1 - kb / total) * (total - nsample) / (total - 1)
+    z = (sample_cov - cov) / math.sqrt((var_a * var_b + cov ** 2) / trials)
+    passed = abs(z) < 4
+    ok &= passed
+    print(f"  [{name}] 3等とはずれの共分散: 理論 {cov:.4f} / 実測 {sample_cov:.4f} z={z:+.2f} {'OK' if passed else 'NG'}")
+
+    expected_reward = nsample * sum(k * setting[f"prize{g}"] for g, k in zip(GRADES, counts)) / total
+    print(f"  [{name}] 平均当選金: 理論 {expected_reward:.1f} / 実測 {rewards / trials:.1f}")
+    return ok
+
+def run_checks(seed, trials):
+    rng = random.Random(seed)
+    print(f"== 統計チェック (seed={seed}, trials={trials}) ==")
+    ok = check_univariate(rng, trials)
+    ok &= check_multivariate(draw_unit_lottery, "新", rng, trials)
+    ok &= check_multivariate(legacy_draw_unit_lottery, "旧", rng, trials)
+    # 境界ケース
+    edge_ok = True
+    results, _ = draw_unit_lottery(make_setting(10, [1, 2, 3, 0, 0, 0]), 50, rng)
+    edge_ok &= results == {1: 1, 2: 2, 3: 3, 4: 0, 5: 0, 6: 0, "lose": 4}
+    results, reward = draw_unit_lottery(make_setting(0, [0] * 6), 5, rng)
+    edge_ok &= sum(results.values()) == 0 and reward == 0
+    results, _ = draw_unit_lottery(make_setting(3, [5, 0, 0, 0, 0, 0]), 2, rng)
+    edge_ok &= results[1] == 2 and results["lose"] == 0
+    print(f"  境界ケース: {'OK' if edge_ok else 'NG'}")
+    return ok and edge_ok and check_sharded_payout(rng)
+
+def check_sharded_payout(rng):
+    """全部1等のくじをシャードに分けて買い、当選金が残高に入るか（シャードが親の当選金を使えているか）"""
+    price, prize, shards = 10, 100, 4
+    with tempfile.TemporaryDirectory(prefix="raruin-lottery-") as tmpdir:
+        store = SQLiteStorage(os.path.join(tmpdir, "lottery.db"))
+        setting = make_setting(shards, [shards, 0, 0, 0, 0, 0], prizes=(prize, 0, 0, 0, 0, 0)) | {"price": price}
+        store.set_lottery("check", setting, split_inventory(shards, [shards, 0, 0, 0, 0, 0], shards, rng))
+        total_reward = 0
+        for i in range(shards):
+            _, _, reward = store.buy_from_lottery_shard("check", i, 1, price, 1)
+            total_reward += reward
+        balance, earned, spent = store.get_user_balance(1)
+        store.close()
+    expected = RESET_FIELDS["balance"] + shards * (prize - price)
+    passed = total_reward == shards * prize and balance == expected and earned == shards * prize
+    print(f"  シャードの当選金: 当選金 {total_reward} / 残高 {balance}（期待 {expected}） {'OK' if passed else 'NG'}")
+    return passed
+
+# --- ベンチマーク ---
+def measure(func, setting, count, repeat):
+    tracemalloc.start()
+    func(setting, count)
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    started = time.perf_counter()
+    for _ in range(repeat):
+        func(setting, count)
+    return (time.perf_counter() - started) / repeat, peak
+
+def run_bench(repeat):
+    print("== ベンチマーク（1回あたり） ==")
+    print(f"{'総枚数':>10} {'購入':>7} | {'旧: 時間':>12} {'旧: ピークメモリ':>16} | {'新: 時間':>12} {'新: ピークメモリ':>16}")
+    for total in (10_000, 1_000_000, 10_000_000):
+        counts = [1, 10, 100, 1000, total // 100, total // 10]
+        setting = make_setting(total, counts)
+        for count in (1, 100, 10_000):
+            legacy_repeat = max(1, repeat // (total // 10_000))
+            old_t, old_m = measure(legacy_draw_unit_lottery, setting, count, legacy_repeat)
+            new_t, new_m = measure(draw_unit_lottery, setting, count, repeat)
+            print(
+                f"{total:>10,} {count:>7,} | {old_t * 1000:>10.3f}ms {old_m / 1024 / 1024:>14.1f}MB"
+                f" | {new_t * 1000:>10.3f}ms {new_m / 1024:>14.1f}KB"
+            )
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--check", action="store_true", help="統計チェックのみ")
+    parser.add_argument("--bench", action="store_true", help="ベンチマークのみ")
+    parser.add_argument("--seed", type=int, default=20240101)
+    parser.add_argument("--trials", type=int, default=20000)
+    parser.add_argument("--repeat", type=int, default=20)
+    args = parser.parse_args()
+    both = not args.check and not args.bench
+
+    ok = True
+    if args.check or both:
+        ok = run_checks(args.seed, args.trials)
+    if args.bench or both:
+        run_bench(args.repeat)
+    sys.exit(0 if ok else 1)
+
+if __name__ == "__main__":
+    main()
@@ -5,14 +5,26 @@ from discord.ext import commands
 from dotenv import load_dotenv
 from datetime import datetime
 import json
-from flask import Flask
 import threading
-from google.cloud import firestore
-from google.cloud.firestore_v1 import Transaction
-from typing import Union, List
+from typing import Union
 import random
 from datetime import date
 import asyncio
+import bisect
+import heapq
+import functools
+import signal
+import time
+import traceback
+import sys
+import io
+import hashlib
+from collections import Counter, OrderedDict, deque
+from http.server import HTTPServer, BaseHTTPRequestHandler
+from concurrent.futures import ThreadPoolExecutor
+from lottery import split_inventory
+from storage import BATCH_LIMIT, RESET_FIELDS, open_storage, user_totals
+from metrics import REGISTRY
 
 # === 環境設定 ===
 load_dotenv()
@@ -47,42 +59,694 @@ else:
 print(f"Final Credentials Path: {os.environ['GOOGLE_APPLICATION_CREDENTIALS']}")
 CURRENCY_NAME = "Raruin"
 
-# === Firestore ===
-db = firestore.Client()
-
-def user_doc(user_id):
-    return db.collection("users").document(str(user_id))
-def shop_doc(shop_name):
-    return db.collection("shops").document(shop_name)
-def product_doc(shop_name, product_name):
-    return shop_doc(shop_name).collection("products").document(product_name)
-def user_item_doc(user_id, shop_name, product_name):
-    return user_doc(user_id).collection("items").document(f"{shop_name}:{product_name}")
+# === データの保存先 ===
+# 読み書きはすべて storage.py の Storage を通す（STORAGE_BACKEND=firestore / sqlite）
+store = open_storage()
+print(f"Storage backend: {store.name}")
+
 def is_admin(user):
     return user.id in ADMIN_IDS
 
-def get_user_balance(user_id):
-    doc = user_doc(user_id).get()
-    if doc.exists:
-        val = doc.to_dict()
-        return int(val.get("balance",1000)), int(val.get("earned",0)), int(val.get("spent",0))
-    else:
-        user_doc(user_id).set({"balance":1000, "earned":0, "spent":0})
-        return 1000,0,0
-def change_balance(user_id, amount, is_add=True):
-    doc = user_doc(user_id)
-    if is_add:
-        doc.set({
-            "balance":firestore.Increment(amount),
-            "earned":firestore.Increment(amount)
-        }, merge=True)
+# === 非同期アクセス層 ===
+# Storage のメソッドは同期APIなので、イベントループ上で直接呼ぶと Bot 全体が止まる。
+# すべてスレッドプール上で実行し、コマンド側は await run_db(store.xxx, ...) で呼ぶ。
+DB_MAX_WORKERS = int(os.getenv("DB_MAX_WORKERS") or 16)
+db_executor = ThreadPoolExecutor(max_workers=DB_MAX_WORKERS, thread_name_prefix="storage")
+
+async def run_db(func, *args, **kwargs):
+    """同期の読み書きをスレッドプールで実行して結果を待つ"""
+    loop = asyncio.get_running_loop()
+    return await loop.run_in_executor(db_executor, functools.partial(timed_storage_call, func, *args, **kwargs))
+
+# === メトリクス（/metrics） ===
+# 保存先への呼び出しは run_db を必ず通るので、ここで回数・時間・エラーを数える。
+# 種類は名前で分ける: list_ / load / recount_ は複数件の読み込み（stream）、get_ は1件の読み込み、それ以外は書き込み
+storage_calls = REGISTRY.counter(
+    "raruin_storage_calls_total", "保存先（Firestore / SQLite）への呼び出し回数", ("call", "kind"))
+storage_errors = REGISTRY.counter(
+    "raruin_storage_errors_total", "保存先への呼び出しで出た例外の数", ("call", "error"))
+storage_seconds = REGISTRY.histogram(
+    "raruin_storage_call_seconds", "保存先への1回の呼び出しにかかった時間（スレッド内）", ("kind",))
+
+def storage_call_name(func):
+    func = getattr(func, "func", func)  # functools.partial
+    return getattr(func, "__qualname__", None) or getattr(func, "__name__", "unknown")
+
+def storage_call_kind(name):
+    method = name.rsplit(".", 1)[-1]
+    if method.startswith(("list_", "load", "recount_")):
+        return "stream"
+    if method.startswith(("get_", "cached_")):
+        return "read"
+    return "write"
+
+def timed_storage_call(func, *args, **kwargs):
+    name = storage_call_name(func)
+    kind = storage_call_kind(name)
+    started = time.perf_counter()
+    try:
+        return func(*args, **kwargs)
+    except Exception as e:
+        storage_errors.inc(call=name, error=type(e).__name__)
+        raise
+    finally:
+        storage_calls.inc(call=name, kind=kind)
+        storage_seconds.observe(time.perf_counter() - started, kind=kind)
+
+# === ショップ・商品カタログのキャッシュ ===
+# オートコンプリートや一覧表示のたびに shops / products を読み直さないよう、
+# プロセス全体で1つのカタログをメモリに持ち、on_snapshot で最新に保つ。
+# リスナーが使えない環境でも、管理コマンドでの書き込み時にその場で更新する。
+CATALOG_RELOAD_SECONDS = float(os.getenv("CATALOG_RELOAD_SECONDS") or 300)
+
+def insert_sorted(keys, key):
+    i = bisect.bisect_left(keys, key)
+    if i == len(keys) or keys[i] != key:
+        keys.insert(i, key)
+
+def remove_sorted(keys, key):
+    i = bisect.bisect_left(keys, key)
+    if i < len(keys) and keys[i] == key:
+        del keys[i]
+
+class CatalogCache:
+    def __init__(self):
+        self.shop_set = set()
+        self.shop_keys = []         # ショップ名のソート済みリスト（ページ送り用）
+        self.products_by_shop = {}  # shop_name -> {product_name: data}
+        self.product_keys = {}      # shop_name -> 商品名のソート済みリスト
+        self.loaded_at = 0.0
+        self.reads = 0
+        self._lock = threading.Lock()
+        self._load_lock = asyncio.Lock()
+        self._watches = []
+
+    @property
+    def listening(self):
+        return bool(self._watches)
+
+    def load(self):
+        """保存先から全件読み込んで置き換える"""
+        shops = store.list_shop_names()
+        products = {}
+        for shop_name, product_name, data in store.list_all_products():
+            products.setdefault(shop_name, {})[product_name] = data
+        with self._lock:
+            self.shop_set = set(shops)
+            self.shop_keys = sorted(self.shop_set)
+            self.products_by_shop = products
+            self.product_keys = {shop_name: sorted(prods) for shop_name, prods in products.items()}
+            self.loaded_at = time.monotonic()
+            self.reads += 1
+
+    def start_listeners(self):
+        self._watches = store.watch_catalog(self._on_shop, self._on_product)
+
+    def stop_listeners(self):
+        for watch in self._watches:
+            try: watch.unsubscribe()
+            except Exception: pass
+        self._watches = []
+
+    def _on_shop(self, shop_name, removed):
+        with self._lock:
+            if removed:
+                self.shop_set.discard(shop_name)
+                remove_sorted(self.shop_keys, shop_name)
+            else:
+                self.shop_set.add(shop_name)
+                insert_sorted(self.shop_keys, shop_name)
+
+    def _on_product(self, shop_name, product_name, data):
+        with self._lock:
+            if data is None:
+                self.products_by_shop.get(shop_name, {}).pop(product_name, None)
+                remove_sorted(self.product_keys.get(shop_name, []), product_name)
+            else:
+                self.products_by_shop.setdefault(shop_name, {})[product_name] = data
+                insert_sorted(self.product_keys.setdefault(shop_name, []), product_name)
+
+    async def ensure_loaded(self):
+        # リスナーが動いていれば常に最新。動いていない時だけ一定時間ごとに読み直す
+        if self.loaded_at and (self.listening or time.monotonic() - self.loaded_at < CATALOG_RELOAD_SECONDS):
+            return
+        async with self._load_lock:
+            if self.loaded_at and (self.listening or time.monotonic() - self.loaded_at < CATALOG_RELOAD_SECONDS):
+                return
+            await run_db(self.load)
+
+    async def start(self):
+        try:
+            await run_db(self.load)
+            await run_db(self.start_listeners)
+        except Exception as e:
+            print(f"カタログのリスナー開始に失敗（書き込み時の更新のみで運用）: {e}")
+
+    # --- 読み取り（メモリから） ---
+    async def shop_names(self):
+        await self.ensure_loaded()
+        with self._lock:
+            return list(self.shop_keys)
+
+    async def shop_page(self, offset, limit):
+        """ショップ名順に offset 件目から limit 件と、全件数"""
+        await self.ensure_loaded()
+        with self._lock:
+            return self.shop_keys[offset:offset + limit], len(self.shop_keys)
+
+    async def product_page(self, shop_name, offset, limit):
+        """商品名順に offset 件目から limit 件と、全件数"""
+        await self.ensure_loaded()
+        with self._lock:
+            prods = self.products_by_shop.get(shop_name, {})
+            names = self.product_keys.get(shop_name, [])
+            return [prods[name] | {"product_name": name} for name in names[offset:offset + limit]], len(names)
+
+    async def has_shop(self, shop_name):
+        await self.ensure_loaded()
+        return shop_name in self.shop_set
+
+    async def product(self, shop_name, product_name):
+        """商品のデータ（無ければ None）"""
+        await self.ensure_loaded()
+        with self._lock:
+            return self.products_by_shop.get(shop_name, {}).get(product_name)
+
+    async def products(self, shop_name):
+        await self.ensure_loaded()
+        with self._lock:
+            prods = self.products_by_shop.get(shop_name, {})
+            return [prods[name] | {"product_name": name} for name in self.product_keys.get(shop_name, [])]
+
+    # --- 管理コマンドで書き込んだ時にその場で反映 ---
+    def put_shop(self, shop_name):
+        self._on_shop(shop_name, removed=False)
+
+    def remove_shop(self, shop_name):
+        self._on_shop(shop_name, removed=True)
+
+    def put_product(self, shop_name, product_name, data):
+        self._on_product(shop_name, product_name, dict(data))
+
+    def update_product(self, shop_name, product_name, fields):
+        with self._lock:
+            product = self.products_by_shop.get(shop_name, {}).get(product_name)
+            if product is not None:
+                product.update(fields)
+
+    def remove_product(self, shop_name, product_name):
+        self._on_product(shop_name, product_name, None)
+
+    def stats(self):
+        with self._lock:
+            return {
+                "shops": len(self.shop_set),
+                "products": sum(len(p) for p in self.products_by_shop.values()),
+                "full_loads": self.reads,
+                "listening": self.listening,
+            }
+
+catalog = CatalogCache()
+
+async def shop_exists(shop_name):
+    return await catalog.has_shop(shop_name)
+
+# === 汎用 LRU キャッシュ ===
+class LRUCache:
+    """件数上限（古いものから追い出し）と有効期限つきのキャッシュ"""
+    def __init__(self, maxsize, ttl=None):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.hits = 0
+        self.misses = 0
+        self._data = OrderedDict()  # key -> (期限, 値)
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._data)
+
+    def get(self, key, default=None):
+        with self._lock:
+            entry = self._data.get(key)
+            if entry is None or (entry[0] is not None and entry[0] < time.monotonic()):
+                if entry is not None:
+                    del self._data[key]
+                self.misses += 1
+                return default
+            self._data.move_to_end(key)
+            self.hits += 1
+            return entry[1]
+
+    def set(self, key, value):
+        expires = time.monotonic() + self.ttl if self.ttl else None
+        with self._lock:
+            self._data[key] = (expires, value)
+            self._data.move_to_end(key)
+            while len(self._data) > self.maxsize:
+                self._data.popitem(last=False)
+
+    def update(self, key, func):
+        """キャッシュにある時だけ値を func(値) に置き換える（期限と並び順はそのまま）"""
+        with self._lock:
+            entry = self._data.get(key)
+            if entry is not None:
+                self._data[key] = (entry[0], func(entry[1]))
+
+    def pop(self, key, default=None):
+        with self._lock:
+            entry = self._data.pop(key, None)
+        return default if entry is None else entry[1]
+
+    def clear(self):
+        with self._lock:
+            self._data.clear()
+
+    def stats(self):
+        return {"size": len(self._data), "hits": self.hits, "misses": self.misses}
+
+# === 所持アイテムのキャッシュ ===
+# ユーザーごとに items サブコレクションを丸ごと持っておき、
+# 購入・譲渡ではその場で書き換える（オートコンプリートのたびに読み直さない）。
+# 他のプロセスの書き込みは、SQLite の change_log の通知でその人の分を捨てて追従する（無い時は TTL まで）
+INVENTORY_CACHE_SIZE = int(os.getenv("INVENTORY_CACHE_SIZE") or 1000)
+INVENTORY_CACHE_TTL = float(os.getenv("INVENTORY_CACHE_TTL") or 300)
+inventory_cache = LRUCache(INVENTORY_CACHE_SIZE, INVENTORY_CACHE_TTL)
+inventory_watches = []
+inventory_generation = 0  # 変更通知のたびに増やす（読み込み中に変わった所持アイテムを入れないため）
+inventory_lock = threading.Lock()
+
+def on_inventory_changed(user_id):
+    # 変更ログの監視スレッドから呼ばれる
+    global inventory_generation
+    with inventory_lock:
+        inventory_generation += 1
+    inventory_cache.pop(user_id)
+
+async def start_inventory_listeners():
+    global inventory_watches
+    try:
+        inventory_watches = await run_db(store.watch_items, on_inventory_changed)
+    except Exception as e:
+        print(f"所持アイテムのリスナー開始に失敗（TTL で追従）: {e}")
+
+def stop_inventory_listeners():
+    global inventory_watches
+    for watch in inventory_watches:
+        try: watch.unsubscribe()
+        except Exception: pass
+    inventory_watches = []
+
+def make_inventory_item(shop_name, product_name, amount):
+    display = f"{product_name}（{shop_name}）"
+    return {
+        "shop_name": shop_name, "product_name": product_name, "amount": amount,
+        "display": display, "search": display.lower(),
+    }
+
+class Inventory(dict):
+    """{"shop:product": アイテム} と、一覧のページ送り用にキーのソート済みリストを持つ"""
+    def __init__(self, items=()):
+        super().__init__(items)
+        self.sorted_keys = sorted(self)
+
+    def put(self, key, item):
+        if key not in self:
+            insert_sorted(self.sorted_keys, key)
+        self[key] = item
+
+    def remove(self, key):
+        if self.pop(key, None) is not None:
+            remove_sorted(self.sorted_keys, key)
+
+    def page(self, offset, limit):
+        """キー順に offset 件目から limit 件のアイテム"""
+        return [self[key] for key in self.sorted_keys[offset:offset + limit]]
+
+async def get_inventory(user_id):
+    """Inventory を返す（キャッシュになければ1回だけ読む）"""
+    items = inventory_cache.get(user_id)
+    if items is None:
+        generation = inventory_generation
+        items = Inventory(
+            (f"{itm['shop_name']}:{itm['product_name']}",
+             make_inventory_item(itm["shop_name"], itm["product_name"], itm.get("amount", 0)))
+            for itm in await run_db(store.list_user_items, user_id)
+        )
+        if generation == inventory_generation:
+            inventory_cache.set(user_id, items)
+    return items
+
+def update_inventory(user_id, shop_name, product_name, delta):
+    """キャッシュ済みの所持数を増減する（キャッシュにない人は次回読み込み時に反映される）"""
+    items = inventory_cache.get(user_id)
+    if items is None:
+        return
+    key = f"{shop_name}:{product_name}"
+    amount = items[key]["amount"] + delta if key in items else delta
+    if amount > 0:
+        items.put(key, make_inventory_item(shop_name, product_name, amount))
     else:
-        doc.set({
-            "balance":firestore.Increment(-amount),
-            "spent":firestore.Increment(amount)
-        }, merge=True)
-def shop_exists(shop_name):
-    return shop_doc(shop_name).get().exists
+        items.remove(key)
+
+def update_inventories(user_ids, shop_name, product_name, delta):
+    """update_inventory を複数人に（一括配布の後に）"""
+    for user_id in user_ids:
+        update_inventory(user_id, shop_name, product_name, delta)
+
+# === 残高のキャッシュ ===
+# users/{id} のデータ（balance / earned / spent / last_login）を件数上限つきで持ち、/残高 などの表示はメモリから返す。
+# キャッシュにない人だけ1回読んで入れる（read-through）。
+# ・このプロセスの書き込み: コミットの後にその場で加算・置き換え
+# ・他からの書き込み（コンソールでの修正・別プロセス）: 変更通知でその人だけ捨てる（値は次に読む時に取り直す）
+#   SQLite を複数プロセスで共有する時は変更ログで全員分の通知が届く。
+#   Firestore では最近読んだ BALANCE_WATCH_SIZE 人だけ users/{id} を on_snapshot で監視する。
+#   users 全体への on_snapshot は開始・再接続のたびに全員分を読み、全員分をメモリに持つので使わない。
+#   1件ずつの監視も Python のクライアントでは1つごとに接続とスレッドを持つので、キャッシュ全員分ではなく人数を絞る。
+#   監視していない人・通知の無い構成では TTL で読み直す。
+# 通知は捨てるだけなので、自分の書き込みの通知が届いても二重に足すことはない。
+# 支払いに使う残高はキャッシュを信用せず、保存先のトランザクションの中で確かめる。
+BALANCE_CACHE_SIZE = int(os.getenv("BALANCE_CACHE_SIZE") or 5000)
+BALANCE_CACHE_TTL = float(os.getenv("BALANCE_CACHE_TTL") or 60)  # 通知の届かない書き込みが表示に出るまでの最大の遅れ
+BALANCE_WATCH_SIZE = int(os.getenv("BALANCE_WATCH_SIZE") or 100)  # Firestore で1件ずつ監視する人数の上限
+
+class BalanceCache:
+    def __init__(self, maxsize, ttl):
+        self.cache = LRUCache(maxsize, ttl)
+        self.generation = 0  # 書き込み・変更通知のたびに増やす（読み込み中に変わった値を入れないため）
+        self._lock = threading.Lock()
+        self._watches = []
+        self.watch_each = False        # 全員分の通知が無いので、最近読んだ人を1件ずつ監視するか
+        self._doc_watches = OrderedDict()  # user_id -> 監視（古く使われた順）
+
+    @property
+    def listening(self):
+        return bool(self._watches) or self.watch_each
+
+    def start_listeners(self):
+        self._watches = store.watch_users(self._on_user)
+        self.watch_each = not self._watches and store.name == "firestore" and BALANCE_WATCH_SIZE > 0
+
+    def stop_listeners(self):
+        self.watch_each = False
+        with self._lock:
+            watches = self._watches + list(self._doc_watches.values())
+            self._watches = []
+            self._doc_watches.clear()
+        for watch in watches:
+            try: watch.unsubscribe()
+            except Exception: pass
+
+    def _touch(self, user_id):
+        """監視中の人を最近使ったことにする（キャッシュのヒット時）"""
+        with self._lock:
+            if user_id in self._doc_watches:
+                self._doc_watches.move_to_end(user_id)
+
+    def _watch(self, user_id):
+        """users/{id} の監視を始める（スレッドプールで呼ぶ）。BALANCE_WATCH_SIZE 人を超えたら古い人から外す"""
+        with self._lock:
+            if user_id in self._doc_watches:
+                self._doc_watches.move_to_end(user_id)
+                return
+        watch = store.watch_user(user_id, self._on_user)
+        dropped = []
+        with self._lock:
+            if user_id in self._doc_watches or not self.watch_each:
+                dropped.append(watch)  # 同時に始めた・止めた後
+            else:
+                self._doc_watches[user_id] = watch
+            while len(self._doc_watches) > BALANCE_WATCH_SIZE:
+                dropped.append(self._doc_watches.popitem(last=False)[1])
+        for w in dropped:
+            try: w.unsubscribe()
+            except Exception: pass
+
+    async def start(self):
+        try:
+            await run_db(self.start_listeners)
+        except Exception as e:
+            print(f"残高のリスナー開始に失敗（書き込み時の更新のみで運用）: {e}")
+
+    def _bump(self):
+        with self._lock:
+            self.generation += 1
+
+    def _on_user(self, user_id):
+        # リスナーのスレッドから呼ばれる。読み込み中の値も入れないよう世代を進めてから捨てる
+        self._bump()
+        self.cache.pop(user_id)
+
+    # --- 読み取り ---
+    async def get(self, user_id):
+        """ユーザーのデータ（無ければ None）"""
+        data = self.cache.get(user_id)
+        if data is None:
+            generation = self.generation
+            data = await run_db(store.get_user_data, user_id)
+            if data is not None and generation == self.generation:
+                self.cache.set(user_id, data)
+                if self.watch_each:
+                    # 読んでから監視が始まるまでの変更は届かない（その分は TTL で読み直す）
+                    await run_db(self._watch, user_id)
+        elif self.watch_each:
+            self._touch(user_id)
+        return data
+
+    async def balance(self, user_id):
+        """(balance, earned, spent)。まだいないユーザーは初期値で作る"""
+        data = await self.get(user_id)
+        if data is None:
+            # 作った直後の値は入れない（同時に作られた場合の last_login を落とさないよう、次回読み直す）
+            return await run_db(store.get_user_balance, user_id)
+        return user_totals(data)
+
+    # --- このプロセスで書き込んだ後に呼ぶ ---
+    def add(self, user_id, balance=0, earned=0, spent=0, **fields):
+        """残高・統計を加算し、fields（last_login など）を上書きする"""
+        self._bump()
+        def apply(data):
+            return data | fields | {
+                "balance": data.get("balance", 0) + balance,
+                "earned": data.get("earned", 0) + earned,
+                "spent": data.get("spent", 0) + spent,
+            }
+        self.cache.update(user_id, apply)
+
+    def changed(self, user_ids, amount, is_add=True):
+        """change_balance / bulk_change_balance の後に"""
+        for user_id in user_ids:
+            if is_add:
+                self.add(user_id, balance=amount, earned=amount)
+            else:
+                self.add(user_id, balance=-amount, spent=amount)
+
+    def reset(self, user_ids):
+        """reset_user_balance / bulk_reset_balance の後に"""
+        self._bump()
+        for user_id in user_ids:
+            self.cache.update(user_id, lambda data: data | RESET_FIELDS)
+
+    def discard(self, user_id):
+        """削除した時"""
+        self._bump()
+        self.cache.pop(user_id)
+
+    def stats(self):
+        return {**self.cache.stats(), "listening": self.listening, "watched_users": len(self._doc_watches)}
+
+balances = BalanceCache(BALANCE_CACHE_SIZE, BALANCE_CACHE_TTL)
+
+# === 報酬のまとめ書き込み（write-behind） ===
+# チャット報酬は発言ごとに書き込まず、メモリ上でユーザーごとに合算してから
+# 一定間隔 or 一定人数ごとに Increment のバッチとして1回でコミットする
+REWARD_FLUSH_INTERVAL = float(os.getenv("REWARD_FLUSH_INTERVAL") or 30)
+REWARD_FLUSH_MAX_USERS = int(os.getenv("REWARD_FLUSH_MAX_USERS") or 400)
+REWARD_RETRY_MAX_DELAY = 300.0  # 書き込みが失敗し続けた時の再試行間隔の上限（秒）
+class RewardBuffer:
+    """ユーザーごとの未書き込み報酬を溜めておくバッファ"""
+    def __init__(self, interval, max_users):
+        self.interval = interval
+        self.max_users = max_users
+        self.pending = {}
+        self.flush_count = 0
+        self.last_flush_size = 0
+        self.last_flush_latency = 0.0
+        self.last_error = None
+        self.failures = 0  # 連続で失敗した回数（再試行の間隔を延ばす）
+        self._lock = asyncio.Lock()
+        self._wakeup = asyncio.Event()
+        self._stopping = asyncio.Event()
+        self._task = None
+
+    @property
+    def depth(self):
+        """書き込み待ちのユーザー数"""
+        return len(self.pending)
+
+    def add(self, user_id, amount):
+        self.pending[user_id] = self.pending.get(user_id, 0) + amount
+        if len(self.pending) >= self.max_users:
+            self._wakeup.set()
+
+    def start(self):
+        if self._task is None:
+            self._task = asyncio.create_task(self._run())
+
+    async def stop(self):
+        """タイマーを止めて残りを全部書き込む（シャットダウン時）"""
+        if self._task:
+            # キャンセルはしない（書き込み中の run_db を途中で捨てると、そのかたまりと残りが pending に戻らない）。
+            # 止まるよう知らせて、書き込み中ならその終わりを待つ
+            self._stopping.set()
+            self._wakeup.set()
+            await self._task
+            self._task = None
+        await self.flush()
+
+    async def _run(self):
+        while not self._stopping.is_set():
+            # 失敗が続いている間は人数で起こされても待つ（指数的に延ばす。止める時だけは起きる）
+            event = self._stopping if self.failures else self._wakeup
+            delay = min(REWARD_RETRY_MAX_DELAY, self.interval * 2 ** (self.failures - 1)) if self.failures else self.interval
+            try:
+                await asyncio.wait_for(event.wait(), timeout=delay)
+            except asyncio.TimeoutError:
+                pass
+            if self._stopping.is_set():
+                return
+            self._wakeup.clear()
+            try:
+                await self.flush()
+                self.failures = 0
+            except Exception as e:
+                self.failures += 1
+                print(f"報酬の書き込みに失敗（{self.failures}回目）: {e}")
+
+    async def flush(self):
+        async with self._lock:
+            if not self.pending:
+                return
+            pending, self.pending = list(self.pending.items()), {}
+            started = time.perf_counter()
+            step = BATCH_LIMIT - 1
+            for i in range(0, len(pending), step):
+                chunk = pending[i:i + step]
+                try:
+                    await run_db(store.commit_rewards, chunk)
+                    for user_id, amount in chunk:
+                        balances.add(user_id, balance=amount, earned=amount)
+                except BaseException as e:
+                    # コミットできなかった分は戻して次回（キャンセルされた時は stop の最後の flush）に再送する。
+                    # add() と違ってすぐには起こさない
+                    self.last_error = str(e) or type(e).__name__
+                    for user_id, amount in pending[i:]:
+                        self.pending[user_id] = self.pending.get(user_id, 0) + amount
+                    raise
+            self.flush_count += 1
+            self.last_flush_size = len(pending)
+            self.last_flush_latency = time.perf_counter() - started
+            self.last_error = None
+
+    def stats(self):
+        return {
+            "queue_depth": self.depth,
+            "pending_amount": sum(self.pending.values()),
+            "flush_count": self.flush_count,
+            "last_flush_size": self.last_flush_size,
+            "last_flush_latency_ms": round(self.last_flush_latency * 1000, 1),
+            "last_error": self.last_error,
+            "consecutive_failures": self.failures,
+        }
+
+reward_buffer = RewardBuffer(REWARD_FLUSH_INTERVAL, REWARD_FLUSH_MAX_USERS)
+
+# === 一括書き込み（ロール全員への付与・減額・リセットなど） ===
+# 1人ずつ書き込まず、BATCH_LIMIT 件ずつのバッチを BULK_CONCURRENCY 本まで並列にコミットする。
+# 進み具合はフォローアップメッセージを編集して知らせ、失敗した分は最後にまとめて報告する。
+BULK_CONCURRENCY = int(os.getenv("BULK_CONCURRENCY") or 4)
+BULK_PROGRESS_INTERVAL = 2.0  # 進捗メッセージの編集間隔（秒）
+
+async def bulk_write(keys, commit_fn, ops_per_key=1, progress=None, on_commit=None):
+    """
+    keys を BATCH_LIMIT 件以内のかたまりに分け、かたまりごとに commit_fn(keys) を1バッチとしてコミットする。
+    commit_fn は store.bulk_change_balance などの同期関数（スレッドプールで呼ばれる）。
+    on_commit(keys) はコミットできたかたまりごとに呼ばれる（キャッシュの更新など）。
+    progress(完了件数, 失敗件数) は各バッチの完了時に呼ばれる。
+    戻り値: (成功件数, [(失敗したキーのリスト, エラー)])
+    """
+    keys = list(keys)
+    size = max(1, (BATCH_LIMIT - 1) // ops_per_key)
+    chunks = [keys[i:i + size] for i in range(0, len(keys), size)]
+    semaphore = asyncio.Semaphore(BULK_CONCURRENCY)
+    done = 0
+    failures = []
+
+    async def run_chunk(chunk):
+        nonlocal done
+        async with semaphore:
+            # Increment を含むので自動でやり直しはしない（二重付与を避ける）。失敗分は報告する
+            try:
+                await run_db(commit_fn, chunk)
+                done += len(chunk)
+                if on_commit:
+                    on_commit(chunk)
+            except Exception as e:
+                failures.append((chunk, e))
+                print(f"一括書き込みに失敗 ({len(chunk)}件): {e}")
+            if progress:
+                await progress(done, sum(len(c) for c, _ in failures))
+
+    await asyncio.gather(*(run_chunk(c) for c in chunks))
+    return done, failures
+
+class BulkProgress:
+    """一括処理の進み具合をフォローアップメッセージに表示する"""
+    def __init__(self, interaction, label, total):
+        self.interaction = interaction
+        self.label = label
+        self.total = total
+        self.message = None
+        self.started = time.monotonic()
+        self.last_edit = 0.0
+
+    def render(self, done, failed):
+        text = f"⏳ {self.label}: {done}/{self.total}件"
+        if failed:
+            text += f"（失敗 {failed}件）"
+        return text
+
+    async def start(self):
+        self.message = await self.interaction.followup.send(self.render(0, 0), wait=True)
+
+    async def __call__(self, done, failed):
+        now = time.monotonic()
+        if self.message is None or now - self.last_edit < BULK_PROGRESS_INTERVAL:
+            return
+        self.last_edit = now
+        try:
+            await self.message.edit(content=self.render(done, failed))
+        except discord.HTTPException:
+            pass
+
+    async def finish(self, text, done, failures):
+        elapsed = time.monotonic() - self.started
+        text = f"{text}\n成功: {done}/{self.total}件（{elapsed:.1f}秒）"
+        if failures:
+            failed = sum(len(keys) for keys, _ in failures)
+            errors = sorted({type(e).__name__ + ": " + str(e)[:100] for _, e in failures})
+            text += f"\n⚠️ 失敗: {failed}件\n" + "\n".join(f"・{err}" for err in errors[:5])
+        try:
+            await self.message.edit(content=text)
+        except discord.HTTPException:
+            await self.interaction.followup.send(text, ephemeral=True)
+
+async def bulk_update_role(interaction, role, label, commit_fn, ops_per_key=1, on_commit=None):
+    """ロールの Bot 以外の全員に commit_fn(user_ids) を適用し、進捗と結果を表示する"""
+    user_ids = [m.id for m in role.members if not m.bot]
+    progress = BulkProgress(interaction, label, len(user_ids))
+    await progress.start()
+    done, failures = await bulk_write(user_ids, commit_fn, ops_per_key, progress, on_commit)
+    return progress, done, failures
 
 # discord.py intents
 intents = discord.Intents.default()
@@ -90,46 +754,473 @@ intents.message_content = True
 intents.voice_states = True
 intents.guilds = True
 intents.members = True
-bot = commands.Bot(command_prefix="/", intents=intents)
+
+# === シャード（複数プロセス） ===
+# AutoShardedBot なので、何も指定しなければ1プロセスで Discord の推奨数のシャードをすべて受け持つ。
+# SHARD_COUNT（全体のシャード数）と SHARD_IDS（このプロセスが受け持つ番号、カンマ区切り）を指定すると、
+# 複数のワーカープロセスでシャードを分け合う（ローカルでは run_shards.py でまとめて起動できる）。
+# 共有すべき状態は保存先に置き、それ以外はサーバー（ギルド）単位なので、受け持ちのシャードで分かれる:
+# ・通話セッション: 保存先の voice_sessions から、自分のシャードのギルドの分だけ復元する
+# ・カタログのキャッシュ: 保存先の変更通知（Firestore の on_snapshot / SQLite の change_log）で追従
+# ・残高のキャッシュ: 変更通知（SQLite の change_log / Firestore では最近読んだ人の users/{id}）で捨てて読み直す
+# ・所持アイテムのキャッシュ: SQLite では change_log の通知で捨てて読み直す。Firestore では TTL で追従
+# ・報酬バッファ: 加算だけなのでプロセスごとに溜めて書いても合計は同じ
+# ・コマンドの登録: シャード0を受け持つプロセスだけが行う
+SHARD_COUNT = int(os.getenv("SHARD_COUNT") or 0) or None
+SHARD_IDS = [int(x) for x in (os.getenv("SHARD_IDS") or "").split(",") if x.strip().isdigit()] or None
+if SHARD_IDS and not SHARD_COUNT:
+    raise SystemExit("SHARD_IDS を指定する時は SHARD_COUNT も指定してください")
+
+def shard_of(guild_id):
+    return (guild_id >> 22) % SHARD_COUNT
+
+def owns_guild(guild_id):
+    """このプロセスが受け持つシャードのギルドか"""
+    return SHARD_IDS is None or shard_of(guild_id) in SHARD_IDS
+
+def owns_shard_zero():
+    return SHARD_IDS is None or 0 in SHARD_IDS
+
+class RaruinBot(commands.AutoShardedBot):
+    async def setup_hook(self):
+        loop_lag.start()
+        stall_watchdog.start()
+        # コマンドの登録はシャード0のプロセスだけが1回、接続を待たせないよう裏で行う
+        # （タスクは参照を持っておかないと、終わる前にガベージコレクションされることがある）
+        self.sync_task = asyncio.create_task(sync_command_tree()) if owns_shard_zero() else None
+        reward_buffer.start()
+        voice_tracker.start()
+        await catalog.start()
+        await balances.start()
+        await start_inventory_listeners()
+        # Render/Heroku の停止は SIGTERM なので、close() を通して残りを書き込む
+        try:
+            asyncio.get_running_loop().add_signal_handler(
+                signal.SIGTERM, lambda: asyncio.create_task(self.close())
+            )
+        except (NotImplementedError, RuntimeError):
+            pass
+
+    async def close(self):
+        loop_lag.stop()
+        stall_watchdog.stop()
+        catalog.stop_listeners()
+        balances.stop_listeners()
+        stop_inventory_listeners()
+        try:
+            await voice_tracker.stop()
+        except Exception as e:
+            print(f"終了時の通話セッション保存に失敗: {e}")
+        try:
+            await reward_buffer.stop()
+        except Exception as e:
+            print(f"終了時の報酬書き込みに失敗: {e}")
+        try:
+            await outbox.drain()
+        except Exception as e:
+            print(f"終了時の通知送信に失敗: {e}")
+        await super().close()
+
+bot = RaruinBot(command_prefix="/", intents=intents, shard_count=SHARD_COUNT, shard_ids=SHARD_IDS)
 tree = bot.tree
 
+# --- コマンドの応答時間・イベントループの遅れ ---
+# 応答時間はインタラクションの作成時刻（Discord 側）からコマンド完了までなので、3秒の応答期限と直接比べられる
+COMMAND_BUCKETS = (0.1, 0.25, 0.5, 1.0, 1.5, 2.0, 2.5, 3.0, 5.0, 10.0)
+LOOP_LAG_INTERVAL = float(os.getenv("LOOP_LAG_INTERVAL") or 0.5)
+
+command_seconds = REGISTRY.histogram(
+    "raruin_command_seconds", "インタラクション作成からコマンド完了までの時間", ("command",), COMMAND_BUCKETS)
+command_errors = REGISTRY.counter(
+    "raruin_command_errors_total", "コマンドで出た例外の数", ("command", "error"))
+loop_lag_seconds = REGISTRY.histogram(
+    "raruin_event_loop_lag_seconds", "イベントループの遅れ（sleep が予定より遅れて戻った時間）",
+    buckets=(0.001, 0.005, 0.01, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0))
+loop_lag_current = REGISTRY.gauge("raruin_event_loop_lag_current_seconds", "直近のイベントループの遅れ")
+REGISTRY.gauge("raruin_gateway_latency_seconds", "Discord ゲートウェイの遅延（bot.latency）", func=lambda: bot.latency)
+REGISTRY.gauge("raruin_outbound_queue_depth", "送信待ちのメッセージ数", func=lambda: outbox.depth)
+REGISTRY.gauge("raruin_reward_buffer_users", "書き込み待ちのチャット報酬の人数", func=lambda: reward_buffer.depth)
+REGISTRY.gauge("raruin_storage_executor_queue", "スレッドプールで実行待ちの保存先呼び出し数",
+               func=lambda: db_executor._work_queue.qsize())
+
+def interaction_age(interaction):
+    return (discord.utils.utcnow() - interaction.created_at).total_seconds()
+
+@bot.event
+async def on_app_command_completion(interaction, command):
+    command_seconds.observe(interaction_age(interaction), command=command.qualified_name)
+
+@tree.error
+async def on_app_command_error(interaction, error):
+    name = interaction.command.qualified_name if interaction.command else "unknown"
+    original = getattr(error, "original", error)
+    command_seconds.observe(interaction_age(interaction), command=name)
+    command_errors.inc(command=name, error=type(original).__name__)
+    print(f"コマンドエラー ({name}): {original}")
+    traceback.print_exception(type(original), original, original.__traceback__)
+
+class LoopLagMonitor:
+    """LOOP_LAG_INTERVAL ごとに sleep し、予定より遅れて戻った分をイベントループの遅れとして記録する"""
+    def __init__(self, interval):
+        self.interval = interval
+        self.task = None
+        self.max_lag = 0.0
+        self.beat = time.monotonic()  # 最後に起きた時刻（StallWatchdog が見る）
+
+    async def _run(self):
+        while True:
+            started = self.beat = time.monotonic()
+            await asyncio.sleep(self.interval)
+            lag = max(0.0, time.monotonic() - started - self.interval)
+            loop_lag_seconds.observe(lag)
+            loop_lag_current.set(lag)
+            self.max_lag = max(self.max_lag, lag)
+
+    def start(self):
+        if self.task is None or self.task.done():
+            self.task = asyncio.create_task(self._run())
+
+    def stop(self):
+        if self.task:
+            self.task.cancel()
+
+loop_lag = LoopLagMonitor(LOOP_LAG_INTERVAL)
+
+# --- イベントループの停止検知 ---
+# 同期の処理がループを止めている間は LoopLagMonitor も動けないので、別スレッドから心拍を見張る。
+# STALL_THRESHOLD 秒以上止まっていたら、その時ループで動いているタスクとスタックを1回だけログに出す。
+STALL_THRESHOLD = float(os.getenv("STALL_THRESHOLD") or 1.0)
+
+loop_stalls = REGISTRY.counter(
+    "raruin_event_loop_stalls_total", "イベントループが STALL_THRESHOLD 秒以上止まった回数", ("task",))
+
+def describe_task(task):
+    if task is None:
+        return "タスク外のコールバック"
+    coro = task.get_coro()
+    return f"{task.get_name()} ({getattr(coro, '__qualname__', coro)})"
+
+class StallWatchdog:
+    def __init__(self, monitor, threshold):
+        self.monitor = monitor
+        self.threshold = threshold
+        self.loop = None
+        self.loop_thread_id = None
+        self.stalls = 0
+        self._stop = threading.Event()
+        self._thread = None
+
+    def start(self):
+        self.loop = asyncio.get_running_loop()
+        self.loop_thread_id = threading.get_ident()
+        self._stop.clear()
+        if self._thread is None or not self._thread.is_alive():
+            self._thread = threading.Thread(target=self._run, name="stall-watchdog", daemon=True)
+            self._thread.start()
+
+    def stop(self):
+        self._stop.set()
+
+    def _run(self):
+        reported = None
+        while not self._stop.wait(min(self.threshold / 4, 0.25)):
+            beat = self.monitor.beat
+            stalled = time.monotonic() - beat - self.monitor.interval
+            if stalled < self.threshold or reported == beat:
+                continue
+            reported = beat  # 同じ停止は1回だけ報告する
+            self.report(stalled)
+
+    def report(self, stalled):
+        frame = sys._current_frames().get(self.loop_thread_id)
+        name = describe_task(asyncio.current_task(self.loop))
+        stack = "".join(traceback.format_stack(frame)) if frame else "(スタックを取得できません)\n"
+        self.stalls += 1
+        loop_stalls.inc(task=name)
+        print(f"⚠️ イベントループが {stalled:.1f}秒以上止まっています: {name}\n{stack}", end="")
+
+stall_watchdog = StallWatchdog(loop_lag, STALL_THRESHOLD)
+
+# === 送信スケジューラ ===
+# 通知・ログ・DM はすべてここに積む。送信先ごとのキューでまとめて1通にし、
+# 2000文字を超える分は行の切れ目で分けて送る。同じ送信先へは OUTBOUND_MIN_INTERVAL 秒以上空け、
+# 429 が返ってきたら retry_after だけ待ってやり直す。コマンド側は積むだけで待たない。
+DISCORD_MESSAGE_LIMIT = 2000
+OUTBOUND_MIN_INTERVAL = float(os.getenv("OUTBOUND_MIN_INTERVAL") or 1.0)
+OUTBOUND_MAX_RETRIES = 5
+
+def split_message(text, limit=DISCORD_MESSAGE_LIMIT):
+    """行の切れ目で limit 文字以内に分ける（1行が長すぎる時だけ行の途中で切る）"""
+    parts = []
+    current = ""
+    for line in text.split("\n"):
+        while len(line) > limit:
+            if current:
+                parts.append(current)
+                current = ""
+            parts.append(line[:limit])
+            line = line[limit:]
+        candidate = f"{current}\n{line}" if current else line
+        if len(candidate) > limit:
+            parts.append(current)
+            current = line
+        else:
+            current = candidate
+    if current:
+        parts.append(current)
+    return parts
+
+class OutboundScheduler:
+    def __init__(self, min_interval=OUTBOUND_MIN_INTERVAL):
+        self.min_interval = min_interval
+        self.queues = {}        # 送信先キー -> deque[str]
+        self.targets = {}       # 送信先キー -> ユーザー（DM用）
+        self.workers = {}       # 送信先キー -> Task
+        self.last_sent = {}     # 送信先キー -> 最後に送った時刻
+        self.draining = asyncio.Event()  # 終了時：まとめ待ち（delay）を打ち切ってすぐ送る
+        self.sent = 0
+        self.failed = 0
+        self.rate_limited = 0
+
+    @property
+    def depth(self):
+        return sum(len(q) for q in self.queues.values())
+
+    def send_channel(self, channel_id, text, delay=0.0):
+        """チャンネルへ送る。delay 秒の間に積まれた分は1通にまとめる"""
+        if channel_id:
+            self._enqueue(("channel", channel_id), text, delay)
+
+    def send_user(self, user, text, delay=0.0):
+        """DMを送る（DMを受け取らない設定の人には送れないので捨てる）"""
+        key = ("dm", user.id)
+        self.targets[key] = user
+        self._enqueue(key, text, delay)
+
+    def _enqueue(self, key, text, delay):
+        self.queues.setdefault(key, deque()).append(text)
+        worker = self.workers.get(key)
+        if worker is None or worker.done():
+            self.workers[key] = asyncio.create_task(self._worker(key, delay))
+
+    async def _resolve(self, key):
+        kind, target_id = key
+        if kind == "channel":
+            # 別のシャードのギルドのチャンネルはキャッシュに無いので、IDだけで送る
+            return bot.get_channel(target_id) or bot.get_partial_messageable(target_id)
+        return self.targets.get(key)
+
+    def _take_batch(self, queue):
+        """キューの先頭から1通に収まるだけ取り出す（1件で収まらない物は分割して先頭に戻す）"""
+        first = queue.popleft()
+        if len(first) > DISCORD_MESSAGE_LIMIT:
+            parts = split_message(first)
+            queue.extendleft(reversed(parts[1:]))
+            return parts[0]
+        content = first
+        while queue and len(content) + 1 + len(queue[0]) <= DISCORD_MESSAGE_LIMIT:
+            content += "\n" + queue.popleft()
+        return content
+
+    async def _worker(self, key, delay):
+        try:
+            if delay:
+                try:
+                    await asyncio.wait_for(self.draining.wait(), timeout=delay)
+                except asyncio.TimeoutError:
+                    pass
+            queue = self.queues[key]
+            while True:
+                while queue:
+                    wait = self.last_sent.get(key, 0) + self.min_interval - time.monotonic()
+                    if wait > 0:
+                        await asyncio.sleep(wait)
+                    content = self._take_batch(queue)
+                    await self._send(key, content)
+                    self.last_sent[key] = time.monotonic()
+                # 次に送れるようになるまで待ってから片付ける（その間に積まれた分はこのまま送る）
+                wait = self.last_sent.get(key, 0) + self.min_interval - time.monotonic()
+                if wait > 0:
+                    await asyncio.sleep(wait)
+                if not queue:
+                    break
+            # 一度DMした相手ごとに空のキューが残り続けないよう、送り終えた送信先は消す
+            self.queues.pop(key, None)
+            self.last_sent.pop(key, None)
+        finally:
+            self.workers.pop(key, None)
+            self.targets.pop(key, None)
+
+    async def _send(self, key, content):
+        """1通送る（429 は待って再送。それ以外の失敗は数えて捨てる）"""
+        try:
+            target = await self._resolve(key)
+        except Exception as e:
+            target = None
+            print(f"送信先の取得に失敗 ({key}): {e}")
+        if target is None:
+            print(f"送信先が見つかりません: {key}")
+            self.failed += 1
+            return
+        for attempt in range(OUTBOUND_MAX_RETRIES):
+            try:
+                await target.send(content)
+                self.sent += 1
+                return
+            except discord.HTTPException as e:
+                if e.status == 429:
+                    self.rate_limited += 1
+                    retry_after = getattr(e, "retry_after", None) or 2 ** attempt
+                    await asyncio.sleep(retry_after)
+                    continue
+                if key[0] == "channel":
+                    print(f"送信に失敗 ({key}): {e}")
+                self.failed += 1
+                return
+            except Exception as e:
+                print(f"送信に失敗 ({key}): {type(e).__name__}: {e}")
+                self.failed += 1
+                return
+        print(f"送信をあきらめました ({key}): レート制限が続いています")
+        self.failed += 1
+
+    async def drain(self, timeout=10.0):
+        """終了時：待機中の分も含めて送り切る（まとめ待ちの分も待たずに送る）"""
+        self.draining.set()
+        for key, queue in self.queues.items():
+            worker = self.workers.get(key)
+            if queue and (worker is None or worker.done()):
+                self.workers[key] = asyncio.create_task(self._worker(key, 0))
+        pending = [w for w in self.workers.values() if not w.done()]
+        if pending:
+            await asyncio.wait(pending, timeout=timeout)
+
+    def stats(self):
+        return {
+            "queue_depth": self.depth, "routes": len(self.workers),
+            "sent": self.sent, "failed": self.failed, "rate_limited": self.rate_limited,
+        }
+
+outbox = OutboundScheduler()
+
+# === メンバー検索用インデックス ===
+# 表示名（小文字）の 1〜3文字 n-gram → メンバーID の転置索引と、前方一致用のソート済みリスト。
+# キー入力のたびに全メンバーを走査しないよう、参加/退出/名前変更イベントで差分更新する。
+class MemberIndex:
+    NGRAM = 3
+
+    def __init__(self, members=()):
+        self.names = {}         # member_id -> (display_name, 小文字の表示名)
+        self.sorted_keys = []   # (小文字の表示名, member_id) のソート済みリスト
+        self.grams = {}         # n-gram -> {member_id}
+        for m in members:
+            self.add(m.id, m.display_name)
+
+    def __len__(self):
+        return len(self.names)
+
+    def _ngrams(self, lower):
+        return {lower[i:i + n] for n in range(1, self.NGRAM + 1) for i in range(len(lower) - n + 1)}
+
+    def add(self, member_id, display_name):
+        if member_id in self.names:
+            if self.names[member_id][0] == display_name:
+                return
+            self.remove(member_id)
+        lower = display_name.lower()
+        self.names[member_id] = (display_name, lower)
+        bisect.insort(self.sorted_keys, (lower, member_id))
+        for gram in self._ngrams(lower):
+            self.grams.setdefault(gram, set()).add(member_id)
+
+    def remove(self, member_id):
+        entry = self.names.pop(member_id, None)
+        if entry is None:
+            return
+        lower = entry[1]
+        i = bisect.bisect_left(self.sorted_keys, (lower, member_id))
+        if i < len(self.sorted_keys) and self.sorted_keys[i] == (lower, member_id):
+            del self.sorted_keys[i]
+        for gram in self._ngrams(lower):
+            ids = self.grams.get(gram)
+            if ids is not None:
+                ids.discard(member_id)
+                if not ids:
+                    del self.grams[gram]
+
+    def search(self, query, limit=25):
+        """前方一致を先に、足りなければ部分一致で埋めて (表示名, ID) を最大 limit 件返す"""
+        q = query.lower()
+        results = []
+        seen = set()
+        # 前方一致：ソート済みリストを二分探索
+        i = bisect.bisect_left(self.sorted_keys, (q,))
+        while i < len(self.sorted_keys) and len(results) < limit:
+            lower, member_id = self.sorted_keys[i]
+            if not lower.startswith(q):
+                break
+            results.append((self.names[member_id][0], member_id))
+            seen.add(member_id)
+            i += 1
+        if len(results) >= limit or not q:
+            return results
+        # 部分一致：n-gram の転置索引から候補を絞り込む
+        if len(q) <= self.NGRAM:
+            candidates = self.grams.get(q, set())
+        else:
+            postings = sorted(
+                (self.grams.get(q[j:j + self.NGRAM], set()) for j in range(len(q) - self.NGRAM + 1)),
+                key=len
+            )
+            candidates = set(postings[0]).intersection(*postings[1:])
+        rest = (
+            (self.names[m][1], m) for m in candidates
+            if m not in seen and q in self.names[m][1]
+        )
+        for lower, member_id in heapq.nsmallest(limit - len(results), rest):
+            results.append((self.names[member_id][0], member_id))
+        return results
+
+member_indexes = {}  # guild_id -> MemberIndex
+
+def get_member_index(guild):
+    index = member_indexes.get(guild.id)
+    if index is None:
+        index = member_indexes[guild.id] = MemberIndex(guild.members)
+    return index
+
 # --- async autocomplete ---
 async def user_autocomplete(interaction: discord.Interaction, current: str):
     return [
-        app_commands.Choice(name=m.display_name, value=str(m.id))
-        for m in interaction.guild.members if current.lower() in m.display_name.lower()
-    ][:25]
+        app_commands.Choice(name=name, value=str(member_id))
+        for name, member_id in get_member_index(interaction.guild).search(current, 25)
+    ]
 
 async def shop_autocomplete(interaction: discord.Interaction, current: str):
-    shops = [doc.id for doc in db.collection("shops").stream()]
+    shops = await catalog.shop_names()
     return [
         app_commands.Choice(name=s, value=s)
         for s in shops if current.lower() in s.lower()
     ][:25]
 
 async def myitem_key_autocomplete(interaction: discord.Interaction, current: str):
-    items = []
-    for doc in user_doc(interaction.user.id).collection("items").stream():
-        pname = doc.id.split(":",1)[1]
-        sname = doc.id.split(":",1)[0]
-        display = f"{pname}（{sname}）"
-        items.append((display, doc.id))
+    items = await get_inventory(interaction.user.id)
+    q = current.lower()
     return [
-        app_commands.Choice(name=disp, value=key)
-        for disp, key in items if current.lower() in disp.lower()
+        app_commands.Choice(name=itm["display"], value=key)
+        for key, itm in items.items() if q in itm["search"]
     ][:25]
 
 async def product_autocomplete(interaction: discord.Interaction, current: str):
     # すでにショップ名が入力されているか確認
     shop_name = interaction.namespace.shop_name
-    if not shop_name or not shop_exists(shop_name):
+    if not shop_name or not await shop_exists(shop_name):
         return []
 
-    # そのショップの商品一覧を取得
+    # そのショップの商品一覧を取得（カタログキャッシュから）
     prods = []
-    for doc in shop_doc(shop_name).collection("products").stream():
-        p_data = doc.to_dict()
-        p_name = doc.id
+    for p_data in await catalog.products(shop_name):
+        p_name = p_data["product_name"]
         price = p_data.get("price", 0)
         # 候補に「商品名 (価格 Raruin)」と表示
         display_name = f"{p_name} ({price} {CURRENCY_NAME})"
@@ -140,15 +1231,83 @@ async def product_autocomplete(interaction: discord.Interaction, current: str):
     return prods[:25]
 
 
+# === コマンドの登録（sync） ===
+# tree.sync() は遅くレート制限もあるので、再接続のたびには呼ばない。
+# コマンド定義のハッシュを maintenance/command_sync に覚えておき、変わった時だけ setup_hook から1回送る。
+# SYNC_GUILD_IDS（カンマ区切り）を指定するとそのサーバーだけに登録する（すぐ反映される。開発用）。
+SYNC_GUILD_IDS = [int(x) for x in (os.getenv("SYNC_GUILD_IDS") or "").split(",") if x.strip().isdigit()]
+
+def command_payload(guild=None):
+    commands_ = tree.get_commands(guild=guild)
+    try:
+        payload = [cmd.to_dict(tree) for cmd in commands_]
+    except TypeError:  # discord.py 2.4 より前は引数なし
+        payload = [cmd.to_dict() for cmd in commands_]
+    return sorted(payload, key=lambda c: (c.get("type", 1), c["name"]))
+
+def command_tree_hash(guild=None):
+    raw = json.dumps(command_payload(guild), sort_keys=True, ensure_ascii=False, default=str)
+    return hashlib.sha256(raw.encode()).hexdigest()
+
+async def sync_command_tree():
+    scopes = [discord.Object(id=g) for g in SYNC_GUILD_IDS] or [None]
+    try:
+        state = await run_db(store.get_checkpoint, "command_sync") or {}
+        changed = False
+        for guild in scopes:
+            if guild is not None:
+                tree.copy_global_to(guild=guild)
+            key = f"guild:{guild.id}" if guild else "global"
+            digest = command_tree_hash(guild)
+            if state.get(key) == digest:
+                print(f"Command sync skipped ({key}: unchanged)")
+                continue
+            synced = await tree.sync(guild=guild)
+            print(f"Synced {len(synced)} command(s) ({key})")
+            state[key] = digest
+            changed = True
+        if changed:
+            await run_db(store.save_checkpoint, "command_sync", state)
+    except Exception as e:
+        print(f"Sync error: {e}")
+
 @bot.event
 async def on_ready():
     print(f"Logged in as {bot.user.name}")
+    # 再起動・再接続の間に入退室した人の分をボイスチャンネルの実際の状態と突き合わせる
     try:
-        # スラッシュコマンドをDiscordに送信して登録する
-        synced = await bot.tree.sync()
-        print(f"Synced {len(synced)} command(s)")
+        await voice_tracker.restore(bot.guilds)
     except Exception as e:
-        print(f"Sync error: {e}")
+        print(f"通話セッションの復元に失敗: {e}")
+
+# --- メンバー検索インデックスの差分更新 ---
+@bot.event
+async def on_member_join(member):
+    index = member_indexes.get(member.guild.id)
+    if index is not None:
+        index.add(member.id, member.display_name)
+
+@bot.event
+async def on_member_remove(member):
+    index = member_indexes.get(member.guild.id)
+    if index is not None:
+        index.remove(member.id)
+
+@bot.event
+async def on_member_update(before, after):
+    if before.display_name != after.display_name:
+        index = member_indexes.get(after.guild.id)
+        if index is not None:
+            index.add(after.id, after.display_name)
+
+@bot.event
+async def on_user_update(before, after):
+    # グローバル名の変更はニックネームのないメンバーの表示名に影響する
+    for guild_id, index in member_indexes.items():
+        guild = bot.get_guild(guild_id)
+        member = guild.get_member(after.id) if guild else None
+        if member is not None:
+            index.add(member.id, member.display_name)
         
 # --- コマンド群 ---
 @tree.command(name="リセット", description=f"ユーザーまたはロールの残高・統計をリセット（管理者）")
@@ -160,16 +1319,15 @@ async def reset_balance_cmd(interaction: discord.Interaction, target: Union[disc
     # タイムアウト対策
     await interaction.response.defer(ephemeral=True)
 
-    def reset_user(uid):
-        user_doc(uid).set({"balance": 1000, "earned": 0, "spent": 0}, merge=True)
-
     if isinstance(target, discord.Role):
-        for member in target.members:
-            if not member.bot:
-                reset_user(member.id)
-        await interaction.followup.send(f"ロール「{target.name}」の全員の残高・統計をリセットしました。")
+        progress, done, failures = await bulk_update_role(
+            interaction, target, f"ロール「{target.name}」をリセット中",
+            store.bulk_reset_balance, on_commit=balances.reset
+        )
+        await progress.finish(f"ロール「{target.name}」の全員の残高・統計をリセットしました。", done, failures)
     else:
-        reset_user(target.id)
+        await run_db(store.reset_user_balance, target.id)
+        balances.reset([target.id])
         await interaction.followup.send(f"{target.display_name} の残高・統計をリセットしました。")
         
 @tree.command(name="付与", description=f"ユーザーまたはロールに {CURRENCY_NAME} 付与")
@@ -184,14 +1342,16 @@ async def add_raurin(interaction: discord.Interaction, target: Union[discord.Mem
     await interaction.response.defer(ephemeral=True)
 
     if isinstance(target, discord.Role):
-        for member in target.members:
-            if not member.bot:
-                change_balance(member.id, amount, is_add=True)
-        await interaction.followup.send(f"ロール「{target.name}」の全員に {amount}{CURRENCY_NAME} を付与しました。")
+        progress, done, failures = await bulk_update_role(
+            interaction, target, f"ロール「{target.name}」に付与中",
+            functools.partial(store.bulk_change_balance, amount=amount, is_add=True),
+            on_commit=functools.partial(balances.changed, amount=amount, is_add=True)
+        )
+        await progress.finish(f"ロール「{target.name}」の全員に {amount}{CURRENCY_NAME} を付与しました。", done, failures)
     else:
-        change_balance(target.id, amount, is_add=True)
-        try: await target.send(f"あなたに {amount}{CURRENCY_NAME} が付与されました。")
-        except: pass
+        await run_db(store.change_balance, target.id, amount, is_add=True)
+        balances.changed([target.id], amount, is_add=True)
+        outbox.send_user(target, f"あなたに {amount}{CURRENCY_NAME} が付与されました。")
         await interaction.followup.send(f"{target.display_name} に {amount}{CURRENCY_NAME} 付与しました。")
 
 @tree.command(name="減額", description=f"ユーザーまたはロールから {CURRENCY_NAME} 減額")
@@ -205,14 +1365,40 @@ async def remove_raurin(interaction: discord.Interaction, target: Union[discord.
     await interaction.response.defer(ephemeral=True)
 
     if isinstance(target, discord.Role):
-        for member in target.members:
-            if not member.bot:
-                change_balance(member.id, amount, is_add=False)
-        await interaction.followup.send(f"ロール「{target.name}」の全員から {amount}{CURRENCY_NAME} を減額しました。")
+        progress, done, failures = await bulk_update_role(
+            interaction, target, f"ロール「{target.name}」から減額中",
+            functools.partial(store.bulk_change_balance, amount=amount, is_add=False),
+            on_commit=functools.partial(balances.changed, amount=amount, is_add=False)
+        )
+        await progress.finish(f"ロール「{target.name}」の全員から {amount}{CURRENCY_NAME} を減額しました。", done, failures)
     else:
-        change_balance(target.id, amount, is_add=False)
+        await run_db(store.change_balance, target.id, amount, is_add=False)
+        balances.changed([target.id], amount, is_add=False)
         await interaction.followup.send(f"{target.display_name} から {amount}{CURRENCY_NAME} 減額しました。")
 
+@tree.command(name="アイテム配布", description="ロールの全員にアイテムを配布（管理者）")
+@app_commands.describe(role="配布するロール", shop_name="ショップ名", product_name="商品名", amount="1人あたりの個数")
+@app_commands.autocomplete(shop_name=shop_autocomplete, product_name=product_autocomplete)
+async def item_distribute_cmd(interaction: discord.Interaction, role: discord.Role, shop_name: str, product_name: str, amount: int = 1):
+    if not is_admin(interaction.user):
+        await interaction.response.send_message("管理者限定", ephemeral=True); return
+    if amount <= 0:
+        await interaction.response.send_message("個数が不正です", ephemeral=True); return
+    if await catalog.product(shop_name, product_name) is None:
+        await interaction.response.send_message("その商品は存在しません", ephemeral=True); return
+
+    await interaction.response.defer(ephemeral=True)
+
+    # 在庫は減らさない（管理者からの配布）。1人1件の書き込みを BATCH_LIMIT 件ずつのバッチで並列に
+    progress, done, failures = await bulk_update_role(
+        interaction, role, f"ロール「{role.name}」に「{product_name}」を配布中",
+        functools.partial(store.bulk_add_user_item, shop_name=shop_name, product_name=product_name, amount=amount),
+        on_commit=functools.partial(update_inventories, shop_name=shop_name, product_name=product_name, delta=amount)
+    )
+    await progress.finish(
+        f"ロール「{role.name}」の全員に「{product_name}（{shop_name}）」を {amount} 個ずつ配布しました。", done, failures
+    )
+
 @tree.command(name="shop", description="ショップ追加/削除（管理者）")
 @app_commands.describe(action="追加or削除", shop_name="ショップ名")
 @app_commands.choices(action=[
@@ -223,10 +1409,12 @@ async def shop_command(interaction, action:str, shop_name:str):
     if not is_admin(interaction.user):
         await interaction.response.send_message("管理者限定", ephemeral=True);return
     if action=="add":
-        shop_doc(shop_name).set({})
+        await run_db(store.create_shop, shop_name)
+        catalog.put_shop(shop_name)
         await interaction.response.send_message(f"ショップ「{shop_name}」追加", ephemeral=True)
     elif action=="remove":
-        shop_doc(shop_name).delete()
+        await run_db(store.delete_shop, shop_name)
+        catalog.remove_shop(shop_name)
         await interaction.response.send_message(f"ショップ「{shop_name}」削除", ephemeral=True)
 
 @tree.command(name="shop商品", description="商品の追加/削除（管理者）")
@@ -245,87 +1433,255 @@ async def shopitem_command(
 ):
     if not is_admin(interaction.user):
         await interaction.response.send_message("管理者限定", ephemeral=True);return
-    if not shop_exists(shop_name):
+    if not await shop_exists(shop_name):
         await interaction.response.send_message("ショップがありません", ephemeral=True);return
     if action=="add":
-        product_doc(shop_name,product_name).set({
-            "description":description, "price":price, "stock":stock, "buy_role":buy_role
-        })
+        data = {"description":description, "price":price, "stock":stock, "buy_role":buy_role}
+        await run_db(store.set_product, shop_name, product_name, data)
+        catalog.put_product(shop_name, product_name, data)
         await interaction.response.send_message(f"{shop_name}に商品「{product_name}」追加", ephemeral=True)
     else:
-        product_doc(shop_name,product_name).delete()
+        await run_db(store.delete_product, shop_name, product_name)
+        catalog.remove_product(shop_name, product_name)
         await interaction.response.send_message(f"{shop_name}の商品「{product_name}」削除", ephemeral=True)
 
 @tree.command(name="残高", description=f"{CURRENCY_NAME}残高・獲得/消費表示")
 async def balance_cmd(interaction):
-    b,e,s = get_user_balance(interaction.user.id)
+    b,e,s = await balances.balance(interaction.user.id)
     await interaction.response.send_message(
         f"あなたの残高:\n**{b} {CURRENCY_NAME}**\n獲得:{e} 消費:{s}", ephemeral=True
     )
 
+# === ランキング ===
+# 全ユーザーを読まずに order_by + limit で必要な分だけ取る。
+# 上位 RANKING_TOP_N 人は定期的に更新する共有スナップショットを全ビューで使い回し、
+# それより下のページはビューごとにカーソルを覚えて10人ずつ読む。
+RANKING_PAGE_SIZE = 10
+RANKING_TOP_N = int(os.getenv("RANKING_TOP_N") or 100) // RANKING_PAGE_SIZE * RANKING_PAGE_SIZE or RANKING_PAGE_SIZE
+RANKING_REFRESH_SECONDS = float(os.getenv("RANKING_REFRESH_SECONDS") or 60)
+RANKING_FIELDS = {"balance": "残高", "earned": "累計獲得", "spent": "累計消費"}
+
+class LeaderboardSnapshot:
+    """field ごとの上位 N 人（全ビュー共有）"""
+    def __init__(self, field, size):
+        self.field = field
+        self.size = size
+        self.rows = []
+        self.cursor = None  # 上位 N 人の最後のドキュメント（N+1位以降を読む起点）
+        self.refreshed_at = 0.0
+        self._lock = asyncio.Lock()
+
+    @property
+    def complete(self):
+        """全ユーザーがスナップショットに収まっているか"""
+        return len(self.rows) < self.size
+
+    async def refresh_if_stale(self):
+        if time.monotonic() - self.refreshed_at < RANKING_REFRESH_SECONDS:
+            return
+        async with self._lock:
+            if time.monotonic() - self.refreshed_at < RANKING_REFRESH_SECONDS:
+                return
+            self.rows, self.cursor = await run_db(store.list_top_users, self.field, self.size)
+            self.refreshed_at = time.monotonic()
+
+leaderboards = {field: LeaderboardSnapshot(field, RANKING_TOP_N) for field in RANKING_FIELDS}
+
 class RankingPagination(discord.ui.View):
-    def __init__(self, users, guild):
+    def __init__(self, board, guild):
         super().__init__(timeout=60)
-        self.users = users
+        self.board = board
         self.guild = guild
         self.page = 0
-        self.max_page = (len(users) - 1) // 10
-
-    def create_embed(self):
-        start = self.page * 10
-        end = start + 10
-        current_users = self.users[start:end]
-        
-        embed = discord.Embed(title=f"{CURRENCY_NAME}ランキング ({self.page + 1}/{self.max_page + 1}ページ)")
-        for idx, u in enumerate(current_users):
+        self.extra_pages = {}  # 上位 N 人より下のページ: page -> (rows, 最後のドキュメント)
+
+    async def get_page(self, page):
+        start = page * RANKING_PAGE_SIZE
+        if start < self.board.size or self.board.complete:
+            return self.board.rows[start:start + RANKING_PAGE_SIZE]
+        if page not in self.extra_pages:
+            first_extra = self.board.size // RANKING_PAGE_SIZE
+            cursor = self.board.cursor if page == first_extra else self.extra_pages[page - 1][1]
+            if cursor is None:
+                return []
+            self.extra_pages[page] = await run_db(store.list_top_users, self.board.field, RANKING_PAGE_SIZE, cursor)
+        return self.extra_pages[page][0]
+
+    def create_embed(self, rows):
+        start = self.page * RANKING_PAGE_SIZE
+        label = RANKING_FIELDS[self.board.field]
+        embed = discord.Embed(title=f"{CURRENCY_NAME}ランキング・{label} ({self.page + 1}ページ)")
+        for idx, u in enumerate(rows):
             member = self.guild.get_member(u["user_id"])
             name = member.display_name if member else f"不明({u['user_id']})"
-            embed.add_field(
-                name=f"{start + idx + 1}位 {name}", 
-                value=f"残高: {u.get('balance',0)} / 累計獲得: {u.get('earned',0)}", 
-                inline=False
-            )
+            if self.board.field == "spent":
+                value = f"残高: {u.get('balance',0)} / 累計消費: {u.get('spent',0)}"
+            else:
+                value = f"残高: {u.get('balance',0)} / 累計獲得: {u.get('earned',0)}"
+            embed.add_field(name=f"{start + idx + 1}位 {name}", value=value, inline=False)
         return embed
 
     @discord.ui.button(label="前へ", style=discord.ButtonStyle.gray)
     async def prev_button(self, interaction: discord.Interaction, button: discord.ui.Button):
         if self.page > 0:
             self.page -= 1
-            await interaction.response.edit_message(embed=self.create_embed(), view=self)
+            rows = await self.get_page(self.page)
+            await interaction.response.edit_message(embed=self.create_embed(rows), view=self)
         else:
             await interaction.response.send_message("最初のページです", ephemeral=True)
 
     @discord.ui.button(label="次へ", style=discord.ButtonStyle.gray)
     async def next_button(self, interaction: discord.Interaction, button: discord.ui.Button):
-        if self.page < self.max_page:
+        rows = await self.get_page(self.page + 1)
+        if rows:
             self.page += 1
-            await interaction.response.edit_message(embed=self.create_embed(), view=self)
+            await interaction.response.edit_message(embed=self.create_embed(rows), view=self)
         else:
             await interaction.response.send_message("最後のページです", ephemeral=True)
 
 @tree.command(name="ランキング", description=f"{CURRENCY_NAME}ランキング")
-async def ranking_cmd(interaction: discord.Interaction):
+@app_commands.describe(kind="並び順（デフォルトは残高）")
+@app_commands.choices(kind=[
+    app_commands.Choice(name=label, value=field) for field, label in RANKING_FIELDS.items()
+])
+async def ranking_cmd(interaction: discord.Interaction, kind: str = "balance"):
     target_role_id = 1408273149199650867
     
     # 【自動削除】ロールを持っていない場合、Firestoreからその人のデータを消す
     if not any(role.id == target_role_id for role in interaction.user.roles):
-        user_doc(interaction.user.id).delete() # データを削除
+        await run_db(store.delete_user, interaction.user.id) # データを削除
+        balances.discard(interaction.user.id)
         await interaction.response.send_message("❌ 認証ロールがないため、データをリセットしました。実行できません。", ephemeral=True)
         return
 
     await interaction.response.defer(ephemeral=True)
-    users = []
-    for doc in db.collection("users").stream():
-        data = doc.to_dict()
-        users.append({**data, "user_id": int(doc.id)})
-    
-    users.sort(key=lambda x: x.get('balance', 0), reverse=True)
-    if not users:
+    board = leaderboards.get(kind, leaderboards["balance"])
+    await board.refresh_if_stale()
+    if not board.rows:
         await interaction.followup.send("データがありません。")
         return
 
-    view = RankingPagination(users, interaction.guild)
-    await interaction.followup.send(embed=view.create_embed(), view=view)
+    view = RankingPagination(board, interaction.guild)
+    await interaction.followup.send(embed=view.create_embed(await view.get_page(0)), view=view)
+
+# === 経済統計 ===
+ECONOMY_STATS_TTL = float(os.getenv("ECONOMY_STATS_TTL") or 60)
+economy_stats_cache = LRUCache(1, ttl=ECONOMY_STATS_TTL)
+
+def cached_economy_stats():
+    """集計シャードの合計（ECONOMY_STATS_TTL 秒キャッシュ。ヘルスチェックのスレッドからも呼ばれる）"""
+    totals = economy_stats_cache.get("totals")
+    if totals is None:
+        totals = store.get_economy_stats()
+        economy_stats_cache.set("totals", totals)
+    return totals
+
+@tree.command(name="経済統計", description=f"{CURRENCY_NAME}の総量・累計獲得/消費・ユーザー数（管理者）")
+@app_commands.describe(recount="users を全件読み直して集計を作り直す（重い）")
+async def economy_stats_cmd(interaction: discord.Interaction, recount: bool = False):
+    if not is_admin(interaction.user):
+        await interaction.response.send_message("管理者のみ", ephemeral=True);return
+    await interaction.response.defer(ephemeral=True)
+    if recount:
+        totals = await run_db(store.recount_economy_stats)
+        economy_stats_cache.set("totals", totals)
+    else:
+        economy_stats_cache.pop("totals")
+        totals = await run_db(cached_economy_stats)
+    users = totals["users"]
+    average = totals["supply"] // users if users else 0
+    embed = discord.Embed(title=f"{CURRENCY_NAME}経済統計" + ("（再集計）" if recount else ""))
+    embed.add_field(name="総量", value=f"{totals['supply']} {CURRENCY_NAME}", inline=False)
+    embed.add_field(name="累計獲得", value=str(totals["earned"]))
+    embed.add_field(name="累計消費", value=str(totals["spent"]))
+    embed.add_field(name="ユーザー数", value=f"{users}（平均残高 {average}）", inline=False)
+    await interaction.followup.send(embed=embed)
+
+# === プロファイラ（管理者） ===
+# 再起動せずに本番で重い処理を調べる。結果はテキストファイルで返す。
+#  cprofile: イベントループのスレッドで cProfile を動かす（コマンド・イベント処理の関数ごとの時間）
+#  sampling: 全スレッドのスタックを一定間隔で取る（保存先のスレッドプールも含む。止まっている所も分かる）
+PROFILE_MAX_SECONDS = 120
+PROFILE_SAMPLE_INTERVAL = 0.005
+PROFILE_TOP_N = 40
+profile_lock = asyncio.Lock()
+
+async def run_cprofile(seconds):
+    import cProfile, pstats  # 使う時だけ読み込む
+    profiler = cProfile.Profile()
+    profiler.enable()
+    try:
+        await asyncio.sleep(seconds)
+    finally:
+        profiler.disable()
+    out = io.StringIO()
+    out.write(f"cProfile（イベントループのスレッド, {seconds}秒）\n\n")
+    stats = pstats.Stats(profiler, stream=out)
+    stats.sort_stats("cumulative").print_stats(PROFILE_TOP_N)
+    stats.sort_stats("tottime").print_stats(PROFILE_TOP_N)
+    return out.getvalue()
+
+def frame_label(code):
+    return f"{code.co_name} ({os.path.basename(code.co_filename)}:{code.co_firstlineno})"
+
+def run_sampling_profile(seconds):
+    """全スレッドのスタックを一定間隔で取り、スレッドごとに「実行中の関数」「呼び出し中を含む関数」の上位を返す"""
+    me = threading.get_ident()
+    names = {t.ident: t.name for t in threading.enumerate()}
+    own = {}    # スレッド名 -> Counter（スタックの一番上）
+    total = {}  # スレッド名 -> Counter（スタックのどこかにある）
+    samples = 0
+    deadline = time.monotonic() + seconds
+    while time.monotonic() < deadline:
+        for thread_id, frame in sys._current_frames().items():
+            if thread_id == me:
+                continue
+            name = names.get(thread_id, str(thread_id))
+            own.setdefault(name, Counter())[frame_label(frame.f_code)] += 1
+            seen = set()
+            while frame is not None:
+                seen.add(frame_label(frame.f_code))
+                frame = frame.f_back
+            total.setdefault(name, Counter()).update(seen)
+        samples += 1
+        time.sleep(PROFILE_SAMPLE_INTERVAL)
+
+    lines = [f"サンプリング（全スレッド, {seconds}秒, {samples}回, 間隔 {PROFILE_SAMPLE_INTERVAL * 1000:.0f}ms）", ""]
+    for name in sorted(own, key=lambda n: -sum(own[n].values())):
+        lines.append(f"== {name} ==")
+        lines.append("  実行中（スタックの一番上）:")
+        for label, n in own[name].most_common(PROFILE_TOP_N // 2):
+            lines.append(f"    {n / samples:6.1%}  {label}")
+        lines.append("  呼び出し中を含む:")
+        for label, n in total[name].most_common(PROFILE_TOP_N // 2):
+            lines.append(f"    {n / samples:6.1%}  {label}")
+        lines.append("")
+    return "\n".join(lines)
+
+@tree.command(name="プロファイル", description="指定秒数だけプロファイラを動かし、重い処理をファイルで返す（管理者）")
+@app_commands.describe(seconds=f"計測する秒数（1〜{PROFILE_MAX_SECONDS}）", mode="計測の方法")
+@app_commands.choices(mode=[
+    app_commands.Choice(name="サンプリング（全スレッド）", value="sampling"),
+    app_commands.Choice(name="cProfile（イベントループ）", value="cprofile"),
+])
+async def profile_cmd(interaction: discord.Interaction, seconds: int = 10, mode: str = "sampling"):
+    if not is_admin(interaction.user):
+        await interaction.response.send_message("管理者のみ", ephemeral=True);return
+    if profile_lock.locked():
+        await interaction.response.send_message("別のプロファイルを実行中です", ephemeral=True);return
+    seconds = max(1, min(seconds, PROFILE_MAX_SECONDS))
+    await interaction.response.defer(ephemeral=True)
+    async with profile_lock:
+        if mode == "cprofile":
+            report = await run_cprofile(seconds)
+        else:
+            report = await asyncio.to_thread(run_sampling_profile, seconds)
+    summary = (
+        f"プロファイル結果（{mode}, {seconds}秒）\n"
+        f"イベントループの最大遅延: {loop_lag.max_lag:.3f}秒 / 停止検知: {stall_watchdog.stalls}回"
+    )
+    filename = f"profile_{mode}_{datetime.now():%Y%m%d_%H%M%S}.txt"
+    await interaction.followup.send(summary, file=discord.File(io.BytesIO(report.encode()), filename=filename))
     
 @tree.command(name="渡す", description=f"ユーザーに {CURRENCY_NAME} を渡す")
 @app_commands.describe(target="渡す相手", amount=f"{CURRENCY_NAME}額")
@@ -334,139 +1690,179 @@ async def transfer_cmd(interaction: discord.Interaction, target: discord.Member,
     
     # 【自動削除】
     if not any(role.id == target_role_id for role in interaction.user.roles):
-        user_doc(interaction.user.id).delete()
+        await run_db(store.delete_user, interaction.user.id)
+        balances.discard(interaction.user.id)
         await interaction.response.send_message("❌ 認証ロールがないため、データをリセットしました。", ephemeral=True)
         return
 
     if target.id == interaction.user.id or amount <= 0:
         await interaction.response.send_message("不正な指定です", ephemeral=True); return
     
-    b, _, _ = get_user_balance(interaction.user.id)
-    if b < amount:
+    # 残高の確認と両者への書き込みは1つのトランザクションで（同時に実行しても二重に使えない）
+    if not await run_db(store.transfer_balance, interaction.user.id, target.id, amount):
         await interaction.response.send_message("残高不足です", ephemeral=True); return
-
-    change_balance(interaction.user.id, amount, is_add=False)
-    change_balance(target.id, amount, is_add=True)
+    balances.changed([interaction.user.id], amount, is_add=False)
+    balances.changed([target.id], amount, is_add=True)
     
     await interaction.response.send_message(f"{target.display_name} に {amount}{CURRENCY_NAME} 渡しました", ephemeral=True)
 
+# === ページ送り ===
+# 一覧の元はどれもメモリ上のソート済みリスト（カタログ・所持アイテムのキャッシュ）なので、
+# 全件をビューに持たせず、表示のたびに1ページ分だけ切り出す（どのページへも保存先の読み込みなしで飛べる）。
+PAGE_SIZE = 10
+
+class PageView(ui.View):
+    """
+    source(offset, limit) -> (行のリスト, 全件数) と render(行のリスト, ページ, 総ページ数) -> Embed で動くページ送り（10件/ページ）
+    """
+    def __init__(self, user_id, source, render, page, max_page):
+        super().__init__(timeout=120)
+        self.user_id = user_id
+        self.source = source
+        self.render = render
+        self.set_page(page, max_page)
+
+    def set_page(self, page, max_page):
+        self.page = page
+        self.max_page = max_page
+        self.prev_button.disabled = page <= 1
+        self.next_button.disabled = page >= max_page
+
+    async def show(self, page):
+        """page ページ目の Embed を作る（その間に件数が変わっていれば端のページに寄せる）"""
+        page, max_page, rows = await fetch_page(self.source, page)
+        self.set_page(page, max_page)
+        return self.render(rows, page, max_page)
+
+    async def interaction_check(self, interaction):
+        return interaction.user.id == self.user_id
+
+    @ui.button(label="前のページ", style=discord.ButtonStyle.secondary, row=0)
+    async def prev_button(self, interaction: discord.Interaction, button: ui.Button):
+        embed = await self.show(self.page - 1)
+        await interaction.response.edit_message(embed=embed, view=self)
+
+    @ui.button(label="次のページへ", style=discord.ButtonStyle.success, row=0)
+    async def next_button(self, interaction: discord.Interaction, button: ui.Button):
+        embed = await self.show(self.page + 1)
+        await interaction.response.edit_message(embed=embed, view=self)
+
+async def fetch_page(source, page):
+    """page ページ目（範囲外なら端のページ）を切り出して (ページ, 総ページ数, 行) を返す"""
+    page = max(1, page)
+    rows, total = await source((page - 1) * PAGE_SIZE, PAGE_SIZE)
+    max_page = max(1, (total - 1) // PAGE_SIZE + 1)
+    if page > max_page:
+        page = max_page
+        rows, total = await source((page - 1) * PAGE_SIZE, PAGE_SIZE)
+    return page, max_page, rows
+
+async def send_page(interaction, source, render, page):
+    """1ページで収まる時はボタン（ビュー）を作らずに送る"""
+    page, max_page, rows = await fetch_page(source, page)
+    embed = render(rows, page, max_page)
+    if max_page <= 1:
+        await interaction.response.send_message(embed=embed, ephemeral=True)
+    else:
+        view = PageView(interaction.user.id, source, render, page, max_page)
+        await interaction.response.send_message(embed=embed, view=view, ephemeral=True)
+
+def stock_label(stock):
+    if stock == 0:
+        return "無限"
+    return "売り切れ" if stock < 0 else stock
+
+def render_shop_page(shops, page, max_page):
+    embed = discord.Embed(title="ショップ一覧", description=f"{page}/{max_page}")
+    for s in shops:
+        embed.add_field(name=s, value=s, inline=False)
+    return embed
+
 @tree.command(name="ショップ一覧", description="ショップ一覧（10件/ページ）")
 @app_commands.describe(page="ページ(デフォルト1)")
 async def shop_list_cmd(interaction, page:int=1):
-    shops = [doc.id for doc in db.collection("shops").stream()]
-    max_page = max(1,(len(shops)-1)//10+1)
-    page = max(1,min(page,max_page))
-    embed = discord.Embed(title="ショップ一覧", description=f"{page}/{max_page}")
-    start = (page-1)*10
-    for s in shops[start:start+10]:
-        embed.add_field(name=s, value=s, inline=False)
-    await interaction.response.send_message(embed=embed, ephemeral=True)
+    await send_page(interaction, catalog.shop_page, render_shop_page, page)
 
 @tree.command(name="ショップ", description="指定ショップの商品一覧（ページあり）")
 @app_commands.describe(shop_name="ショップ名", page="ページ(デフォルト1)")
 @app_commands.autocomplete(shop_name=shop_autocomplete)
 async def shop_detail_cmd(interaction, shop_name:str, page:int=1):
-    if not shop_exists(shop_name):
+    if not await shop_exists(shop_name):
         await interaction.response.send_message("ショップがありません", ephemeral=True);return
-    prods = [
-        doc.to_dict() | {"product_name":doc.id}
-        for doc in shop_doc(shop_name).collection("products").stream()
-    ]
-    max_page = max(1,(len(prods)-1)//10+1)
-    page = max(1,min(page,max_page))
-    embed = discord.Embed(title=f"{shop_name}商品一覧", description=f"{page}/{max_page}")
-    start = (page-1)*10
-    for p in prods[start:start+10]:
-        embed.add_field(
-            name=p["product_name"],
-            value=f'{p.get("description","")}\n価格:{p.get("price",0)}{CURRENCY_NAME}\n在庫:{p.get("stock",0) if p.get("stock",0)!=0 else "無限"}',
-            inline=False,
-        )
-    await interaction.response.send_message(embed=embed, ephemeral=True)
+
+    def render(prods, page, max_page):
+        embed = discord.Embed(title=f"{shop_name}商品一覧", description=f"{page}/{max_page}")
+        for p in prods:
+            embed.add_field(
+                name=p["product_name"],
+                value=f'{p.get("description","")}\n価格:{p.get("price",0)}{CURRENCY_NAME}\n在庫:{stock_label(p.get("stock",0))}',
+                inline=False,
+            )
+        return embed
+
+    await send_page(interaction, functools.partial(catalog.product_page, shop_name), render, page)
 
 @tree.command(name="買う", description="商品購入")
-@app_commands.describe(shop_name="ショップ名", product_name="商品名")
+@app_commands.describe(shop_name="ショップ名", product_name="商品名", quantity="個数(デフォルト1)")
 @app_commands.autocomplete(shop_name=shop_autocomplete, product_name=product_autocomplete)
-async def buy_cmd(interaction: discord.Interaction, shop_name: str, product_name: str):
-    doc = product_doc(shop_name, product_name).get()
-    if not doc.exists:
+async def buy_cmd(interaction: discord.Interaction, shop_name: str, product_name: str, quantity: int = 1):
+    if quantity <= 0:
+        await interaction.response.send_message("個数が不正です", ephemeral=True)
+        return
+
+    # 商品・残高の読み込みと、支払い・在庫・所持アイテムの書き込みを1つのトランザクションで
+    # （同時に買われても残高の二重使用や在庫の売り越しにならない。何個買っても読み込み1回・コミット1回）
+    result, val = await run_db(store.buy_product, interaction.user.id, shop_name, product_name, quantity)
+    if result == "missing":
         await interaction.response.send_message("その商品は存在しません", ephemeral=True)
         return
 
-    val = doc.to_dict()
-    price = val.get("price", 0)
+    cost = val.get("price", 0) * quantity
     stock = val.get("stock", 0)
-    
-    b, _, _ = get_user_balance(interaction.user.id)
-    if b < price:
-        await interaction.response.send_message(f"残高が足りません（必要: {price} {CURRENCY_NAME}）", ephemeral=True)
+    catalog.update_product(shop_name, product_name, {"stock": stock})
+    if result == "sold_out":
+        if stock > 0:
+            await interaction.response.send_message(f"在庫が足りません（残り {stock} 個）", ephemeral=True)
+        else:
+            await interaction.response.send_message("在庫切れです", ephemeral=True)
         return
-    
-    if stock != 0 and stock < 1:
-        await interaction.response.send_message("在庫切れです", ephemeral=True)
+    if result == "short":
+        await interaction.response.send_message(f"残高が足りません（必要: {cost} {CURRENCY_NAME}）", ephemeral=True)
         return
-    
-    # 購入処理
-    change_balance(interaction.user.id, price, is_add=False)
-    if stock != 0:
-        product_doc(shop_name, product_name).update({"stock": stock - 1})
-    
-    user_item_doc(interaction.user.id, shop_name, product_name).set({
-        "amount": firestore.Increment(1),
-        "shop_name": shop_name,
-        "product_name": product_name
-    }, merge=True)
-    
-    await interaction.response.send_message(f"「{product_name}」を {price} {CURRENCY_NAME} で購入しました！", ephemeral=True)
 
-class ItemListView(ui.View):
-    def __init__(self, user_id, items, page=1):
-        super().__init__(timeout=120)
-        self.user_id = user_id
-        self.items = items
-        self.page = page
-        self.max_page = max(1,(len(items)-1)//10+1)
-        if self.page > 1:
-            self.add_item(ui.Button(label="前のページ", style=discord.ButtonStyle.secondary, custom_id="prev"))
-        if self.page < self.max_page:
-            self.add_item(ui.Button(label="次のページへ", style=discord.ButtonStyle.success, custom_id="next"))
-    async def interaction_check(self, interaction):
-        return interaction.user.id == self.user_id
-    @ui.button(label="前のページ", style=discord.ButtonStyle.secondary, custom_id="prev", row=0)
-    async def prev_page(self, interaction:discord.Interaction, button:ui.Button):
-        self.page -= 1
-        await send_item_list(interaction, self.user_id, self.items, self.page)
-        self.stop()
-    @ui.button(label="次のページへ", style=discord.ButtonStyle.success, custom_id="next", row=0)
-    async def next_page(self, interaction:discord.Interaction, button:ui.Button):
-        self.page += 1
-        await send_item_list(interaction, self.user_id, self.items, self.page)
-        self.stop()
-
-async def send_item_list(interaction, user_id, items, page):
-    max_page = max(1,(len(items)-1)//10+1)
-    page = max(1,min(page,max_page))
+    balances.changed([interaction.user.id], cost, is_add=False)
+    update_inventory(interaction.user.id, shop_name, product_name, quantity)
+
+    if quantity == 1:
+        await interaction.response.send_message(f"「{product_name}」を {cost} {CURRENCY_NAME} で購入しました！", ephemeral=True)
+    else:
+        await interaction.response.send_message(
+            f"「{product_name}」を {quantity} 個、{cost} {CURRENCY_NAME} で購入しました！", ephemeral=True
+        )
+
+def render_item_page(items, page, max_page):
     embed = discord.Embed(title="所持アイテム一覧", description=f"{page}/{max_page}")
-    start = (page-1)*10
-    for itm in items[start:start+10]:
+    for itm in items:
         embed.add_field(
             name=f"{itm['product_name']}（{itm['shop_name']}）",
             value=f"個数: {itm.get('amount',0)}",
             inline=False
         )
-    view = ItemListView(user_id, items, page)
-    await interaction.response.send_message(embed=embed, view=view, ephemeral=True)
+    return embed
+
+async def send_item_list(interaction, user_id, page=1):
+    # 所持アイテムのキャッシュから切り出す（オートコンプリートで読み込み済みなら保存先は読まない）
+    async def source(offset, limit):
+        items = await get_inventory(user_id)
+        return items.page(offset, limit), len(items)
+    if not await get_inventory(user_id):
+        await interaction.response.send_message("所持アイテムはありません", ephemeral=True);return
+    await send_page(interaction, source, render_item_page, page)
 
 @tree.command(name="アイテム表示", description="所持アイテム一覧（ページング）")
 @app_commands.describe(page="ページ(デフォルト1)")
 async def item_list_cmd(interaction, page:int=1):
-    items = [
-        {**doc.to_dict(), "shop_name": doc.id.split(":")[0], "product_name":doc.id.split(":")[1]}
-        for doc in user_doc(interaction.user.id).collection("items").stream()
-    ]
-    if not items:
-        await interaction.response.send_message("所持アイテムはありません", ephemeral=True);return
-    await send_item_list(interaction, interaction.user.id, items, page)
+    await send_item_list(interaction, interaction.user.id, page)
 
 @tree.command(name="アイテム渡す", description="所持アイテムを他人に渡す")
 @app_commands.describe(target="渡す相手", item="渡すアイテム")
@@ -476,10 +1872,10 @@ async def item_transfer_cmd(interaction: discord.Interaction, target: discord.Me
     
     # 【自動削除】
     if not any(role.id == target_role_id for role in interaction.user.roles):
-        user_doc(interaction.user.id).delete()
-        # アイテムコレクションも消す場合は以下を追加
-        for sub_doc in user_doc(interaction.user.id).collection("items").stream():
-            sub_doc.reference.delete()
+        # アイテムコレクションもまとめて消す
+        await run_db(store.delete_user, interaction.user.id, with_items=True)
+        inventory_cache.pop(interaction.user.id)
+        balances.discard(interaction.user.id)
             
         await interaction.response.send_message("❌ 認証ロールがないため、全アイテムとデータを削除しました。", ephemeral=True)
         return
@@ -489,26 +1885,14 @@ async def item_transfer_cmd(interaction: discord.Interaction, target: discord.Me
     
     # (以下、元々のアイテム転送処理)
     shop_name, product_name = item.split(":", 1)
-    from_ref = user_item_doc(interaction.user.id, shop_name, product_name)
-    to_ref = user_item_doc(target.id, shop_name, product_name)
-
-    @firestore.transactional
-    def do_transfer(transaction):
-        from_snap = from_ref.get(transaction=transaction)
-        to_snap = to_ref.get(transaction=transaction)
-        if not from_snap.exists: return False
-        data = from_snap.to_dict()
-        now_amt = data.get("amount", 0)
-        if now_amt < 1: return False
-        if now_amt == 1: transaction.delete(from_ref)
-        else: transaction.update(from_ref, {"amount": now_amt - 1})
-        if to_snap.exists: transaction.update(to_ref, {"amount": to_snap.to_dict().get("amount", 0) + 1})
-        else: transaction.set(to_ref, {"amount": 1, "shop_name": shop_name, "product_name": product_name})
-        return True
 
-    if do_transfer(db.transaction()):
+    if await run_db(store.transfer_user_item, interaction.user.id, target.id, shop_name, product_name):
+        update_inventory(interaction.user.id, shop_name, product_name, -1)
+        update_inventory(target.id, shop_name, product_name, 1)
         await interaction.response.send_message(f"{target.display_name}に{product_name}を1個渡しました", ephemeral=True)
     else:
+        # キャッシュと実データがずれている可能性があるので捨てておく
+        inventory_cache.pop(interaction.user.id)
         await interaction.response.send_message("アイテムを持っていません", ephemeral=True)
 
 @tree.command(name="ログイン", description="1日1回限定！ランダムで Raruin を獲得します")
@@ -516,31 +1900,22 @@ async def login_bonus_cmd(interaction: discord.Interaction):
     user_id = interaction.user.id
     today = str(date.today())  # "2023-10-27" のような形式
     
-    # ユーザーデータを取得
-    doc_ref = user_doc(user_id)
-    doc = doc_ref.get()
-    
-    last_login = ""
-    if doc.exists:
-        last_login = doc.to_dict().get("last_login", "")
+    already = "今日のログインボーナスは既に受け取っています。また明日来てくださいね！"
 
-    # 日付チェック
-    if last_login == today:
-        await interaction.response.send_message(
-            "今日のログインボーナスは既に受け取っています。また明日来てくださいね！", 
-            ephemeral=True
-        )
+    # キャッシュで受け取り済みと分かればトランザクションまで行かない
+    data = balances.cache.get(user_id)
+    if data is not None and data.get("last_login", "") == today:
+        await interaction.response.send_message(already, ephemeral=True)
         return
 
     # 1〜10000のランダムな金額を決定
     reward = random.randint(1, 10000)
     
-    # Firestoreの更新（残高加算 + 統計更新 + ログイン日記録）
-    doc_ref.set({
-        "balance": firestore.Increment(reward),
-        "earned": firestore.Increment(reward),
-        "last_login": today
-    }, merge=True)
+    # 日付チェックと更新（残高加算 + 統計更新 + ログイン日記録）を1つのトランザクションで
+    if not await run_db(store.claim_login_bonus, user_id, reward, today):
+        await interaction.response.send_message(already, ephemeral=True)
+        return
+    balances.add(user_id, balance=reward, earned=reward, last_login=today)
 
     # 演出用のメッセージ（高額当選時に少し変えるなど）
     msg = f"ログインボーナス！ **{reward} {CURRENCY_NAME}** を獲得しました！"
@@ -551,8 +1926,24 @@ async def login_bonus_cmd(interaction: discord.Interaction):
 
     await interaction.response.send_message(msg, ephemeral=True)
 
+# === データ整理 ===
+# users をID順に少しずつ読み、認証ロールのないユーザーを BulkWriter でまとめて削除する。
+# 続けて items サブコレクションを全ユーザー分なめて、削除対象（親ドキュメントが既にない物も含む）の
+# アイテムも消す。1ページごとに maintenance/{cleanup} に進み具合を保存するので、途中で止まっても再開できる。
+CLEANUP_PAGE_SIZE = int(os.getenv("CLEANUP_PAGE_SIZE") or 300)
+
+def is_verified_member(guild, user_id_str, target_role_id):
+    """サーバーにいて認証ロールを持っているか（IDが数字でなければ触らない）"""
+    try:
+        member = guild.get_member(int(user_id_str))
+    except ValueError:
+        print(f"Error processing {user_id_str}: 不正なユーザーID")
+        return True
+    return member is not None and any(role.id == target_role_id for role in member.roles)
+
 @tree.command(name="データ整理", description="認証ロールがないユーザーのデータをFirestoreから削除します（管理者用）")
-async def cleanup_data(interaction: discord.Interaction):
+@app_commands.describe(dry_run="削除せずに対象件数だけ数える", resume="前回中断したところから再開する")
+async def cleanup_data(interaction: discord.Interaction, dry_run: bool = False, resume: bool = False):
     if not is_admin(interaction.user):
         await interaction.response.send_message("管理者限定です", ephemeral=True)
         return
@@ -561,43 +1952,151 @@ async def cleanup_data(interaction: discord.Interaction):
     
     target_role_id = 1408273149199650867
     guild = interaction.guild
-    users_ref = db.collection("users")
-    
-    deleted_count = 0
-    total_count = 0
+    checkpoint_name = "cleanup_dry_run" if dry_run else "cleanup"
 
-    # Firestoreから全ユーザーを取得
-    docs = users_ref.stream()
+    state = await run_db(store.get_checkpoint, checkpoint_name) if resume else None
+    if state is None or state.get("finished"):
+        state = {
+            "phase": "users", "cursor": None, "scanned": 0, "deleted": 0,
+            "items_scanned": 0, "items_deleted": 0, "failed": 0, "finished": False,
+        }
 
-    for doc in docs:
-        total_count += 1
-        user_id_str = doc.id
-        try:
-            user_id = int(user_id_str)
-            member = guild.get_member(user_id)
-
-            # メンバーがサーバーにいない、または特定のロールを持っていない場合
-            if member is None or not any(role.id == target_role_id for role in member.roles):
-                # Firestoreから削除
-                users_ref.document(user_id_str).delete()
-                deleted_count += 1
-        except Exception as e:
-            print(f"Error processing {user_id_str}: {e}")
+    def render(prefix):
+        mode = "（ドライラン：削除していません）" if dry_run else ""
+        return (
+            f"{prefix}{mode}\n"
+            f"チェック対象: {state['scanned']}件\n"
+            f"{'削除対象' if dry_run else '削除された'}非認証ユーザー: {state['deleted']}件\n"
+            f"アイテム: {state['items_scanned']}件中 {state['items_deleted']}件"
+            + (f"\n⚠️ 削除失敗: {state['failed']}件" if state["failed"] else "")
+        )
 
-    await interaction.followup.send(
-        f"データ整理が完了しました。\n"
-        f"チェック対象: {total_count}件\n"
-        f"削除された非認証ユーザー: {deleted_count}件", 
-        ephemeral=True
-    )
+    message = await interaction.followup.send(render("⏳ データ整理中..."), ephemeral=True, wait=True)
+    last_edit = time.monotonic()
+
+    try:
+        while not state["finished"]:
+            if state["phase"] == "users":
+                rows = await run_db(store.list_user_id_page, state["cursor"], CLEANUP_PAGE_SIZE)
+                page = [uid for uid, _ in rows]
+                targets = [(uid, data) for uid, data in rows if not is_verified_member(guild, uid, target_role_id)]
+                paths = [f"users/{uid}" for uid, _ in targets]
+                state["scanned"] += len(page)
+                state["deleted"] += len(targets)
+            else:
+                page = await run_db(store.list_item_path_page, state["cursor"], CLEANUP_PAGE_SIZE)
+                # パスは users/{user_id}/items/{shop:product}
+                paths = [
+                    p for p in page
+                    if p.startswith("users/") and not is_verified_member(guild, p.split("/")[1], target_role_id)
+                ]
+                state["items_scanned"] += len(page)
+                state["items_deleted"] += len(paths)
+
+            if paths and not dry_run:
+                failed = set(await run_db(store.delete_paths, paths))
+                state["failed"] += len(failed)
+                if state["phase"] == "users":
+                    # 集計から引くのは本当に消せた人の分だけ（消せなかった人は残っているので）
+                    totals = [user_totals(data) for uid, data in targets if f"users/{uid}" not in failed]
+                    if totals:
+                        await run_db(store.commit_economy_delta, {
+                            "supply": -sum(t[0] for t in totals), "earned": -sum(t[1] for t in totals),
+                            "spent": -sum(t[2] for t in totals), "users": -len(totals),
+                        })
+                for p in paths:
+                    user_id = p.split("/")[1]
+                    if user_id.isdigit():
+                        inventory_cache.pop(int(user_id))
+                        if len(p.split("/")) == 2:
+                            balances.discard(int(user_id))
+
+            if len(page) < CLEANUP_PAGE_SIZE:
+                # このフェーズは最後まで読んだ
+                if state["phase"] == "users":
+                    state["phase"], state["cursor"] = "items", None
+                else:
+                    state["finished"] = True
+            else:
+                state["cursor"] = page[-1]
+            await run_db(store.save_checkpoint, checkpoint_name, state)
+
+            if time.monotonic() - last_edit >= BULK_PROGRESS_INTERVAL:
+                last_edit = time.monotonic()
+                try: await message.edit(content=render("⏳ データ整理中..."))
+                except discord.HTTPException: pass
+    except Exception as e:
+        print(f"データ整理が中断されました: {e}")
+        await message.edit(content=render(f"⚠️ データ整理が中断されました（{e}）。resume:True で再開できます。"))
+        return
+
+    await message.edit(content=render("データ整理が完了しました。"))
 
 # ==============================
 # 宝くじシステム（ユニット方式・Firestore版）
 # ==============================
 
-# === 宝くじ用 Firestore ヘルパー ===
-def lottery_doc(name):
-    return db.collection("lottery_settings").document(name)
+# === 宝くじの在庫シャード ===
+# 在庫（remaining / count1..6）は親ドキュメントではなく lottery_shards/{i} に分けて持つ。
+# 購入はランダムに選んだシャード1つだけをトランザクションで更新するので、
+# 発売直後に購入が集中しても1ドキュメントへの書き込みが集中しない。
+# （"shards" を持たない古い宝くじは、親ドキュメント自体を唯一のシャードとして扱う）
+LOTTERY_SHARDS = int(os.getenv("LOTTERY_SHARDS") or 10)
+LOTTERY_VIEW_TTL = float(os.getenv("LOTTERY_VIEW_TTL") or 5)
+
+def lottery_shard_ids(setting):
+    """購入時に渡すシャード番号の一覧（"shards" を持たない古い宝くじは親ドキュメントを表す None だけ）"""
+    n = setting.get("shards", 0)
+    return list(range(n)) if n else [None]
+
+# --- 集計ビュー（オートコンプリート・残り枚数表示用） ---
+class LotteryViews:
+    """宝くじ設定とシャード残数の合計を数秒だけキャッシュする"""
+    def __init__(self):
+        self.views = {}  # name -> {"setting": dict, "shard_remaining": {i: 残り}, "remaining": 合計}
+        self.loaded_at = 0.0
+        self._lock = asyncio.Lock()
+
+    def load(self):
+        shards = store.list_lottery_shards()
+        views = {}
+        for name, setting in store.list_lotteries():
+            if setting.get("shards"):
+                shard_remaining = shards.get(name, {})
+            else:
+                shard_remaining = {0: setting.get("remaining", 0)}
+            views[name] = {
+                "setting": setting,
+                "shard_remaining": shard_remaining,
+                "remaining": sum(shard_remaining.values()),
+            }
+        self.views = views
+        self.loaded_at = time.monotonic()
+
+    async def get_all(self):
+        if time.monotonic() - self.loaded_at >= LOTTERY_VIEW_TTL:
+            async with self._lock:
+                if time.monotonic() - self.loaded_at >= LOTTERY_VIEW_TTL:
+                    await run_db(self.load)
+        return self.views
+
+    async def reload(self):
+        """期限に関係なく読み直す"""
+        async with self._lock:
+            await run_db(self.load)
+        return self.views
+
+    def invalidate(self):
+        self.loaded_at = 0.0
+
+    def consume(self, name, shard_index, n):
+        """購入した分を手元の集計から引いておく（次の読み込みまでの表示用）"""
+        view = self.views.get(name)
+        if view and shard_index in view["shard_remaining"]:
+            view["shard_remaining"][shard_index] -= n
+            view["remaining"] -= n
+
+lottery_views = LotteryViews()
 
 # === 共通関数 ===
 def today_yyyymmdd():
@@ -607,55 +2106,27 @@ def today_yyyymmdd():
 async def lottery_name_autocomplete(interaction: discord.Interaction, current: str):
     # 販売期限内かつ在庫あり
     today = today_yyyymmdd()
-    docs = db.collection("lottery_settings").stream()
     choices = []
-    for doc in docs:
-        d = doc.to_dict()
-        # 期限内かつ残数が1以上
-        if int(d.get("end_date", 0)) >= today and d.get("remaining", 0) > 0:
-            if current.lower() in doc.id.lower():
-                choices.append(app_commands.Choice(name=f"{doc.id} (残り{d['remaining']}枚)", value=doc.id))
+    for name, view in (await lottery_views.get_all()).items():
+        d = view["setting"]
+        # 期限内かつ残数が1以上（残数は全シャードの合計）
+        if int(d.get("end_date", 0) or 0) >= today and view["remaining"] > 0:
+            if current.lower() in name.lower():
+                choices.append(app_commands.Choice(name=f"{name} (残り{view['remaining']}枚)", value=name))
     return choices[:25]
 
 async def lottery_name_all_autocomplete(interaction: discord.Interaction, current: str):
     # 管理用：削除などは期限切れも含めて表示
-    docs = db.collection("lottery_settings").stream()
-    return [app_commands.Choice(name=doc.id, value=doc.id) for doc in docs if current.lower() in doc.id.lower()][:25]
+    names = list(await lottery_views.get_all())
+    return [app_commands.Choice(name=n, value=n) for n in names if current.lower() in n.lower()][:25]
 
 # === 抽選ロジック ===
-def draw_unit_lottery(setting: dict, count: int):
-    """
-    ユニット（残り本数）方式の抽選
-    """
-    results = {1:0, 2:0, 3:0, 4:0, 5:0, 6:0, "lose":0}
-    reward = 0
-    
-    # くじ箱の中身をシミュレート
-    pool = []
-    for grade in range(1, 7):
-        # DBに保存されている「各等級の残り本数」をプールに入れる
-        count_in_box = setting.get(f"count{grade}", 0)
-        pool.extend([grade] * count_in_box)
-    
-    # はずれの数を計算 (現在の総在庫 - 当たり合計)
-    current_remaining = setting.get("remaining", 0)
-    loses = max(0, current_remaining - len(pool))
-    pool.extend(["lose"] * loses)
-
-    # 購入枚数分、ランダムに重複なしで取り出す
-    my_draws = random.sample(pool, min(count, len(pool)))
-
-    for res in my_draws:
-        results[res] += 1
-        if res != "lose":
-            reward += setting.get(f"prize{res}", 0)
-
-    return results, reward
+# 抽選は lottery.draw_unit_lottery（くじ箱をリストに展開しない超幾何分布サンプリング）
 
 # === スラッシュコマンド ===
 
 @tree.command(name="宝くじ設定", description="宝くじの追加・削除（管理者専用）")
-@app_commands.describe(mode="追加 または 削除", name="宝くじ名", price="1枚の価格", total="総枚数", end_date="期限 YYYYMMDD")
+@app_commands.describe(mode="追加 または 削除", name="宝くじ名", price="1枚の価格", total="総枚数", end_date="期限 YYYYMMDD", shards="在庫の分割数（同時購入が多い時は増やす）")
 @app_commands.choices(mode=[
     app_commands.Choice(name="追加", value="add"), 
     app_commands.Choice(name="削除", value="remove")
@@ -666,14 +2137,16 @@ async def lottery_setting(
     price: int=0, total: int=0, end_date: str="",
     count1: int=0, prize1: int=0, count2: int=0, prize2: int=0,
     count3: int=0, prize3: int=0, count4: int=0, prize4: int=0,
-    count5: int=0, prize5: int=0, count6: int=0, prize6: int=0
+    count5: int=0, prize5: int=0, count6: int=0, prize6: int=0,
+    shards: int=LOTTERY_SHARDS
 ):
     if not is_admin(interaction.user):
         await interaction.response.send_message("管理者限定です", ephemeral=True); return
     await interaction.response.defer(ephemeral=True)
 
     if mode == "remove":
-        lottery_doc(name).delete()
+        await run_db(store.delete_lottery, name)
+        lottery_views.invalidate()
         await interaction.followup.send(f"宝くじ「{name}」を削除しました。")
     else:
         # 当たりの合計が総枚数を超えていないかチェック
@@ -683,13 +2156,17 @@ async def lottery_setting(
             return
 
         data = {
-            "price": price, "total": total, "remaining": total, "end_date": end_date,
+            "price": price, "total": total, "end_date": end_date,
             "count1": count1, "prize1": prize1, "count2": count2, "prize2": prize2,
             "count3": count3, "prize3": prize3, "count4": count4, "prize4": prize4,
             "count5": count5, "prize5": prize5, "count6": count6, "prize6": prize6
         }
-        lottery_doc(name).set(data)
-        await interaction.followup.send(f"宝くじ「{name}」を設定しました。\n総数: {total}枚 (1等: {count1}本) | 価格: {price}")
+        # 当たりをランダムに混ぜてシャードに配る
+        shards = max(1, min(shards, total, BATCH_LIMIT - 1))
+        shard_data = split_inventory(total, [count1, count2, count3, count4, count5, count6], shards)
+        await run_db(store.set_lottery, name, data, shard_data)
+        lottery_views.invalidate()
+        await interaction.followup.send(f"宝くじ「{name}」を設定しました。\n総数: {total}枚 (1等: {count1}本) | 価格: {price} | 分割数: {shards}")
 
 @tree.command(name="宝くじ", description="宝くじを購入して抽選します")
 @app_commands.describe(name="宝くじの種類", count="購入枚数")
@@ -700,13 +2177,10 @@ async def lottery_buy(interaction: discord.Interaction, name: str, count: int):
     
     await interaction.response.defer(ephemeral=True)
     
-    l_doc_ref = lottery_doc(name)
-    l_doc = l_doc_ref.get()
-    if not l_doc.exists:
+    setting = await run_db(store.get_lottery, name)
+    if setting is None:
         await interaction.followup.send("指定された宝くじが見つかりません。"); return
     
-    setting = l_doc.to_dict()
-    
     # 日付チェック
     try:
         if int(setting.get("end_date", 0)) < today_yyyymmdd():
@@ -714,33 +2188,54 @@ async def lottery_buy(interaction: discord.Interaction, name: str, count: int):
     except ValueError:
         pass # 日付が空などの場合
     
-    rem = setting.get("remaining", 0)
+    # 残り枚数はシャードの合計（数秒キャッシュ）。
+    # 無い・売り切れ・シャード数が違う時は、キャッシュの後に作り直された可能性があるので読み直してから判断する
+    view = (await lottery_views.get_all()).get(name)
+    if view is None or view["remaining"] <= 0 or view["setting"].get("shards") != setting.get("shards"):
+        view = (await lottery_views.reload()).get(name)
+    shard_remaining = dict(view["shard_remaining"]) if view else {}
+    rem = sum(shard_remaining.values())
     if rem <= 0:
         await interaction.followup.send("完売しました！"); return
     
+    price = setting.get("price", 0)
     buy_count = min(count, rem)
-    total_cost = buy_count * setting.get("price", 0)
+    total_cost = buy_count * price
     
-    # 残高チェック
-    balance, _, _ = get_user_balance(interaction.user.id)
+    # 残高チェック（実際の引き落としはシャードごとのトランザクション内で再確認する）
+    balance, _, _ = await balances.balance(interaction.user.id)
     if balance < total_cost:
         await interaction.followup.send(f"残高不足です。 (必要: {total_cost} {CURRENCY_NAME})"); return
 
-    # 抽選実行
-    results, reward = draw_unit_lottery(setting, buy_count)
-    
-    # DB更新：支払い
-    change_balance(interaction.user.id, total_cost, is_add=False)
-    # DB更新：当選金
-    if reward > 0:
-        change_balance(interaction.user.id, reward, is_add=True)
-    
-    # DB更新：在庫と当たり本数の更新
-    updates = {"remaining": firestore.Increment(-buy_count)}
-    for k in range(1, 7):
-        if results[k] > 0:
-            updates[f"count{k}"] = firestore.Increment(-results[k])
-    l_doc_ref.update(updates)
+    # 残り枚数に比例した確率でシャードを選び、足りなければ次のシャードへ
+    shard_ids = lottery_shard_ids(setting)
+    results = {1:0, 2:0, 3:0, 4:0, 5:0, 6:0, "lose":0}
+    reward = 0
+    bought = 0
+    while bought < buy_count:
+        candidates = [i for i, r in shard_remaining.items() if r > 0 and i < len(shard_ids)]
+        if not candidates:
+            break
+        i = random.choices(candidates, weights=[shard_remaining[c] for c in candidates])[0]
+        res = await run_db(store.buy_from_lottery_shard, name, shard_ids[i], interaction.user.id, price, buy_count - bought)
+        if res is False:
+            break  # 途中で残高が足りなくなった
+        if res is None:
+            shard_remaining[i] = 0
+            continue
+        n, shard_results, shard_reward = res
+        balances.add(interaction.user.id, balance=shard_reward - n * price, earned=shard_reward, spent=n * price)
+        shard_remaining[i] -= n
+        lottery_views.consume(name, i, n)
+        bought += n
+        reward += shard_reward
+        for k, v in shard_results.items():
+            results[k] += v
+
+    if bought == 0:
+        await interaction.followup.send("購入できませんでした（完売または残高不足）。"); return
+    buy_count = bought
+    total_cost = buy_count * price
 
     # 結果表示
     msg = f"🛒 **{name}** を {buy_count} 枚購入しました！ (合計 {total_cost} {CURRENCY_NAME})\n\n"
@@ -753,24 +2248,31 @@ async def lottery_buy(interaction: discord.Interaction, name: str, count: int):
         msg += f"・はずれ: {results['lose']}本\n"
     
     msg += f"\n💰 **合計獲得:** {reward} {CURRENCY_NAME}\n"
-    msg += f"📦 **残り在庫:** {rem - buy_count}枚"
+    msg += f"📦 **残り在庫:** {sum(shard_remaining.values())}枚"
     
     await interaction.followup.send(msg)
 
     
-    # バックアップ送信
-    backup_ch = bot.get_channel(BACKUP_CHANNEL_ID)
-    if backup_ch:
-        backup = {
-            "user_id":interaction.user.id,
-            "product_name":product_name,
-            "shop_name":shop_name,
-            "date":datetime.now().isoformat()
-        }
-        await backup_ch.send(f"【Raruin Item Used Log】\n```json\n{json.dumps(backup, ensure_ascii=False, indent=2)}\n```")
+    # バックアップ送信（数秒分まとめて送る）
+    backup = {
+        "user_id":interaction.user.id,
+        "lottery_name":name,
+        "count":buy_count,
+        "cost":total_cost,
+        "results":{str(k): v for k, v in results.items()},
+        "reward":reward,
+        "date":datetime.now().isoformat()
+    }
+    outbox.send_channel(
+        BACKUP_CHANNEL_ID,
+        f"【Raruin Lottery Log】\n```json\n{json.dumps(backup, ensure_ascii=False)}\n```",
+        delay=BACKUP_COALESCE_SECONDS
+    )
 
 # 通知を送るチャンネルID
 NOTIFICATION_CHANNEL_ID = 1458775432726839464
+VOICE_NOTIFY_DELAY = 15      # 通話通知はこの秒数ぶんまとめて送る
+BACKUP_COALESCE_SECONDS = 5  # 宝くじのバックアップログをまとめる秒数
 
 # --- メッセージ報酬の処理 ---
 @bot.event
@@ -780,83 +2282,247 @@ async def on_message(message):
         # 文字数(len)を取得して 1文字 = 1 Raruin 付与
         msg_reward = len(message.content)
         if msg_reward > 0:
-            change_balance(message.author.id, msg_reward, is_add=True)
+            # 即書き込まずにバッファへ（まとめて書き込まれる）
+            reward_buffer.add(message.author.id, msg_reward)
     
     # スラッシュコマンドを正常に動作させるために必須
     await bot.process_commands(message)
 
 # --- 通話報酬の処理（通話通知のみスパム対策版） ---
-voice_times = {}
-voice_notification_queue = []  # 通知を溜めるリスト
-is_voice_queue_running = False # タイマーが動いているかどうかのフラグ
+# 退出時にまとめて払うのではなく、VOICE_TICK_SECONDS ごとに経過した分（1分単位）を払い、
+# 同じバッチで開いているセッションを voice_sessions に保存する。
+# 再起動しても保存済みのセッションとボイスチャンネルの状態から続きを再開できる。
+VOICE_TICK_SECONDS = float(os.getenv("VOICE_TICK_SECONDS") or 60)
+VOICE_REWARD_PER_MINUTE = 60
 
-async def send_voice_notifications(channel):
-    """15秒後にまとめて通知を送る関数"""
-    global voice_notification_queue, is_voice_queue_running
-    
-    # 15秒待機（この間に他の人が抜けてもキューに溜まる）
-    await asyncio.sleep(15)
-    
-    if voice_notification_queue:
-        # メッセージを改行で結合して1つのメッセージにする
-        content = "\n".join(voice_notification_queue)
-        
-        # 文字数制限対策 (念のため1900文字でカット)
-        if len(content) > 1900:
-            content = content[:1900] + "\n...(他多数)"
-            
-        try:
-            await channel.send(content)
-        except Exception as e:
-            print(f"通話通知の送信に失敗: {e}")
-            
-        # 送信したらリストを空にする
-        voice_notification_queue = []
-        
-    # フラグを下ろす（次の通知待ちを受け付けられるようにする）
-    is_voice_queue_running = False
+class VoiceSession:
+    __slots__ = ("user_id", "guild_id", "channel_id", "joined_at", "paid_until", "paid_minutes", "dirty")
+
+    def __init__(self, user_id, guild_id, channel_id, joined_at, paid_until=None, paid_minutes=0):
+        self.user_id = user_id
+        self.guild_id = guild_id
+        self.channel_id = channel_id
+        self.joined_at = joined_at
+        self.paid_until = joined_at if paid_until is None else paid_until
+        self.paid_minutes = paid_minutes
+        self.dirty = True  # 保存されていない変更があるか
+
+    @property
+    def doc_id(self):
+        return f"{self.guild_id}_{self.user_id}"
+
+    def due_minutes(self, now):
+        """paid_until から now までの未払いの分数（1分単位）"""
+        return max(0, int((now - self.paid_until) // 60))
+
+    def mark_paid(self, minutes):
+        self.paid_until += minutes * 60
+        self.paid_minutes += minutes
+
+    def to_dict(self, extra_minutes=0):
+        """extra_minutes 分を払った後の状態（書き込みが成功してから mark_paid する）"""
+        return {
+            "user_id": self.user_id, "guild_id": self.guild_id, "channel_id": self.channel_id,
+            "joined_at": self.joined_at, "paid_until": self.paid_until + extra_minutes * 60,
+            "paid_minutes": self.paid_minutes + extra_minutes,
+        }
+
+    @classmethod
+    def from_dict(cls, d):
+        return cls(d["user_id"], d["guild_id"], d.get("channel_id"), d["joined_at"], d["paid_until"], d.get("paid_minutes", 0))
+
+class VoiceTracker:
+    def __init__(self):
+        self.sessions = {}  # (guild_id, user_id) -> VoiceSession
+        self.closing = {}   # doc_id -> (VoiceSession, 未払いの分数)：退出時に書き込めず、次の tick で再送する分
+        self.restored = False
+        self._lock = asyncio.Lock()
+        self._stopping = asyncio.Event()
+        self._task = None
+
+    def join(self, member, channel):
+        key = (member.guild.id, member.id)
+        if key not in self.sessions:
+            self.sessions[key] = VoiceSession(member.id, member.guild.id, channel.id, time.time())
+
+    async def leave(self, member):
+        """退出：残りの分を払ってセッションを閉じる。通話した合計分数を返す"""
+        async with self._lock:
+            session = self.sessions.pop((member.guild.id, member.id), None)
+            if session is None:
+                return 0
+            minutes = session.due_minutes(time.time())
+            payouts = [(session.user_id, minutes * VOICE_REWARD_PER_MINUTE)] if minutes else []
+            try:
+                await run_db(store.commit_voice_tick, payouts, [], [session.doc_id])
+                for user_id, reward in payouts:
+                    balances.add(user_id, balance=reward, earned=reward)
+            except Exception as e:
+                # 報酬とチェックポイントの削除は必ず一緒に書く（片方だけだと、再起動後に同じ分をもう一度払ってしまう）。
+                # 書き込めなかった分は次の tick でまとめて再送する
+                print(f"通話報酬の書き込みに失敗（次の定期書き込みで再送）: {e}")
+                self.closing[session.doc_id] = (session, minutes)
+                return session.paid_minutes + minutes
+            session.mark_paid(minutes)
+            return session.paid_minutes
+
+    async def _retry_closing(self):
+        """退出時に書き込めなかったセッションの報酬と削除を再送する"""
+        pending = list(self.closing.items())
+        active = {s.doc_id for s in self.sessions.values()}
+        step = (BATCH_LIMIT - 1) // 2
+        for i in range(0, len(pending), step):
+            chunk = pending[i:i + step]
+            payouts = [(s.user_id, m * VOICE_REWARD_PER_MINUTE) for _, (s, m) in chunk if m]
+            # 再送を待つ間に入り直した人のチェックポイントは新しいセッションの物なので消さない
+            closed = [doc_id for doc_id, _ in chunk if doc_id not in active]
+            await run_db(store.commit_voice_tick, payouts, [], closed)
+            for user_id, reward in payouts:
+                balances.add(user_id, balance=reward, earned=reward)
+            for doc_id, (s, m) in chunk:
+                s.mark_paid(m)
+                del self.closing[doc_id]
+
+    async def tick(self):
+        """経過分の支払いと、変更のあったセッションの保存をバッチで書く"""
+        async with self._lock:
+            if self.closing:
+                await self._retry_closing()
+            now = time.time()
+            changed = []
+            for session in self.sessions.values():
+                minutes = session.due_minutes(now)
+                if minutes or session.dirty:
+                    changed.append((session, minutes))
+            # 1人あたり「報酬」と「チェックポイント」の2件（+ 集計1件）
+            step = (BATCH_LIMIT - 1) // 2
+            for i in range(0, len(changed), step):
+                chunk = changed[i:i + step]
+                payouts = [(s.user_id, m * VOICE_REWARD_PER_MINUTE) for s, m in chunk if m]
+                checkpoints = [(s.doc_id, s.to_dict(m)) for s, m in chunk]
+                await run_db(store.commit_voice_tick, payouts, checkpoints, [])
+                for user_id, reward in payouts:
+                    balances.add(user_id, balance=reward, earned=reward)
+                for s, m in chunk:
+                    s.mark_paid(m)
+                    s.dirty = False
+
+    async def _run(self):
+        while not self._stopping.is_set():
+            try:
+                await asyncio.wait_for(self._stopping.wait(), timeout=VOICE_TICK_SECONDS)
+                return
+            except asyncio.TimeoutError:
+                pass
+            try:
+                await self.tick()
+            except Exception as e:
+                print(f"通話報酬の定期書き込みに失敗: {e}")
+
+    def start(self):
+        if self._task is None:
+            self._task = asyncio.create_task(self._run())
+
+    async def stop(self):
+        """定期書き込みを止めて最後の分を払う（シャットダウン時）"""
+        if self._task:
+            # キャンセルはしない（コミット済みで支払い済みの印を付ける前の tick を捨てると、最後の tick で同じ分をもう一度払う）。
+            # 止まるよう知らせて、書き込み中の tick が終わるのを待ってから締める
+            self._stopping.set()
+            await self._task
+            self._task = None
+        await self.tick()
+
+    async def restore(self, guilds):
+        """保存済みセッションと、いまボイスチャンネルにいるメンバーを突き合わせて状態を作り直す"""
+        async with self._lock:
+            if not self.restored:
+                for d in await run_db(store.list_voice_checkpoints):
+                    # 他のシャードのギルドの分は、そのシャードのプロセスが復元する
+                    if not owns_guild(d["guild_id"]):
+                        continue
+                    session = VoiceSession.from_dict(d)
+                    session.dirty = False
+                    self.sessions.setdefault((session.guild_id, session.user_id), session)
+                self.restored = True
+
+            in_voice = {}
+            for guild in guilds:
+                for channel in guild.voice_channels + list(getattr(guild, "stage_channels", [])):
+                    for member in channel.members:
+                        in_voice[(guild.id, member.id)] = channel.id
+            now = time.time()
+            closed = []
+            for key, session in list(self.sessions.items()):
+                if key not in in_voice:
+                    # いない間に退出していた：退出時刻が分からないので前回の支払いまでで締める
+                    del self.sessions[key]
+                    closed.append(session.doc_id)
+            for key, channel_id in in_voice.items():
+                if key not in self.sessions:
+                    self.sessions[key] = VoiceSession(key[1], key[0], channel_id, now)
+                else:
+                    # 保存時から今までずっと通話していたものとして続きから数える
+                    self.sessions[key].channel_id = channel_id
+            for i in range(0, len(closed), BATCH_LIMIT):
+                await run_db(store.commit_voice_tick, [], [], closed[i:i + BATCH_LIMIT])
+        print(f"通話セッションを復元しました: {len(self.sessions)}件（終了扱い {len(closed)}件）")
+
+voice_tracker = VoiceTracker()
 
 @bot.event
 async def on_voice_state_update(member, before, after):
-    global is_voice_queue_running
-
     # --- 入室時の処理 ---
     if not before.channel and after.channel:
-        voice_times[member.id] = datetime.now()
+        voice_tracker.join(member, after.channel)
         print(f"[DEBUG] {member.display_name} が入室しました")
 
     # --- 退出時の処理 ---
     elif before.channel and not after.channel:
-        join_time = voice_times.pop(member.id, None)
-        if join_time:
-            leave_time = datetime.now()
-            diff = leave_time - join_time
-            seconds = diff.total_seconds()
-            minutes = int(seconds // 60)
+        minutes = await voice_tracker.leave(member)
+        print(f"[DEBUG] {member.display_name}: 通話時間 {minutes}分と判定")
+
+        if minutes >= 1:
+            reward = minutes * VOICE_REWARD_PER_MINUTE
             
-            print(f"[DEBUG] {member.display_name}: 通話時間 {seconds:.1f}秒 -> {minutes}分と判定")
-
-            if minutes >= 1:
-                reward = minutes * 60
-                change_balance(member.id, reward, is_add=True)
-                
-                # --- 即送信せずリストに入れる ---
-                msg = f"🎙️ {member.mention} が {minutes}分間の通話で {reward} {CURRENCY_NAME} を獲得しました！"
-                voice_notification_queue.append(msg)
-                
-                # もしタイマーが動いていなければ、タイマーを起動する（最初の1人が抜けた時だけ動く）
-                if not is_voice_queue_running:
-                    channel = bot.get_channel(NOTIFICATION_CHANNEL_ID)
-                    if channel:
-                        is_voice_queue_running = True
-                        asyncio.create_task(send_voice_notifications(channel))
-            else:
-                print(f"[DEBUG] 1分未満のため報酬なし")
+            # --- 即送信せず、VOICE_NOTIFY_DELAY 秒の間に抜けた人の分とまとめて送る ---
+            msg = f"🎙️ {member.mention} が {minutes}分間の通話で {reward} {CURRENCY_NAME} を獲得しました！"
+            outbox.send_channel(NOTIFICATION_CHANNEL_ID, msg, delay=VOICE_NOTIFY_DELAY)
+        else:
+            print(f"[DEBUG] 1分未満のため報酬なし")
+
+    # --- チャンネル移動 ---
+    elif before.channel and after.channel:
+        session = voice_tracker.sessions.get((member.guild.id, member.id))
+        if session is not None and session.channel_id != after.channel.id:
+            session.channel_id = after.channel.id
+            session.dirty = True
 
 # === リアクション報酬設定 ===
 TARGET_CHANNEL_ID = 1452296570295816253  # 指定されたチャンネルID
 TARGET_EMOJI = "😎"  # 判定する絵文字
 
+# 同じ投稿へのリアクションのたびに fetch_message しないよう、投稿者IDを覚えておく
+message_author_cache = LRUCache(int(os.getenv("REACTION_AUTHOR_CACHE_SIZE") or 2000))
+# 付与済み（または付与を試みた）「メッセージ_ユーザー」の組
+reaction_seen = LRUCache(int(os.getenv("REACTION_SEEN_CACHE_SIZE") or 50000))
+
+async def get_message_author_id(payload):
+    # discord.py 2.4 以降はイベントに投稿者IDが入っている
+    author_id = getattr(payload, "message_author_id", None)
+    if author_id is not None:
+        return author_id
+    author_id = message_author_cache.get(payload.message_id)
+    if author_id is None:
+        channel = bot.get_channel(payload.channel_id)
+        try:
+            message = await channel.fetch_message(payload.message_id)
+        except Exception:
+            return None # メッセージが見つからない場合
+        author_id = message.author.id
+        message_author_cache.set(payload.message_id, author_id)
+    return author_id
+
 @bot.event
 async def on_raw_reaction_add(payload):
     # 指定のチャンネル以外は無視
@@ -876,54 +2542,61 @@ async def on_raw_reaction_add(payload):
     if not member or member.bot:
         return
 
-    # メッセージを取得
-    channel = bot.get_channel(payload.channel_id)
-    try:
-        message = await channel.fetch_message(payload.message_id)
-    except:
-        return # メッセージが見つからない場合
-
-    # メッセージの送信者が管理者（is_admin）かチェック
-    if not is_admin(message.author):
-        return
-
-    # 重複付与の防止（Firestoreで管理）
+    # このプロセスで既に処理した組み合わせは何もしない
     reward_id = f"{payload.message_id}_{payload.user_id}"
-    reward_ref = db.collection("reaction_rewards").document(reward_id)
+    if reaction_seen.get(reward_id):
+        return
 
-    if reward_ref.get().exists:
+    # メッセージの送信者が管理者かチェック（投稿者IDはキャッシュ）
+    author_id = await get_message_author_id(payload)
+    if author_id is None or author_id not in ADMIN_IDS:
         return
 
     # 1〜100,000 Raruinをランダムに決定
     reward_amount = random.randint(1, 100000)
 
-    # 報酬を付与
-    change_balance(payload.user_id, reward_amount, is_add=True)
-
-    # 付与済みフラグをDBに保存
-    reward_ref.set({
+    # 報酬の付与と付与済みフラグの作成を1回の書き込みで（重複付与の防止もここで）
+    granted = await run_db(store.grant_reaction_reward, reward_id, payload.user_id, reward_amount, {
         "user_id": payload.user_id,
         "message_id": payload.message_id,
         "amount": reward_amount,
         "timestamp": datetime.now()
     })
+    reaction_seen.set(reward_id, True)
+    if not granted:
+        return
+    balances.add(payload.user_id, balance=reward_amount, earned=reward_amount)
 
     # 【修正】DMをやめて指定チャンネルに通知
-    notify_channel = bot.get_channel(NOTIFICATION_CHANNEL_ID)
-    if notify_channel:
-        try:
-            await notify_channel.send(f"📸 {member.mention} が撮影に参加して {reward_amount} {CURRENCY_NAME} を獲得しました！")
-        except Exception as e:
-            print(f"通知送信エラー: {e}")
+    outbox.send_channel(NOTIFICATION_CHANNEL_ID, f"📸 {member.mention} が撮影に参加して {reward_amount} {CURRENCY_NAME} を獲得しました！")
 
-import os
-import threading
-from http.server import HTTPServer, BaseHTTPRequestHandler
 
 # --- 最軽量のWebサーバー設定 ---
 class HealthCheckHandler(BaseHTTPRequestHandler):
     def do_GET(self):
         """ブラウザや通常のアクセス用"""
+        if self.path == "/metrics":
+            body = REGISTRY.render().encode()
+            self.send_response(200)
+            self.send_header("Content-Type", "text/plain; version=0.0.4; charset=utf-8")
+            self.end_headers()
+            self.wfile.write(body)
+            return
+        if self.path == "/stats":
+            body = json.dumps({
+                "rewards": reward_buffer.stats(),
+                "catalog": catalog.stats(),
+                "inventory_cache": inventory_cache.stats(),
+                "balance_cache": balances.stats(),
+                "outbox": outbox.stats(),
+                "economy": cached_economy_stats(),
+                "shards": {"count": bot.shard_count, "ids": sorted(bot.shards), "guilds": len(bot.guilds)},
+            }, ensure_ascii=False).encode()
+            self.send_response(200)
+            self.send_header("Content-Type", "application/json; charset=utf-8")
+            self.end_headers()
+            self.wfile.write(body)
+            return
         self.send_response(200)
         self.end_headers()
         self.wfile.write(b"Bot is active")
@@ -953,7 +2626,7 @@ if __name__ == "__main__":
     
     # 2. その後にBotをログインさせる
     try:
-        # ※注意: 上の方で bot = commands.Bot(...) と書いているなら bot.run
+        # ※注意: 上の方で bot = commands.AutoShardedBot(...) と書いているなら bot.run
         # もし client = ... と書いているなら client.run にしてください
         bot.run(TOKEN) 
     except Exception as e:
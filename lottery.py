@@ -0,0 +1,113 @@
+"""
+宝くじの抽選エンジン
+
+くじ箱を1枚ずつのリストに展開してから random.sample するのではなく、
+等級ごとの残り本数から多変量超幾何分布を直接サンプルする。
+結果の分布は「箱から非復元で引く」のと同じで、メモリと時間は等級数に比例する。
+"""
+import math
+import random
+
+GRADES = (1, 2, 3, 4, 5, 6)
+
+def _log_comb(n, k):
+    return math.lgamma(n + 1) - math.lgamma(k + 1) - math.lgamma(n - k + 1)
+
+def hypergeometric(ngood, nbad, nsample, rng=random):
+    """
+    当たり ngood 本・はずれ nbad 本の箱から nsample 本を非復元で引いた時の当たり本数
+    （最頻値から左右交互に確率を引いていく逆関数法。平均の手数は標準偏差程度）
+    """
+    if nsample <= 0 or ngood <= 0:
+        return 0
+    if nbad <= 0:
+        return min(nsample, ngood)
+    total = ngood + nbad
+    if nsample >= total:
+        return ngood
+    lo = max(0, nsample - nbad)
+    hi = min(nsample, ngood)
+    if lo == hi:
+        return lo
+
+    mode = (nsample + 1) * (ngood + 1) // (total + 2)
+    mode = min(max(mode, lo), hi)
+    p_mode = math.exp(
+        _log_comb(ngood, mode) + _log_comb(nbad, nsample - mode) - _log_comb(total, nsample)
+    )
+    u = rng.random() - p_mode
+    if u <= 0:
+        return mode
+
+    x_lo = x_hi = mode
+    p_lo = p_hi = p_mode
+    while x_lo > lo or x_hi < hi:
+        if x_lo > lo:
+            # p(x-1) / p(x)
+            p_lo *= x_lo * (nbad - nsample + x_lo) / ((ngood - x_lo + 1) * (nsample - x_lo + 1))
+            x_lo -= 1
+            u -= p_lo
+            if u <= 0:
+                return x_lo
+        if x_hi < hi:
+            # p(x+1) / p(x)
+            p_hi *= (ngood - x_hi) * (nsample - x_hi) / ((x_hi + 1) * (nbad - nsample + x_hi + 1))
+            x_hi += 1
+            u -= p_hi
+            if u <= 0:
+                return x_hi
+    # 丸め誤差で確率の合計がわずかに1に届かなかった場合
+    return mode
+
+def multivariate_hypergeometric(counts, nsample, rng=random):
+    """
+    各クラスの本数 counts の箱から nsample 本を非復元で引いた時の、クラスごとの本数
+    （1クラスずつ「そのクラス」対「残り全部」の超幾何分布で順に決めていく）
+    """
+    remaining = sum(counts)
+    n = min(nsample, remaining)
+    result = []
+    for i, c in enumerate(counts):
+        remaining -= c
+        if i == len(counts) - 1:
+            x = n
+        else:
+            x = hypergeometric(c, remaining, n, rng)
+        result.append(x)
+        n -= x
+    return result
+
+def draw_unit_lottery(setting: dict, count: int, rng=random):
+    """
+    ユニット（残り本数）方式の抽選
+    """
+    counts = [max(0, setting.get(f"count{grade}", 0)) for grade in GRADES]
+    # はずれの数を計算 (現在の総在庫 - 当たり合計)
+    loses = max(0, setting.get("remaining", 0) - sum(counts))
+
+    drawn = multivariate_hypergeometric(counts + [loses], count, rng)
+
+    results = {grade: drawn[i] for i, grade in enumerate(GRADES)}
+    results["lose"] = drawn[-1]
+    reward = sum(results[grade] * setting.get(f"prize{grade}", 0) for grade in GRADES)
+    return results, reward
+
+def split_inventory(total: int, counts, shards: int, rng=random):
+    """
+    くじ箱（総数 total、当たり本数 counts）を shards 個の小箱にランダムに分ける。
+    各小箱の枚数はほぼ均等で、当たりの入り方は箱をシャッフルして配ったのと同じ分布になる。
+    残り枚数に比例した確率で小箱を選んでから引けば、元の箱から引くのと同じ結果になる。
+    """
+    counts = [max(0, c) for c in counts]
+    box = counts + [max(0, total - sum(counts))]
+    base, extra = divmod(sum(box), shards)
+    result = []
+    for i in range(shards):
+        size = base + (1 if i < extra else 0)
+        drawn = multivariate_hypergeometric(box, size, rng)
+        box = [b - d for b, d in zip(box, drawn)]
+        shard = {"remaining": size}
+        for grade, n in zip(GRADES, drawn):
+            shard[f"count{grade}"] = n
+        result.append(shard)
+    return result
@@ -0,0 +1,57 @@
+"""
+複数のワーカープロセスでシャードを分け合って Bot を起動する（ローカルでの動作確認用）
+
+    python run_shards.py 4              # 4プロセス × 1シャード
+    python run_shards.py 2 --shards 8   # 8シャードを2プロセスで（1プロセス4シャード）
+
+各ワーカーには SHARD_COUNT / SHARD_IDS / PORT（--port から1つずつずらす）を渡す。
+保存先は指定がなければ SQLite（SQLITE_PATH のファイルを全ワーカーで共有し、SQLITE_WATCH=1 でキャッシュを追従させる）。
+Ctrl+C / SIGTERM は全ワーカーに伝え、全員の終了（残りの書き込み）を待つ。
+"""
+import argparse
+import os
+import signal
+import subprocess
+import sys
+
+BOT_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), "bot.py")
+
+def main():
+    parser = argparse.ArgumentParser(description="シャードを分けて複数のワーカーを起動する")
+    parser.add_argument("workers", type=int, help="ワーカープロセスの数")
+    parser.add_argument("--shards", type=int, default=0, help="全体のシャード数（デフォルトはワーカー数）")
+    parser.add_argument("--port", type=int, default=int(os.getenv("PORT") or 10000), help="1つ目のワーカーのポート")
+    args = parser.parse_args()
+
+    shard_count = args.shards or args.workers
+    if shard_count < args.workers:
+        parser.error("シャード数はワーカー数以上にしてください")
+
+    base_env = dict(os.environ)
+    base_env.setdefault("STORAGE_BACKEND", "sqlite")
+    if base_env["STORAGE_BACKEND"] == "sqlite":
+        base_env["SQLITE_WATCH"] = "1"
+        # 最初に1回開いてスキーマとトリガーを作り、watch の設定をファイルに記録しておく（ワーカーが同時に作りに行かないよう）
+        from storage import SQLiteStorage
+        SQLiteStorage(base_env.get("SQLITE_PATH") or "raruin.db", watch=True).close()
+
+    procs = []
+    for i in range(args.workers):
+        shard_ids = [s for s in range(shard_count) if s % args.workers == i]
+        env = dict(base_env, SHARD_COUNT=str(shard_count), SHARD_IDS=",".join(map(str, shard_ids)),
+                   PORT=str(args.port + i))
+        print(f"ワーカー{i}: シャード {shard_ids} / ポート {args.port + i}")
+        procs.append(subprocess.Popen([sys.executable, BOT_PATH], env=env))
+
+    def forward(signum, frame):
+        for proc in procs:
+            if proc.poll() is None:
+                proc.send_signal(signal.SIGTERM)
+    signal.signal(signal.SIGTERM, forward)
+    signal.signal(signal.SIGINT, forward)
+
+    codes = [proc.wait() for proc in procs]
+    sys.exit(max(codes, default=0))
+
+if __name__ == "__main__":
+    main()
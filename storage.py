@@ -0,0 +1,1260 @@
+"""
+データの保存先（Firestore / SQLite）
+
+bot.py はここの Storage を通してだけデータを読み書きする。
+STORAGE_BACKEND=firestore（デフォルト）なら Firestore、sqlite なら SQLITE_PATH のファイルを使う。
+SQLite は WAL モードの1ファイルで、Google の認証情報なしに1サーバー規模の運用・テスト・ベンチマークができる。
+SQLITE_WATCH=1 にすると変更を change_log に記録し、同じファイルを使う複数プロセス（シャードごとのワーカー）の
+キャッシュを Firestore の on_snapshot と同じように追従させる。この設定はファイル（maintenance 表）に残り、
+後から SQLITE_WATCH なしで開いたプロセスも同じように記録・追従する。
+メソッドはすべて同期なので、bot.py からは run_db(store.xxx, ...) でスレッドプール上で呼ぶ。
+"""
+import json
+import os
+import random
+import sqlite3
+import threading
+
+from lottery import GRADES, draw_unit_lottery
+
+BATCH_LIMIT = 500  # Firestore の1バッチあたりの書き込み上限
+RESET_FIELDS = {"balance": 1000, "earned": 0, "spent": 0}
+RANKING_COLUMNS = ("balance", "earned", "spent")
+ECONOMY_FIELDS = ("supply", "earned", "spent", "users")
+
+def user_totals(data):
+    """ユーザーのデータを集計用の (balance, earned, spent) にする"""
+    if data is None:
+        return 0, 0, 0
+    return int(data.get("balance", 0)), int(data.get("earned", 0)), int(data.get("spent", 0))
+
+def balance_change_delta(amount, is_add=True):
+    """残高の加算・減算に対応する集計の増減"""
+    if is_add:
+        return {"supply": amount, "earned": amount}
+    return {"supply": -amount, "spent": amount}
+
+def reset_delta(before):
+    """リセット前のユーザーデータ（無ければ None）の並びから、リセットによる集計の増減を計算する"""
+    supply = earned = spent = users = 0
+    for data in before:
+        b, e, sp = user_totals(data)
+        supply += RESET_FIELDS["balance"] - b
+        earned -= e
+        spent -= sp
+        users += 0 if data is not None else 1
+    return {"supply": supply, "earned": earned, "spent": spent, "users": users}
+
+PRIZE_KEYS = tuple(f"prize{k}" for k in GRADES)
+
+def lottery_prizes(setting):
+    """設定の当選金（prize1..6）。シャードにも同じ値を持たせ、抽選のたびに親の設定を読まずに済ませる"""
+    return {key: setting.get(key, 0) for key in PRIZE_KEYS}
+
+def apply_lottery_draw(shard, n):
+    """シャードの在庫から n 枚を抽選し、(結果, 当選金, 在庫の更新内容) を返す"""
+    results, reward = draw_unit_lottery(shard, n)
+    updates = {"remaining": shard.get("remaining", 0) - n}
+    for k in GRADES:
+        if results[k] > 0:
+            updates[f"count{k}"] = shard.get(f"count{k}", 0) - results[k]
+    return results, reward, updates
+
+SOLD_OUT = -1  # 商品の在庫 0 は「無制限」なので、売り切れは -1 で表す
+
+def take_stock(stock, quantity):
+    """在庫から quantity 個を引いた後の在庫（足りなければ None）"""
+    if stock == 0:
+        return 0
+    if stock < quantity:
+        return None
+    return stock - quantity or SOLD_OUT
+
+def item_path(user_id, shop_name, product_name):
+    return f"users/{user_id}/items/{shop_name}:{product_name}"
+
+def open_storage(backend=None):
+    """環境変数 STORAGE_BACKEND（firestore / sqlite）に応じた Storage を作る"""
+    backend = (backend or os.getenv("STORAGE_BACKEND") or "firestore").lower()
+    if backend == "sqlite":
+        return SQLiteStorage(os.getenv("SQLITE_PATH") or "raruin.db", watch=os.getenv("SQLITE_WATCH") == "1")
+    if backend == "firestore":
+        return FirestoreStorage()
+    raise ValueError(f"不明な STORAGE_BACKEND: {backend}")
+
+# ==============================
+# Firestore
+# ==============================
+firestore = None
+AlreadyExists = None
+
+def _load_firestore():
+    """google-cloud-firestore は Firestore を使う時だけ読み込む"""
+    global firestore, AlreadyExists
+    from google.cloud import firestore
+    from google.api_core.exceptions import AlreadyExists
+
+class FirestoreStorage:
+    name = "firestore"
+
+    # 全ユーザーの balance / earned / spent の合計を economy_stats/{0..N-1} に分けて持つ。
+    # 残高を書き換える処理は同じバッチ／トランザクションでランダムな1シャードにも Increment を積むので、
+    # 集計は users を全件読まずに N 件の読み込みで分かる。
+    # ユーザー数は積まない: 報酬・配布の Increment（merge）はドキュメントを読まずに作るので、
+    # 新しく作られたかが分からない。代わりに読む時に users を count() で数える（1000件ごとに1読み込み）。
+    # シャード数の決め方: 1ドキュメントへの書き込みは持続して毎秒1回程度が目安なので、
+    # 残高を書き換える処理（購入・送金・宝くじ・リアクション・通話・一括処理のバッチ）の
+    # ピーク時の毎秒回数より十分多くする。デフォルトの100で毎秒数十回まで。
+    # 読むのは /経済統計 と /stats の時だけ（ECONOMY_STATS_TTL でキャッシュ）なので、N 件読みの負担は小さい。
+    # recount は全シャードを1バッチで書くので BATCH_LIMIT - 1 件まで。
+    ECONOMY_SHARDS = min(int(os.getenv("ECONOMY_SHARDS") or 100), BATCH_LIMIT - 1)
+
+    def __init__(self, client=None):
+        _load_firestore()
+        self.db = client or firestore.Client()
+
+    # --- ドキュメントの場所 ---
+    def user_doc(self, user_id):
+        return self.db.collection("users").document(str(user_id))
+    def shop_doc(self, shop_name):
+        return self.db.collection("shops").document(shop_name)
+    def product_doc(self, shop_name, product_name):
+        return self.shop_doc(shop_name).collection("products").document(product_name)
+    def user_item_doc(self, user_id, shop_name, product_name):
+        return self.user_doc(user_id).collection("items").document(f"{shop_name}:{product_name}")
+    def lottery_doc(self, name):
+        return self.db.collection("lottery_settings").document(name)
+    def lottery_shard_doc(self, name, index):
+        # index が None なら "shards" を持たない古い宝くじ（親ドキュメント自体が唯一のシャード）
+        if index is None:
+            return self.lottery_doc(name)
+        return self.lottery_doc(name).collection("lottery_shards").document(str(index))
+
+    # --- 経済全体の集計 ---
+    def economy_shard_doc(self, index=None):
+        if index is None:
+            index = random.randrange(self.ECONOMY_SHARDS)
+        return self.db.collection("economy_stats").document(str(index))
+
+    def add_economy_delta(self, writer, supply=0, earned=0, spent=0, users=0):
+        """集計シャードへの加算を writer（バッチ or トランザクション）に積む（users は数えないので無視する）"""
+        fields = {
+            name: firestore.Increment(value)
+            for name, value in (("supply", supply), ("earned", earned), ("spent", spent))
+            if value
+        }
+        if fields:
+            writer.set(self.economy_shard_doc(), fields, merge=True)
+
+    def commit_economy_delta(self, delta):
+        batch = self.db.batch()
+        self.add_economy_delta(batch, **delta)
+        batch.commit()
+
+    def get_economy_stats(self):
+        """全シャードを足し合わせた集計（ECONOMY_SHARDS 件の読み込み）と users の件数"""
+        totals = dict.fromkeys(ECONOMY_FIELDS, 0)
+        for doc in self.db.collection("economy_stats").stream():
+            for key, value in doc.to_dict().items():
+                if key in totals and key != "users":
+                    totals[key] += int(value)
+        totals["users"] = self.count_users()
+        return totals
+
+    def count_users(self):
+        """users の件数（count() の集計クエリなので、ドキュメントは読まずに1000件ごとに1読み込み）"""
+        return int(self.db.collection("users").count().get()[0][0].value)
+
+    def recount_economy_stats(self):
+        """users を全件読み直して集計を作り直す（ずれた時の管理用）"""
+        totals = dict.fromkeys(ECONOMY_FIELDS, 0)
+        for doc in self.db.collection("users").stream():
+            b, e, sp = user_totals(doc.to_dict())
+            totals["supply"] += b
+            totals["earned"] += e
+            totals["spent"] += sp
+            totals["users"] += 1
+        sums = {key: totals[key] for key in ("supply", "earned", "spent")}
+        batch = self.db.batch()
+        batch.set(self.economy_shard_doc(0), sums)
+        for i in range(1, self.ECONOMY_SHARDS):
+            batch.set(self.economy_shard_doc(i), dict.fromkeys(sums, 0))
+        # シャード数を減らした後に残っている分も合計に入るので消しておく
+        for ref in self.db.collection("economy_stats").list_documents():
+            if not ref.id.isdigit() or int(ref.id) >= self.ECONOMY_SHARDS:
+                batch.delete(ref)
+        batch.commit()
+        return totals
+
+    # --- 残高 ---
+    @staticmethod
+    def balance_change_fields(amount, is_add=True):
+        if is_add:
+            return {
+                "balance":firestore.Increment(amount),
+                "earned":firestore.Increment(amount)
+            }
+        else:
+            return {
+                "balance":firestore.Increment(-amount),
+                "spent":firestore.Increment(amount)
+            }
+
+    def get_user_data(self, user_id):
+        doc = self.user_doc(user_id).get()
+        return doc.to_dict() if doc.exists else None
+
+    def get_user_balance(self, user_id):
+        doc = self.user_doc(user_id).get()
+        if doc.exists:
+            val = doc.to_dict()
+            return int(val.get("balance",RESET_FIELDS["balance"])), int(val.get("earned",0)), int(val.get("spent",0))
+        batch = self.db.batch()
+        batch.create(self.user_doc(user_id), dict(RESET_FIELDS))
+        self.add_economy_delta(batch, supply=RESET_FIELDS["balance"])
+        try:
+            batch.commit()
+        except AlreadyExists:
+            # 同時に作られた場合はそちらを読む
+            return self.get_user_balance(user_id)
+        return RESET_FIELDS["balance"], 0, 0
+
+    def change_balance(self, user_id, amount, is_add=True):
+        batch = self.db.batch()
+        batch.set(self.user_doc(user_id), self.balance_change_fields(amount, is_add), merge=True)
+        self.add_economy_delta(batch, **balance_change_delta(amount, is_add))
+        batch.commit()
+
+    def reset_user_balance(self, user_id):
+        self.bulk_reset_balance([user_id])
+
+    def bulk_change_balance(self, user_ids, amount, is_add=True):
+        """user_ids 全員の残高を1バッチで加算・減算する（BATCH_LIMIT - 1 人まで）"""
+        fields = self.balance_change_fields(amount, is_add)
+        batch = self.db.batch()
+        for user_id in user_ids:
+            batch.set(self.user_doc(user_id), fields, merge=True)
+        delta = balance_change_delta(amount, is_add)
+        self.add_economy_delta(batch, **{k: v * len(user_ids) for k, v in delta.items()})
+        batch.commit()
+
+    def bulk_reset_balance(self, user_ids):
+        """user_ids 全員の残高・統計を1バッチで初期値に戻す（BATCH_LIMIT - 1 人まで）"""
+        refs = [self.user_doc(user_id) for user_id in user_ids]
+        # リセット前の値は1回でまとめて読んで集計から引く
+        before = [snap.to_dict() if snap.exists else None for snap in self.db.get_all(refs)]
+        batch = self.db.batch()
+        for ref in refs:
+            batch.set(ref, RESET_FIELDS, merge=True)
+        self.add_economy_delta(batch, **reset_delta(before))
+        batch.commit()
+
+    def delete_user(self, user_id, with_items=False):
+        snap = self.user_doc(user_id).get()
+        if snap.exists:
+            b, e, sp = user_totals(snap.to_dict())
+            batch = self.db.batch()
+            batch.delete(self.user_doc(user_id))
+            self.add_economy_delta(batch, supply=-b, earned=-e, spent=-sp)
+            batch.commit()
+        if with_items:
+            for sub_doc in self.user_doc(user_id).collection("items").stream():
+                sub_doc.reference.delete()
+
+    def list_top_users(self, field, limit, start_after=None):
+        """field の降順で limit 人分を返す。start_after（前ページの続きを読むためのカーソル）から続きを読む"""
+        query = self.db.collection("users").order_by(field, direction=firestore.Query.DESCENDING)
+        if start_after is not None:
+            query = query.start_after(start_after)
+        docs = list(query.limit(limit).stream())
+        rows = [{**doc.to_dict(), "user_id": int(doc.id)} for doc in docs]
+        return rows, (docs[-1] if docs else None)
+
+    def claim_login_bonus(self, user_id, reward, today):
+        """
+        ログインボーナスを受け取る（last_login の確認と加算を1トランザクションで）。
+        今日もう受け取っていれば False
+        """
+        u_ref = self.user_doc(user_id)
+
+        @firestore.transactional
+        def do_claim(transaction):
+            snap = u_ref.get(transaction=transaction)
+            if snap.exists and snap.to_dict().get("last_login") == today:
+                return False
+            transaction.set(u_ref, {
+                "balance": firestore.Increment(reward),
+                "earned": firestore.Increment(reward),
+                "last_login": today
+            }, merge=True)
+            self.add_economy_delta(transaction, supply=reward, earned=reward)
+            return True
+
+        return do_claim(self.db.transaction())
+
+    def transfer_balance(self, from_id, to_id, amount):
+        """
+        from_id から to_id へ amount を渡す（残高の確認と両者の書き込みを1トランザクションで）。
+        残高不足なら False
+        """
+        from_ref = self.user_doc(from_id)
+        to_ref = self.user_doc(to_id)
+
+        @firestore.transactional
+        def do_transfer(transaction):
+            from_snap = from_ref.get(transaction=transaction)
+            if from_snap.exists:
+                if int(from_snap.to_dict().get("balance", RESET_FIELDS["balance"])) < amount:
+                    return False
+                transaction.update(from_ref, self.balance_change_fields(amount, is_add=False))
+            else:
+                # まだいない人は初期残高から払う（get_user_balance で作られるのと同じ）
+                if RESET_FIELDS["balance"] < amount:
+                    return False
+                transaction.set(from_ref, {**RESET_FIELDS, "balance": RESET_FIELDS["balance"] - amount, "spent": amount})
+                self.add_economy_delta(transaction, supply=RESET_FIELDS["balance"])
+            transaction.set(to_ref, self.balance_change_fields(amount, is_add=True), merge=True)
+            # 渡した分は差し引きゼロ。獲得・消費だけ集計に足す
+            self.add_economy_delta(transaction, earned=amount, spent=amount)
+            return True
+
+        return do_transfer(self.db.transaction())
+
+    def commit_rewards(self, chunk):
+        """[(user_id, amount)] を1つのバッチで加算する（集計の1件を含めて BATCH_LIMIT 件以内）"""
+        batch = self.db.batch()
+        for user_id, amount in chunk:
+            batch.set(self.user_doc(user_id), self.balance_change_fields(amount, is_add=True), merge=True)
+        total = sum(amount for _, amount in chunk)
+        self.add_economy_delta(batch, supply=total, earned=total)
+        batch.commit()
+
+    def grant_reaction_reward(self, reward_id, user_id, amount, data):
+        """
+        付与済みフラグの作成と残高の加算を1回のコミットで行う。
+        フラグは create（既にあれば失敗）なのでバッチごと失敗し、二重付与にならない。既に付与済みなら False
+        """
+        batch = self.db.batch()
+        batch.create(self.db.collection("reaction_rewards").document(reward_id), data)
+        batch.set(self.user_doc(user_id), self.balance_change_fields(amount, is_add=True), merge=True)
+        self.add_economy_delta(batch, **balance_change_delta(amount, is_add=True))
+        try:
+            batch.commit()
+        except AlreadyExists:
+            return False
+        return True
+
+    def watch_users(self, on_user):
+        """
+        users の変更を on_user(ユーザーID) で知らせる（残高キャッシュから捨てる用）。戻り値は unsubscribe() を持つ監視のリスト
+        Firestore では users 全体は監視しない: 全体の on_snapshot は開始・再接続のたびに全ドキュメントを読み、
+        全件をクライアントのメモリに持つため。代わりにキャッシュにいる人を watch_user で1件ずつ監視する
+        """
+        return []
+
+    def watch_user(self, user_id, on_user):
+        """
+        users/{user_id} 1件の変更を on_user(ユーザーID) で知らせる。戻り値は unsubscribe() を持つ監視
+        （監視ごとに接続とスレッドを1つ持つので、呼ぶ側で数を絞る）。最初に届く今の状態は変更ではないので知らせない
+        """
+        first = True
+        def changed(docs, changes, read_time):
+            nonlocal first
+            if first:
+                first = False
+                return
+            on_user(user_id)
+        return self.user_doc(user_id).on_snapshot(changed)
+
+    def watch_items(self, on_items):
+        """
+        所持アイテムが変わったユーザーを on_items(ユーザーID) で知らせる（所持アイテムのキャッシュから捨てる用）。
+        Firestore では watch_users と同じ理由で監視しない（items のコレクショングループ全体になるため）
+        """
+        return []
+
+    # --- データ整理・メンテナンス ---
+    def list_user_id_page(self, after_id, limit):
+        """ドキュメントID順に after_id の次から limit 件の (ユーザーID, データ) を返す"""
+        query = self.db.collection("users").order_by("__name__")
+        if after_id:
+            query = query.start_after({"__name__": after_id})
+        return [(doc.id, doc.to_dict()) for doc in query.limit(limit).stream()]
+
+    def list_item_path_page(self, after_path, limit):
+        """全ユーザーの items をパス順に after_path の次から limit 件返す（親のユーザーが消えた物も含む）"""
+        query = self.db.collection_group("items").order_by("__name__")
+        if after_path:
+            query = query.start_after({"__name__": self.db.document(after_path)})
+        return [doc.reference.path for doc in query.limit(limit).stream()]
+
+    def delete_paths(self, paths):
+        """BulkWriter でまとめて削除し、削除できなかったパスのリストを返す（削除は冪等なので再試行は BulkWriter に任せる）"""
+        failed = []
+        def on_error(error):
+            if error.attempts < 5:
+                return True
+            failed.append(error.operation.reference.path)
+            return False
+        writer = self.db.bulk_writer()
+        writer.on_write_error(on_error)
+        for path in paths:
+            writer.delete(self.db.document(path))
+        writer.close()
+        return failed
+
+    def get_checkpoint(self, name):
+        doc = self.db.collection("maintenance").document(name).get()
+        return doc.to_dict() if doc.exists else None
+
+    def save_checkpoint(self, name, data):
+        self.db.collection("maintenance").document(name).set(data)
+
+    # --- 通話報酬 ---
+    def list_voice_checkpoints(self):
+        return [doc.to_dict() for doc in self.db.collection("voice_sessions").stream()]
+
+    def commit_voice_tick(self, payouts, checkpoints, closed):
+        """
+        通話報酬の加算とセッションの保存・削除を1バッチで書く（報酬とチェックポイントがずれないように）
+        payouts: [(user_id, 報酬)] / checkpoints: [(doc_id, データ)] / closed: [doc_id]
+        """
+        batch = self.db.batch()
+        for user_id, reward in payouts:
+            batch.set(self.user_doc(user_id), self.balance_change_fields(reward, is_add=True), merge=True)
+        total = sum(reward for _, reward in payouts)
+        self.add_economy_delta(batch, supply=total, earned=total)
+        for doc_id, data in checkpoints:
+            batch.set(self.db.collection("voice_sessions").document(doc_id), data)
+        for doc_id in closed:
+            batch.delete(self.db.collection("voice_sessions").document(doc_id))
+        batch.commit()
+
+    # --- ショップ・商品 ---
+    def list_shop_names(self):
+        return [doc.id for doc in self.db.collection("shops").stream()]
+
+    def list_all_products(self):
+        """全ショップの商品を (ショップ名, 商品名, データ) で返す"""
+        return [
+            (doc.reference.parent.parent.id, doc.id, doc.to_dict())
+            for doc in self.db.collection_group("products").stream()
+        ]
+
+    def create_shop(self, shop_name):
+        self.shop_doc(shop_name).set({})
+    def delete_shop(self, shop_name):
+        self.shop_doc(shop_name).delete()
+    def get_product(self, shop_name, product_name):
+        doc = self.product_doc(shop_name, product_name).get()
+        return doc.to_dict() if doc.exists else None
+    def set_product(self, shop_name, product_name, data):
+        self.product_doc(shop_name, product_name).set(data)
+    def delete_product(self, shop_name, product_name):
+        self.product_doc(shop_name, product_name).delete()
+
+    def watch_catalog(self, on_shop, on_product):
+        """
+        shops / products の変更を on_snapshot で受け取る。
+        on_shop(ショップ名, 削除されたか) / on_product(ショップ名, 商品名, データ or 削除なら None)
+        戻り値は unsubscribe() を持つ監視のリスト
+        """
+        def shops_changed(docs, changes, read_time):
+            for change in changes:
+                on_shop(change.document.id, change.type.name == "REMOVED")
+
+        def products_changed(docs, changes, read_time):
+            for change in changes:
+                doc = change.document
+                data = None if change.type.name == "REMOVED" else doc.to_dict()
+                on_product(doc.reference.parent.parent.id, doc.id, data)
+
+        return [
+            self.db.collection("shops").on_snapshot(shops_changed),
+            self.db.collection_group("products").on_snapshot(products_changed),
+        ]
+
+    # --- 所持アイテム ---
+    def list_user_items(self, user_id):
+        items = []
+        for doc in self.user_doc(user_id).collection("items").stream():
+            shop_name, product_name = doc.id.split(":", 1)
+            items.append({**doc.to_dict(), "shop_name": shop_name, "product_name": product_name})
+        return items
+
+    def add_user_item(self, user_id, shop_name, product_name, amount=1):
+        self.user_item_doc(user_id, shop_name, product_name).set({
+            "amount": firestore.Increment(amount),
+            "shop_name": shop_name,
+            "product_name": product_name
+        }, merge=True)
+
+    def buy_product(self, user_id, shop_name, product_name, quantity=1):
+        """
+        商品を quantity 個買う（商品と残高を1回でまとめて読み、支払い・在庫・所持アイテムを1回のコミットで書く）
+        戻り値: (結果, 購入後の商品データ)
+        結果は "ok" / "missing"（商品なし）/ "sold_out"（在庫不足）/ "short"（残高不足）
+        """
+        p_ref = self.product_doc(shop_name, product_name)
+        u_ref = self.user_doc(user_id)
+        i_ref = self.user_item_doc(user_id, shop_name, product_name)
+
+        @firestore.transactional
+        def do_buy(transaction):
+            snaps = {snap.reference.path: snap for snap in self.db.get_all([p_ref, u_ref], transaction=transaction)}
+            p_snap, u_snap = snaps[p_ref.path], snaps[u_ref.path]
+            if not p_snap.exists:
+                return "missing", None
+            product = p_snap.to_dict()
+            cost = product.get("price", 0) * quantity
+            stock = take_stock(product.get("stock", 0), quantity)
+            if stock is None:
+                return "sold_out", product
+            balance = int(u_snap.to_dict().get("balance", RESET_FIELDS["balance"])) if u_snap.exists else RESET_FIELDS["balance"]
+            if balance < cost:
+                return "short", product
+
+            if u_snap.exists:
+                transaction.update(u_ref, self.balance_change_fields(cost, is_add=False))
+                self.add_economy_delta(transaction, **balance_change_delta(cost, is_add=False))
+            else:
+                transaction.set(u_ref, {**RESET_FIELDS, "balance": RESET_FIELDS["balance"] - cost, "spent": cost})
+                self.add_economy_delta(transaction, supply=RESET_FIELDS["balance"] - cost, spent=cost)
+            if product.get("stock", 0) != 0:
+                transaction.update(p_ref, {"stock": stock})
+            transaction.set(i_ref, {
+                "amount": firestore.Increment(quantity),
+                "shop_name": shop_name,
+                "product_name": product_name
+            }, merge=True)
+            return "ok", product | {"stock": stock}
+
+        return do_buy(self.db.transaction())
+
+    def bulk_add_user_item(self, user_ids, shop_name, product_name, amount=1):
+        """user_ids 全員に同じアイテムを amount 個ずつ1バッチで追加する（BATCH_LIMIT 人まで）"""
+        fields = {
+            "amount": firestore.Increment(amount),
+            "shop_name": shop_name,
+            "product_name": product_name
+        }
+        batch = self.db.batch()
+        for user_id in user_ids:
+            batch.set(self.user_item_doc(user_id, shop_name, product_name), fields, merge=True)
+        batch.commit()
+
+    def transfer_user_item(self, from_id, to_id, shop_name, product_name):
+        """アイテムを1個移動する。持っていなければ False"""
+        from_ref = self.user_item_doc(from_id, shop_name, product_name)
+        to_ref = self.user_item_doc(to_id, shop_name, product_name)
+
+        @firestore.transactional
+        def do_transfer(transaction):
+            from_snap = from_ref.get(transaction=transaction)
+            to_snap = to_ref.get(transaction=transaction)
+            if not from_snap.exists: return False
+            data = from_snap.to_dict()
+            now_amt = data.get("amount", 0)
+            if now_amt < 1: return False
+            if now_amt == 1: transaction.delete(from_ref)
+            else: transaction.update(from_ref, {"amount": now_amt - 1})
+            if to_snap.exists: transaction.update(to_ref, {"amount": to_snap.to_dict().get("amount", 0) + 1})
+            else: transaction.set(to_ref, {"amount": 1, "shop_name": shop_name, "product_name": product_name})
+            return True
+
+        return do_transfer(self.db.transaction())
+
+    # --- 宝くじ ---
+    # 在庫（remaining / count1..6）は親ドキュメントではなく lottery_shards/{i} に分けて持つ。
+    def list_lotteries(self):
+        return [(doc.id, doc.to_dict()) for doc in self.db.collection("lottery_settings").stream()]
+
+    def list_lottery_shards(self):
+        """全宝くじのシャード在庫を {宝くじ名: {シャード番号: 残り枚数}} で返す"""
+        shards = {}
+        for doc in self.db.collection_group("lottery_shards").stream():
+            name = doc.reference.parent.parent.id
+            shards.setdefault(name, {})[int(doc.id)] = doc.to_dict().get("remaining", 0)
+        return shards
+
+    def get_lottery(self, name):
+        doc = self.lottery_doc(name).get()
+        return doc.to_dict() if doc.exists else None
+
+    def set_lottery(self, name, data, shard_data):
+        """設定とシャードをまとめて書き込む（前回より減ったシャードは消す）"""
+        old_shards = [doc.reference for doc in self.lottery_doc(name).collection("lottery_shards").list_documents()]
+        batch = self.db.batch()
+        batch.set(self.lottery_doc(name), data | {"shards": len(shard_data)})
+        for i, shard in enumerate(shard_data):
+            batch.set(self.lottery_shard_doc(name, i), shard | lottery_prizes(data))
+        for ref in old_shards:
+            if int(ref.id) >= len(shard_data):
+                batch.delete(ref)
+        batch.commit()
+
+    def delete_lottery(self, name):
+        for ref in self.lottery_doc(name).collection("lottery_shards").list_documents():
+            ref.delete()
+        self.lottery_doc(name).delete()
+
+    def buy_from_lottery_shard(self, name, index, user_id, price, want):
+        """
+        1つのシャードから最大 want 枚を購入する（支払い・抽選・在庫更新・当選金を1トランザクションで）
+        戻り値: (購入枚数, 結果, 当選金) / 在庫なしなら None / 残高不足なら False
+        """
+        shard_ref = self.lottery_shard_doc(name, index)
+        u_ref = self.user_doc(user_id)
+
+        @firestore.transactional
+        def do_buy(transaction):
+            shard_snap = shard_ref.get(transaction=transaction)
+            user_snap = u_ref.get(transaction=transaction)
+            if not shard_snap.exists:
+                return None
+            shard = shard_snap.to_dict()
+            n = min(want, shard.get("remaining", 0))
+            if n <= 0:
+                return None
+            cost = n * price
+            balance = int(user_snap.to_dict().get("balance", RESET_FIELDS["balance"])) if user_snap.exists else RESET_FIELDS["balance"]
+            if balance < cost:
+                return False
+
+            prizes = {}
+            if index is not None and PRIZE_KEYS[0] not in shard:
+                # 当選金を持たない前のシャード: 親の設定から読み、このシャードにも書いておく
+                prizes = lottery_prizes(self.lottery_doc(name).get(transaction=transaction).to_dict() or {})
+                shard |= prizes
+            results, reward, updates = apply_lottery_draw(shard, n)
+            transaction.update(shard_ref, updates | prizes)
+            if user_snap.exists:
+                transaction.update(u_ref, {
+                    "balance": firestore.Increment(reward - cost),
+                    "earned": firestore.Increment(reward),
+                    "spent": firestore.Increment(cost),
+                })
+                self.add_economy_delta(transaction, supply=reward - cost, earned=reward, spent=cost)
+            else:
+                start = RESET_FIELDS["balance"]
+                transaction.set(u_ref, {"balance": start + reward - cost, "earned": reward, "spent": cost})
+                self.add_economy_delta(transaction, supply=start + reward - cost, earned=reward, spent=cost)
+            return n, results, reward
+
+        return do_buy(self.db.transaction())
+
+# ==============================
+# SQLite
+# ==============================
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS users (
+    user_id TEXT PRIMARY KEY,
+    balance INTEGER NOT NULL DEFAULT 1000,
+    earned INTEGER NOT NULL DEFAULT 0,
+    spent INTEGER NOT NULL DEFAULT 0,
+    last_login TEXT
+);
+CREATE INDEX IF NOT EXISTS users_by_balance ON users (balance DESC, user_id);
+CREATE INDEX IF NOT EXISTS users_by_earned ON users (earned DESC, user_id);
+CREATE INDEX IF NOT EXISTS users_by_spent ON users (spent DESC, user_id);
+
+CREATE TABLE IF NOT EXISTS items (
+    user_id TEXT NOT NULL,
+    shop_name TEXT NOT NULL,
+    product_name TEXT NOT NULL,
+    amount INTEGER NOT NULL,
+    PRIMARY KEY (user_id, shop_name, product_name)
+) WITHOUT ROWID;
+
+CREATE TABLE IF NOT EXISTS shops (name TEXT PRIMARY KEY) WITHOUT ROWID;
+CREATE TABLE IF NOT EXISTS products (
+    shop_name TEXT NOT NULL,
+    product_name TEXT NOT NULL,
+    data TEXT NOT NULL,
+    PRIMARY KEY (shop_name, product_name)
+) WITHOUT ROWID;
+
+CREATE TABLE IF NOT EXISTS lotteries (name TEXT PRIMARY KEY, data TEXT NOT NULL) WITHOUT ROWID;
+CREATE TABLE IF NOT EXISTS lottery_shards (
+    name TEXT NOT NULL,
+    idx INTEGER NOT NULL,
+    data TEXT NOT NULL,
+    PRIMARY KEY (name, idx)
+) WITHOUT ROWID;
+
+CREATE TABLE IF NOT EXISTS reaction_rewards (reward_id TEXT PRIMARY KEY, data TEXT NOT NULL) WITHOUT ROWID;
+CREATE TABLE IF NOT EXISTS voice_sessions (doc_id TEXT PRIMARY KEY, data TEXT NOT NULL) WITHOUT ROWID;
+CREATE TABLE IF NOT EXISTS maintenance (name TEXT PRIMARY KEY, data TEXT NOT NULL) WITHOUT ROWID;
+
+CREATE TABLE IF NOT EXISTS economy_stats (
+    id INTEGER PRIMARY KEY CHECK (id = 0),
+    supply INTEGER NOT NULL DEFAULT 0,
+    earned INTEGER NOT NULL DEFAULT 0,
+    spent INTEGER NOT NULL DEFAULT 0,
+    users INTEGER NOT NULL DEFAULT 0
+);
+INSERT OR IGNORE INTO economy_stats (id) VALUES (0);
+"""
+
+# 複数プロセスで1つのファイルを使う時だけ（SQLITE_WATCH=1 で一度開いたファイル）。
+# users / items / shops / products の変更をトリガーで change_log に積み、各プロセスがポーリングで読む。
+# 開く時にトリガーを消すと、同じファイルを使っている他のプロセスの追従まで止まるので、一度作ったら消さない。
+WATCH_TRIGGERS = {
+    "log_users_insert": "AFTER INSERT ON users BEGIN INSERT INTO change_log (kind, key) VALUES ('users', NEW.user_id); END",
+    "log_users_update": "AFTER UPDATE ON users BEGIN INSERT INTO change_log (kind, key) VALUES ('users', NEW.user_id); END",
+    "log_users_delete": "AFTER DELETE ON users BEGIN INSERT INTO change_log (kind, key) VALUES ('users', OLD.user_id); END",
+    "log_shops_insert": "AFTER INSERT ON shops BEGIN INSERT INTO change_log (kind, key) VALUES ('shops', NEW.name); END",
+    "log_shops_delete": "AFTER DELETE ON shops BEGIN INSERT INTO change_log (kind, key) VALUES ('shops', OLD.name); END",
+    "log_products_insert": "AFTER INSERT ON products BEGIN"
+        " INSERT INTO change_log (kind, key, sub) VALUES ('products', NEW.shop_name, NEW.product_name); END",
+    "log_products_update": "AFTER UPDATE ON products BEGIN"
+        " INSERT INTO change_log (kind, key, sub) VALUES ('products', NEW.shop_name, NEW.product_name); END",
+    "log_products_delete": "AFTER DELETE ON products BEGIN"
+        " INSERT INTO change_log (kind, key, sub) VALUES ('products', OLD.shop_name, OLD.product_name); END",
+    "log_items_insert": "AFTER INSERT ON items BEGIN INSERT INTO change_log (kind, key) VALUES ('items', NEW.user_id); END",
+    "log_items_update": "AFTER UPDATE ON items BEGIN INSERT INTO change_log (kind, key) VALUES ('items', NEW.user_id); END",
+    "log_items_delete": "AFTER DELETE ON items BEGIN INSERT INTO change_log (kind, key) VALUES ('items', OLD.user_id); END",
+}
+WATCH_SETTING = "sqlite_watch"  # maintenance 表に記録する名前
+WATCH_INTERVAL = float(os.getenv("SQLITE_WATCH_INTERVAL") or 1.0)
+CHANGE_LOG_KEEP_SECONDS = 600  # これより古い change_log は消す（止まっていたプロセスはキャッシュの期限切れで追いつく）
+
+class SQLiteStorage:
+    """
+    1ファイルの SQLite（WAL モード）。接続はスレッドごとに持ち、読み込みは書き込みと並行して進む。
+    書き込みは BEGIN IMMEDIATE のトランザクションで、複数の表にまたがる更新もまとめて反映される。
+    集計（economy_stats）は書き込みが1本に並ぶので分散させず1行で持つ。
+    """
+    name = "sqlite"
+
+    def __init__(self, path, watch=False):
+        self.path = path
+        self._local = threading.local()
+        conn = self._conn()
+        conn.executescript(SCHEMA)
+        with _WriteTransaction(conn):
+            # watch はファイル側の設定と合わせる（どれか1つのプロセスが有効にしたら全員が記録・追従する）
+            stored = self._get_json("maintenance", "name", WATCH_SETTING)
+            if watch and not stored:
+                conn.execute(
+                    "INSERT OR REPLACE INTO maintenance (name, data) VALUES (?, ?)", (WATCH_SETTING, json.dumps(True))
+                )
+            self.watch = bool(watch or stored)
+            if self.watch:
+                conn.execute(
+                    "CREATE TABLE IF NOT EXISTS change_log (seq INTEGER PRIMARY KEY AUTOINCREMENT,"
+                    " kind TEXT NOT NULL, key TEXT NOT NULL, sub TEXT NOT NULL DEFAULT '',"
+                    " at REAL NOT NULL DEFAULT (julianday('now')))"
+                )
+                for name, body in WATCH_TRIGGERS.items():
+                    conn.execute(f"CREATE TRIGGER IF NOT EXISTS {name} {body}")
+
+    def _conn(self):
+        conn = getattr(self._local, "conn", None)
+        if conn is None:
+            conn = sqlite3.connect(self.path, timeout=30, isolation_level=None, check_same_thread=False)
+            conn.row_factory = sqlite3.Row
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("PRAGMA synchronous=NORMAL")
+            conn.execute("PRAGMA foreign_keys=OFF")
+            self._local.conn = conn
+        return conn
+
+    def _write(self):
+        return _WriteTransaction(self._conn())
+
+    def close(self):
+        conn = getattr(self._local, "conn", None)
+        if conn is not None:
+            conn.close()
+            self._local.conn = None
+
+    # --- 経済全体の集計 ---
+    @staticmethod
+    def _add_economy(conn, supply=0, earned=0, spent=0, users=0):
+        if supply or earned or spent or users:
+            conn.execute(
+                "UPDATE economy_stats SET supply = supply + ?, earned = earned + ?,"
+                " spent = spent + ?, users = users + ? WHERE id = 0",
+                (supply, earned, spent, users),
+            )
+
+    def commit_economy_delta(self, delta):
+        with self._write() as conn:
+            self._add_economy(conn, **delta)
+
+    def get_economy_stats(self):
+        row = self._conn().execute("SELECT supply, earned, spent, users FROM economy_stats WHERE id = 0").fetchone()
+        return {key: int(row[key]) for key in ECONOMY_FIELDS}
+
+    def recount_economy_stats(self):
+        with self._write() as conn:
+            row = conn.execute(
+                "SELECT COALESCE(SUM(balance), 0) AS supply, COALESCE(SUM(earned), 0) AS earned,"
+                " COALESCE(SUM(spent), 0) AS spent, COUNT(*) AS users FROM users"
+            ).fetchone()
+            totals = {key: int(row[key]) for key in ECONOMY_FIELDS}
+            conn.execute(
+                "UPDATE economy_stats SET supply = ?, earned = ?, spent = ?, users = ? WHERE id = 0",
+                tuple(totals[key] for key in ECONOMY_FIELDS),
+            )
+        return totals
+
+    # --- 残高 ---
+    @staticmethod
+    def _user_dict(row):
+        data = {"balance": row["balance"], "earned": row["earned"], "spent": row["spent"]}
+        if row["last_login"] is not None:
+            data["last_login"] = row["last_login"]
+        return data
+
+    def _read_user(self, conn, user_id):
+        row = conn.execute("SELECT * FROM users WHERE user_id = ?", (str(user_id),)).fetchone()
+        return self._user_dict(row) if row else None
+
+    @staticmethod
+    def _ensure_user(conn, user_id):
+        """ユーザーの行が無ければ初期値で作り、作ったかどうかを返す"""
+        created = conn.execute(
+            "INSERT OR IGNORE INTO users (user_id, balance) VALUES (?, ?)", (str(user_id), RESET_FIELDS["balance"])
+        ).rowcount
+        if created:
+            SQLiteStorage._add_economy(conn, supply=RESET_FIELDS["balance"], users=1)
+        return bool(created)
+
+    def _change_balance(self, conn, user_id, amount, is_add):
+        # Firestore の Increment と同じく、行が無い時は 0 から加算する（初期残高は付かない）
+        created = conn.execute(
+            "INSERT OR IGNORE INTO users (user_id, balance, earned, spent) VALUES (?, 0, 0, 0)", (str(user_id),)
+        ).rowcount
+        if is_add:
+            conn.execute(
+                "UPDATE users SET balance = balance + ?, earned = earned + ? WHERE user_id = ?",
+                (amount, amount, str(user_id)),
+            )
+        else:
+            conn.execute(
+                "UPDATE users SET balance = balance - ?, spent = spent + ? WHERE user_id = ?",
+                (amount, amount, str(user_id)),
+            )
+        self._add_economy(conn, **balance_change_delta(amount, is_add), users=created)
+
+    def get_user_data(self, user_id):
+        return self._read_user(self._conn(), user_id)
+
+    def get_user_balance(self, user_id):
+        data = self._read_user(self._conn(), user_id)
+        if data is None:
+            with self._write() as conn:
+                self._ensure_user(conn, user_id)
+                data = self._read_user(conn, user_id)
+        return user_totals(data)
+
+    def change_balance(self, user_id, amount, is_add=True):
+        with self._write() as conn:
+            self._change_balance(conn, user_id, amount, is_add)
+
+    def reset_user_balance(self, user_id):
+        self.bulk_reset_balance([user_id])
+
+    def bulk_change_balance(self, user_ids, amount, is_add=True):
+        with self._write() as conn:
+            for user_id in user_ids:
+                self._change_balance(conn, user_id, amount, is_add)
+
+    def bulk_reset_balance(self, user_ids):
+        with self._write() as conn:
+            before = [self._read_user(conn, user_id) for user_id in user_ids]
+            conn.executemany(
+                "INSERT INTO users (user_id, balance, earned, spent) VALUES (?, ?, ?, ?)"
+                " ON CONFLICT(user_id) DO UPDATE SET"
+                " balance = excluded.balance, earned = excluded.earned, spent = excluded.spent",
+                [(str(user_id), RESET_FIELDS["balance"], RESET_FIELDS["earned"], RESET_FIELDS["spent"])
+                 for user_id in user_ids],
+            )
+            self._add_economy(conn, **reset_delta(before))
+
+    def delete_user(self, user_id, with_items=False):
+        with self._write() as conn:
+            data = self._read_user(conn, user_id)
+            if data is not None:
+                b, e, sp = user_totals(data)
+                conn.execute("DELETE FROM users WHERE user_id = ?", (str(user_id),))
+                self._add_economy(conn, supply=-b, earned=-e, spent=-sp, users=-1)
+            if with_items:
+                conn.execute("DELETE FROM items WHERE user_id = ?", (str(user_id),))
+
+    def list_top_users(self, field, limit, start_after=None):
+        """field の降順で limit 人分を返す。start_after は前回返したカーソル（(値, ユーザーID)）"""
+        if field not in RANKING_COLUMNS:
+            raise ValueError(f"並べ替えできない項目: {field}")
+        sql = "SELECT * FROM users"
+        params = []
+        if start_after is not None:
+            sql += f" WHERE {field} < ? OR ({field} = ? AND user_id > ?)"
+            params = [start_after[0], start_after[0], start_after[1]]
+        sql += f" ORDER BY {field} DESC, user_id LIMIT ?"
+        rows = self._conn().execute(sql, (*params, limit)).fetchall()
+        result = [{**self._user_dict(row), "user_id": int(row["user_id"])} for row in rows]
+        return result, ((rows[-1][field], rows[-1]["user_id"]) if rows else None)
+
+    def claim_login_bonus(self, user_id, reward, today):
+        with self._write() as conn:
+            user = self._read_user(conn, user_id)
+            if user is not None and user.get("last_login") == today:
+                return False
+            self._change_balance(conn, user_id, reward, True)
+            conn.execute("UPDATE users SET last_login = ? WHERE user_id = ?", (today, str(user_id)))
+        return True
+
+    def transfer_balance(self, from_id, to_id, amount):
+        with self._write() as conn:
+            self._ensure_user(conn, from_id)
+            if self._read_user(conn, from_id)["balance"] < amount:
+                return False
+            self._change_balance(conn, from_id, amount, False)
+            self._change_balance(conn, to_id, amount, True)
+        return True
+
+    def commit_rewards(self, chunk):
+        with self._write() as conn:
+            for user_id, amount in chunk:
+                self._change_balance(conn, user_id, amount, True)
+
+    def grant_reaction_reward(self, reward_id, user_id, amount, data):
+        with self._write() as conn:
+            inserted = conn.execute(
+                "INSERT OR IGNORE INTO reaction_rewards (reward_id, data) VALUES (?, ?)",
+                (reward_id, json.dumps(data, ensure_ascii=False, default=str)),
+            ).rowcount
+            if not inserted:
+                return False
+            self._change_balance(conn, user_id, amount, True)
+        return True
+
+    def watch_users(self, on_user):
+        # 書き込むのがこのプロセスだけなら、書き込み時のキャッシュ更新で足りる
+        if not self.watch:
+            return []
+        def changed(kind, key, sub):
+            on_user(int(key))
+        return [_ChangeLogWatch(self, ("users",), changed)]
+
+    def watch_items(self, on_items):
+        if not self.watch:
+            return []
+        def changed(kind, key, sub):
+            on_items(int(key))
+        return [_ChangeLogWatch(self, ("items",), changed)]
+
+    # --- データ整理・メンテナンス ---
+    def list_user_id_page(self, after_id, limit):
+        rows = self._conn().execute(
+            "SELECT * FROM users WHERE user_id > ? ORDER BY user_id LIMIT ?", (after_id or "", limit)
+        ).fetchall()
+        return [(row["user_id"], self._user_dict(row)) for row in rows]
+
+    def list_item_path_page(self, after_path, limit):
+        """Firestore と同じ users/{user_id}/items/{shop:product} 形式のパスで返す"""
+        after = ("", "", "")
+        if after_path:
+            _, user_id, _, key = after_path.split("/", 3)
+            after = (user_id, *key.split(":", 1))
+        rows = self._conn().execute(
+            "SELECT user_id, shop_name, product_name FROM items"
+            " WHERE (user_id, shop_name, product_name) > (?, ?, ?)"
+            " ORDER BY user_id, shop_name, product_name LIMIT ?",
+            (*after, limit),
+        ).fetchall()
+        return [item_path(*row) for row in rows]
+
+    def delete_paths(self, paths):
+        """users/{id} と users/{id}/items/{shop:product} 形式のパスを削除する（1トランザクションなので失敗したパスは無い）"""
+        with self._write() as conn:
+            for path in paths:
+                parts = path.split("/", 3)
+                if len(parts) == 2:
+                    conn.execute("DELETE FROM users WHERE user_id = ?", (parts[1],))
+                else:
+                    shop_name, product_name = parts[3].split(":", 1)
+                    conn.execute(
+                        "DELETE FROM items WHERE user_id = ? AND shop_name = ? AND product_name = ?",
+                        (parts[1], shop_name, product_name),
+                    )
+        return []
+
+    def _get_json(self, table, key_column, key):
+        row = self._conn().execute(f"SELECT data FROM {table} WHERE {key_column} = ?", (key,)).fetchone()
+        return json.loads(row["data"]) if row else None
+
+    def get_checkpoint(self, name):
+        return self._get_json("maintenance", "name", name)
+
+    def save_checkpoint(self, name, data):
+        with self._write() as conn:
+            conn.execute(
+                "INSERT OR REPLACE INTO maintenance (name, data) VALUES (?, ?)",
+                (name, json.dumps(data, ensure_ascii=False)),
+            )
+
+    # --- 通話報酬 ---
+    def list_voice_checkpoints(self):
+        return [json.loads(row["data"]) for row in self._conn().execute("SELECT data FROM voice_sessions")]
+
+    def commit_voice_tick(self, payouts, checkpoints, closed):
+        with self._write() as conn:
+            for user_id, reward in payouts:
+                self._change_balance(conn, user_id, reward, True)
+            conn.executemany(
+                "INSERT OR REPLACE INTO voice_sessions (doc_id, data) VALUES (?, ?)",
+                [(doc_id, json.dumps(data)) for doc_id, data in checkpoints],
+            )
+            conn.executemany("DELETE FROM voice_sessions WHERE doc_id = ?", [(doc_id,) for doc_id in closed])
+
+    # --- ショップ・商品 ---
+    def list_shop_names(self):
+        return [row["name"] for row in self._conn().execute("SELECT name FROM shops")]
+
+    def list_all_products(self):
+        return [
+            (row["shop_name"], row["product_name"], json.loads(row["data"]))
+            for row in self._conn().execute("SELECT * FROM products")
+        ]
+
+    def create_shop(self, shop_name):
+        with self._write() as conn:
+            conn.execute("INSERT OR IGNORE INTO shops (name) VALUES (?)", (shop_name,))
+
+    def delete_shop(self, shop_name):
+        # Firestore と同じく、商品（サブコレクション）はショップを消しても残る
+        with self._write() as conn:
+            conn.execute("DELETE FROM shops WHERE name = ?", (shop_name,))
+
+    def get_product(self, shop_name, product_name):
+        row = self._conn().execute(
+            "SELECT data FROM products WHERE shop_name = ? AND product_name = ?", (shop_name, product_name)
+        ).fetchone()
+        return json.loads(row["data"]) if row else None
+
+    def set_product(self, shop_name, product_name, data):
+        with self._write() as conn:
+            conn.execute(
+                "INSERT OR REPLACE INTO products (shop_name, product_name, data) VALUES (?, ?, ?)",
+                (shop_name, product_name, json.dumps(data, ensure_ascii=False)),
+            )
+
+    def delete_product(self, shop_name, product_name):
+        with self._write() as conn:
+            conn.execute(
+                "DELETE FROM products WHERE shop_name = ? AND product_name = ?", (shop_name, product_name)
+            )
+
+    def watch_catalog(self, on_shop, on_product):
+        if not self.watch:
+            return []
+        def changed(kind, key, sub):
+            if kind == "shops":
+                exists = self._conn().execute("SELECT 1 FROM shops WHERE name = ?", (key,)).fetchone()
+                on_shop(key, exists is None)
+            else:
+                on_product(key, sub, self.get_product(key, sub))
+        return [_ChangeLogWatch(self, ("shops", "products"), changed)]
+
+    # --- 所持アイテム ---
+    def list_user_items(self, user_id):
+        rows = self._conn().execute(
+            "SELECT shop_name, product_name, amount FROM items WHERE user_id = ?", (str(user_id),)
+        ).fetchall()
+        return [dict(row) for row in rows]
+
+    def add_user_item(self, user_id, shop_name, product_name, amount=1):
+        with self._write() as conn:
+            conn.execute(
+                "INSERT INTO items (user_id, shop_name, product_name, amount) VALUES (?, ?, ?, ?)"
+                " ON CONFLICT(user_id, shop_name, product_name) DO UPDATE SET amount = amount + excluded.amount",
+                (str(user_id), shop_name, product_name, amount),
+            )
+
+    def bulk_add_user_item(self, user_ids, shop_name, product_name, amount=1):
+        with self._write() as conn:
+            conn.executemany(
+                "INSERT INTO items (user_id, shop_name, product_name, amount) VALUES (?, ?, ?, ?)"
+                " ON CONFLICT(user_id, shop_name, product_name) DO UPDATE SET amount = amount + excluded.amount",
+                [(str(user_id), shop_name, product_name, amount) for user_id in user_ids],
+            )
+
+    def buy_product(self, user_id, shop_name, product_name, quantity=1):
+        with self._write() as conn:
+            row = conn.execute(
+                "SELECT data FROM products WHERE shop_name = ? AND product_name = ?", (shop_name, product_name)
+            ).fetchone()
+            if row is None:
+                return "missing", None
+            product = json.loads(row["data"])
+            cost = product.get("price", 0) * quantity
+            stock = take_stock(product.get("stock", 0), quantity)
+            if stock is None:
+                return "sold_out", product
+            user = self._read_user(conn, user_id)
+            if (user["balance"] if user else RESET_FIELDS["balance"]) < cost:
+                return "short", product
+
+            self._ensure_user(conn, user_id)
+            self._change_balance(conn, user_id, cost, False)
+            if product.get("stock", 0) != 0:
+                conn.execute(
+                    "UPDATE products SET data = json_set(data, '$.stock', ?) WHERE shop_name = ? AND product_name = ?",
+                    (stock, shop_name, product_name),
+                )
+            conn.execute(
+                "INSERT INTO items (user_id, shop_name, product_name, amount) VALUES (?, ?, ?, ?)"
+                " ON CONFLICT(user_id, shop_name, product_name) DO UPDATE SET amount = amount + excluded.amount",
+                (str(user_id), shop_name, product_name, quantity),
+            )
+        return "ok", product | {"stock": stock}
+
+    def transfer_user_item(self, from_id, to_id, shop_name, product_name):
+        with self._write() as conn:
+            taken = conn.execute(
+                "UPDATE items SET amount = amount - 1"
+                " WHERE user_id = ? AND shop_name = ? AND product_name = ? AND amount >= 1",
+                (str(from_id), shop_name, product_name),
+            ).rowcount
+            if not taken:
+                return False
+            conn.execute(
+                "DELETE FROM items WHERE user_id = ? AND shop_name = ? AND product_name = ? AND amount <= 0",
+                (str(from_id), shop_name, product_name),
+            )
+            conn.execute(
+                "INSERT INTO items (user_id, shop_name, product_name, amount) VALUES (?, ?, ?, 1)"
+                " ON CONFLICT(user_id, shop_name, product_name) DO UPDATE SET amount = amount + 1",
+                (str(to_id), shop_name, product_name),
+            )
+        return True
+
+    # --- 宝くじ ---
+    def list_lotteries(self):
+        return [(row["name"], json.loads(row["data"])) for row in self._conn().execute("SELECT * FROM lotteries")]
+
+    def list_lottery_shards(self):
+        shards = {}
+        for row in self._conn().execute("SELECT name, idx, json_extract(data, '$.remaining') AS remaining FROM lottery_shards"):
+            shards.setdefault(row["name"], {})[row["idx"]] = row["remaining"] or 0
+        return shards
+
+    def get_lottery(self, name):
+        return self._get_json("lotteries", "name", name)
+
+    def set_lottery(self, name, data, shard_data):
+        with self._write() as conn:
+            conn.execute(
+                "INSERT OR REPLACE INTO lotteries (name, data) VALUES (?, ?)",
+                (name, json.dumps(data | {"shards": len(shard_data)}, ensure_ascii=False)),
+            )
+            conn.execute("DELETE FROM lottery_shards WHERE name = ?", (name,))
+            conn.executemany(
+                "INSERT INTO lottery_shards (name, idx, data) VALUES (?, ?, ?)",
+                [(name, i, json.dumps(shard | lottery_prizes(data))) for i, shard in enumerate(shard_data)],
+            )
+
+    def delete_lottery(self, name):
+        with self._write() as conn:
+            conn.execute("DELETE FROM lottery_shards WHERE name = ?", (name,))
+            conn.execute("DELETE FROM lotteries WHERE name = ?", (name,))
+
+    def buy_from_lottery_shard(self, name, index, user_id, price, want):
+        with self._write() as conn:
+            if index is None:
+                row = conn.execute("SELECT data FROM lotteries WHERE name = ?", (name,)).fetchone()
+            else:
+                row = conn.execute(
+                    "SELECT data FROM lottery_shards WHERE name = ? AND idx = ?", (name, index)
+                ).fetchone()
+            if row is None:
+                return None
+            shard = json.loads(row["data"])
+            n = min(want, shard.get("remaining", 0))
+            if n <= 0:
+                return None
+            cost = n * price
+            user = self._read_user(conn, user_id)
+            balance = user["balance"] if user else RESET_FIELDS["balance"]
+            if balance < cost:
+                return False
+
+            if index is not None and PRIZE_KEYS[0] not in shard:
+                # 当選金を持たない前のシャード: 親の設定から読み、このシャードにも書いておく
+                parent = conn.execute("SELECT data FROM lotteries WHERE name = ?", (name,)).fetchone()
+                shard |= lottery_prizes(json.loads(parent["data"]) if parent else {})
+            results, reward, updates = apply_lottery_draw(shard, n)
+            data = json.dumps(shard | updates, ensure_ascii=False)
+            if index is None:
+                conn.execute("UPDATE lotteries SET data = ? WHERE name = ?", (data, name))
+            else:
+                conn.execute("UPDATE lottery_shards SET data = ? WHERE name = ? AND idx = ?", (data, name, index))
+            self._ensure_user(conn, user_id)
+            conn.execute(
+                "UPDATE users SET balance = balance + ?, earned = earned + ?, spent = spent + ? WHERE user_id = ?",
+                (reward - cost, reward, cost, str(user_id)),
+            )
+            self._add_economy(conn, supply=reward - cost, earned=reward, spent=cost)
+        return n, results, reward
+
+class _ChangeLogWatch:
+    """
+    change_log を WATCH_INTERVAL 秒ごとに読み、kinds の新しい変更を callback(kind, key, sub) に渡すスレッド。
+    同じ行への変更が続いた分は1回にまとめる。Firestore の監視と同じく unsubscribe() で止まる
+    """
+    PRUNE_EVERY = 60  # 何回読むごとに古い行を消すか
+
+    def __init__(self, storage, kinds, callback):
+        self.storage = storage
+        self.kinds = kinds
+        self.callback = callback
+        self.last_seq = storage._conn().execute("SELECT COALESCE(MAX(seq), 0) FROM change_log").fetchone()[0]
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._run, name="sqlite-watch", daemon=True)
+        self._thread.start()
+
+    def _run(self):
+        marks = ",".join("?" * len(self.kinds))
+        polls = 0
+        while not self._stop.wait(WATCH_INTERVAL):
+            try:
+                conn = self.storage._conn()
+                rows = conn.execute(
+                    f"SELECT seq, kind, key, sub FROM change_log WHERE seq > ? AND kind IN ({marks}) ORDER BY seq",
+                    (self.last_seq, *self.kinds),
+                ).fetchall()
+                if rows:
+                    self.last_seq = rows[-1]["seq"]
+                for kind, key, sub in dict.fromkeys((row["kind"], row["key"], row["sub"]) for row in rows):
+                    self.callback(kind, key, sub)
+                polls += 1
+                if polls % self.PRUNE_EVERY == 0:
+                    with _WriteTransaction(conn):
+                        conn.execute(
+                            "DELETE FROM change_log WHERE at < julianday('now') - ?", (CHANGE_LOG_KEEP_SECONDS / 86400,)
+                        )
+            except Exception as e:
+                print(f"change_log の読み込みに失敗: {e}")
+
+    def unsubscribe(self):
+        self._stop.set()
+
+class _WriteTransaction:
+    """BEGIN IMMEDIATE で書き込みトランザクションを始め、例外が出たらロールバックする"""
+    def __init__(self, conn):
+        self.conn = conn
+
+    def __enter__(self):
+        self.conn.execute("BEGIN IMMEDIATE")
+        return self.conn
+
+    def __exit__(self, exc_type, exc, tb):
+        if exc_type is None:
+            self.conn.execute("COMMIT")
+        else:
+            self.conn.execute("ROLLBACK")
+        return False